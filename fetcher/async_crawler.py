@@ -0,0 +1,336 @@
+# fetcher/async_crawler.py
+import time
+import asyncio
+import logging
+import aiohttp
+from livefeeds_worker import (
+    save_instance_cursor, mark_instance_done,
+    save_livefeeds_page, build_livefeeds_params,
+    get_seek_bounds, check_seek_page, confirm_empty_window, forget_instance,
+    resume_cursor, window_hours, retry_instance, create_scheduler, check_response
+)
+from retry import crawl_error
+from utils import parse_next_max_id, instance_url
+from writer import close_writers
+from storage import create_storage
+from scheduler import Heartbeat, record_crawl_stats
+from metrics import metrics, record_request
+
+logger = logging.getLogger(__name__)
+
+class AsyncCrawler:
+    """
+    Asyncio engine that crawls the public timelines of many instances from a single process.
+    Keeps the round and time window semantics of livefeeds_worker.process_task.
+    """
+    def __init__(self, config, collections, token_pool, worker_id, global_duration, max_round,
+                 max_concurrency=200, per_host=2, timeout=5, schedule='rounds', cursor_interval=10,
+                 claim_batch=1, lease_seconds=300, sort_field='statuses'):
+        """
+        Args:
+            config (Config): Configuration object.
+            collections (dict): MongoDB collections ('livefeeds', 'error_log', 'instances').
+            token_pool (TokenPool): Pool of API tokens.
+            worker_id (int): ID of the worker.
+            global_duration (dict): Dictionary containing 'start_time' and 'end_time'.
+            max_round (int): The maximum number of rounds.
+            max_concurrency (int, optional): Maximum number of requests in flight. Defaults to 200.
+            per_host (int, optional): Maximum number of requests in flight per instance. Defaults to 2.
+            timeout (int, optional): Request timeout in seconds. Defaults to 5.
+            schedule (str, optional): 'rounds' for hourly rounds or 'single' for one pass per instance.
+                Defaults to 'rounds'.
+            cursor_interval (int, optional): Save the cursor every this many pages. Defaults to 10.
+            claim_batch (int, optional): Number of instances claimed at once. Defaults to 1.
+            lease_seconds (int, optional): Seconds without heartbeat after which a claimed instance is requeued.
+                Defaults to 300.
+            sort_field (str, optional): Field the instances are claimed by, largest first. Defaults to 'statuses'.
+        """
+        self.config = config
+        self.collections = create_storage(collections, ['livefeeds', 'error_log'], config)
+        self.token_pool = token_pool
+        self.worker_id = worker_id
+        self.global_duration = global_duration
+        self.max_round = max_round
+        self.max_concurrency = max_concurrency
+        self.per_host = per_host
+        self.timeout = timeout
+        self.schedule = schedule
+        self.cursor_interval = cursor_interval
+        self.scheduler = create_scheduler(collections, 'instances', config, batch_size=claim_batch,
+                                          lease_seconds=lease_seconds, sort_field=sort_field)
+        self.global_semaphore = None
+        self.host_semaphores = {}
+
+    def host_semaphore(self, instance_name):
+        """
+        Returns the semaphore limiting the requests in flight to one instance.
+
+        Args:
+            instance_name (str): Name of the instance.
+
+        Returns:
+            asyncio.Semaphore: Semaphore of the instance.
+        """
+        semaphore = self.host_semaphores.get(instance_name)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.per_host)
+            self.host_semaphores[instance_name] = semaphore
+        return semaphore
+
+    async def request(self, session, instance_name, url, params):
+        """
+        Sends a GET request with a leased token while holding the global and per-instance slots.
+        Leasing and reporting run in a thread, as they are round trips to the central MongoDB in cluster mode.
+
+        Args:
+            session (aiohttp.ClientSession): HTTP session.
+            instance_name (str): Name of the instance.
+            url (str): Request URL.
+            params (dict): Query parameters.
+
+        Returns:
+            tuple: Status code, lower-cased response headers, decoded JSON body (None unless 200) and the leased token.
+        """
+        params = {k: str(v).lower() if isinstance(v, bool) else v for k, v in params.items()}
+        token, wait_time = await asyncio.to_thread(self.token_pool.lease, instance_name)
+        if wait_time > 0:
+            metrics.inc('ratelimit_sleep_seconds_total', wait_time)
+            await asyncio.sleep(wait_time)
+        async with self.global_semaphore, self.host_semaphore(instance_name):
+            request_start = time.monotonic()
+            try:
+                async with session.get(url, headers=self.token_pool.headers(token), params=params) as response:
+                    res_headers = {k.lower(): v for k, v in response.headers.items()}
+                    latency = time.monotonic() - request_start
+                    data = await response.json(content_type=None) if response.status == 200 else None
+            except asyncio.TimeoutError:
+                record_request('timeout', time.monotonic() - request_start, 'timeline')
+                await asyncio.to_thread(self.token_pool.report_timeout, instance_name)
+                raise
+            record_request(response.status, latency, 'timeline')
+        await asyncio.to_thread(self.token_pool.report, instance_name, token, response.status, res_headers, latency)
+        return response.status, res_headers, data, token
+
+    async def fetch_page(self, session, instance_name, url, params):
+        """
+        Requests one page of a timeline and retries it as decided by livefeeds_worker.check_response.
+        Async counterpart of livefeeds_worker.fetch_timeline_page.
+
+        Args:
+            session (aiohttp.ClientSession): HTTP session.
+            instance_name (str): Name of the instance.
+            url (str): Request URL.
+            params (dict): Query parameters.
+
+        Returns:
+            tuple: The decoded statuses, the lower-cased response headers and None, or None, None and the
+                error from retry.crawl_error if the page could not be fetched.
+        """
+        retries = 0
+        while True:
+            logger.debug(f"Request parameters: {params}")
+            try:
+                status_code, res_headers, data, token = await self.request(session, instance_name, url, params)
+            except asyncio.TimeoutError:
+                retries, error = check_response(instance_name, 'timeout', None, retries)
+            else:
+                if status_code == 200:
+                    logger.debug(f"Successfully fetched {len(data)} tweets.")
+                    return data, res_headers, None
+                retries, error = check_response(instance_name, status_code, token, retries)
+            if error:
+                return None, None, error
+
+    async def crawl_instance(self, session, instance_info, stats=None):
+        """
+        Fetches livefeeds (tweets) from a specific Mastodon instance.
+        Async counterpart of livefeeds_worker.fetch_livefeeds.
+
+        Args:
+            session (aiohttp.ClientSession): HTTP session.
+            instance_info (dict): Information about the instance.
+            stats (dict, optional): Counts of the 'pages' and 'statuses' fetched in the window and whether the crawl
+                'resumed' from a cursor or stopped early as 'partial', updated in place.
+
+        Returns:
+            dict or None: None if the instance was crawled, otherwise the error from retry.crawl_error.
+        """
+        instance_name = instance_info['name']
+        current_round = instance_info['round']
+        instances_collection = self.collections['instances']
+        logger.info(f"Starting to fetch tweets from {instance_name}")
+        livefeeds_url = instance_url(instance_name, "/api/v1/timelines/public", self.config.api.get('scheme', 'https'))
+        last_page_flag = resume_cursor(instance_info)
+        if stats is not None:
+            stats['resumed'] = last_page_flag != -1
+        page_num = 0
+        id_range = {}
+        if current_round != 0:
+            id_range = instance_info.get(f'round{current_round-1}_id_range', {})
+        seek_bounds = get_seek_bounds(instance_info, self.global_duration)
+        verify_seek = False
+
+        while True:
+            params = build_livefeeds_params(current_round, last_page_flag, id_range, seek_bounds)
+            try:
+                data, res_headers, error = await self.fetch_page(session, instance_name, livefeeds_url, params)
+                if error:
+                    return error
+
+                if seek_bounds and last_page_flag == -1:
+                    seek_state = await asyncio.to_thread(check_seek_page, data, instances_collection, instance_name)
+                    if seek_state != 'seek':
+                        seek_bounds = None
+                        verify_seek = seek_state == 'verify'
+                        continue
+                elif verify_seek:
+                    verify_seek = False
+                    empty = await asyncio.to_thread(
+                        confirm_empty_window, data, instance_name, self.collections, self.max_round
+                    )
+                    if empty:
+                        return
+
+                if stats is not None:
+                    stats['pages'] = stats.get('pages', 0) + 1
+                    stats['statuses'] = stats.get('statuses', 0) + len(data)
+                finished = await asyncio.to_thread(
+                    save_livefeeds_page, data, instance_info, self.collections,
+                    self.global_duration, self.max_round, id_range, stats
+                )
+                if finished:
+                    return
+
+                if 'link' not in res_headers or len(data) < 40:
+                    return
+                next_max_id = parse_next_max_id(res_headers)
+                if next_max_id:
+                    last_page_flag = next_max_id
+                    page_num += 1
+                    if self.cursor_interval and page_num % self.cursor_interval == 0:
+                        await asyncio.to_thread(save_instance_cursor, instances_collection, instance_name,
+                                                last_page_flag, current_round)
+            except Exception as e:
+                logger.exception(f"Exception while connecting to {instance_name}")
+                return crawl_error('exception', repr(e))
+
+    async def crawl_instance_once(self, session, instance_info):
+        """
+        Crawls an instance in a single pass and, if it succeeded, records its crawl stats and marks it as done.
+
+        Args:
+            session (aiohttp.ClientSession): HTTP session.
+            instance_info (dict): Information about the instance.
+
+        Returns:
+            dict or None: None if the instance was crawled, otherwise the error from retry.crawl_error.
+        """
+        stats = {}
+        crawl_start = time.monotonic()
+        error = await self.crawl_instance(session, instance_info, stats)
+        if error:
+            return error
+        await asyncio.to_thread(record_crawl_stats, self.collections['instances'], instance_info['name'], stats,
+                                time.monotonic() - crawl_start, window_hours(self.global_duration))
+        await asyncio.to_thread(mark_instance_done, self.collections['instances'], instance_info['name'], self.max_round)
+        return None
+
+    async def crawl_leased(self, session, instance_info, round_num):
+        """
+        Crawls a claimed instance and removes its lease afterwards, or schedules a retry if it failed.
+
+        Args:
+            session (aiohttp.ClientSession): HTTP session.
+            instance_info (dict): The claimed instance.
+            round_num (int): The current round number, or None for a single pass.
+        """
+        if round_num is None:
+            error = await self.crawl_instance_once(session, instance_info)
+        else:
+            error = await self.crawl_instance(session, instance_info)
+        forget_instance(self.collections, instance_info['name'])
+        if error:
+            await asyncio.to_thread(retry_instance, self.scheduler, self.collections, instance_info, error)
+        else:
+            await asyncio.to_thread(self.scheduler.complete, instance_info)
+
+    async def run_round(self, session, round_num):
+        """
+        Claims instances of one round and crawls them concurrently until none are left.
+        Whenever a crawl finishes, it claims again, since failed instances become due and expired leases
+        of other workers are requeued while the round runs.
+
+        Args:
+            session (aiohttp.ClientSession): HTTP session.
+            round_num (int): The current round number, or None for a single pass.
+        """
+        claim_round = None if round_num is None else round_num - 1
+        running = set()
+        exhausted = False
+        while True:
+            while not exhausted and len(running) < self.max_concurrency:
+                instance_info = await asyncio.to_thread(self.scheduler.get, claim_round, False)
+                if instance_info:
+                    logger.info(f"Found instance: {instance_info['name']}, starting processing.")
+                    running.add(asyncio.create_task(self.crawl_leased(session, instance_info, round_num)))
+                else:
+                    exhausted = True
+            if not running:
+                if (await asyncio.to_thread(self.scheduler.leased_by_others, claim_round)
+                        or await asyncio.to_thread(self.scheduler.retries_pending, claim_round)):
+                    await asyncio.sleep(self.scheduler.poll_interval)
+                    exhausted = False
+                    continue
+                logger.info(f"No more instances to process for round {round_num}.")
+                return
+            _, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            exhausted = False
+
+    async def run(self):
+        """
+        Runs all rounds of the crawl.
+        """
+        self.global_semaphore = asyncio.Semaphore(self.max_concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency, limit_per_host=self.per_host)
+        heartbeat = Heartbeat(self.scheduler)
+        heartbeat.start()
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            try:
+                if self.schedule == 'single':
+                    await self.run_round(session, None)
+                else:
+                    for round_num in range(self.max_round + 1):
+                        await self.run_round(session, round_num)
+            finally:
+                heartbeat.stop()
+                await asyncio.to_thread(self.scheduler.release_all)
+                await asyncio.to_thread(close_writers, self.collections)
+
+def run_async_crawl(config, collections, token_pool, worker_id, global_duration, max_round,
+                    max_concurrency=200, per_host=2, schedule='rounds', claim_batch=1, lease_seconds=300,
+                    cursor_interval=10, sort_field='statuses'):
+    """
+    Runs the asyncio engine until every round is finished.
+
+    Args:
+        config (Config): Configuration object.
+        collections (dict): MongoDB collections ('livefeeds', 'error_log', 'instances').
+        token_pool (TokenPool): Pool of API tokens.
+        worker_id (int): ID of the worker.
+        global_duration (dict): Dictionary containing 'start_time' and 'end_time'.
+        max_round (int): The maximum number of rounds.
+        max_concurrency (int, optional): Maximum number of requests in flight. Defaults to 200.
+        per_host (int, optional): Maximum number of requests in flight per instance. Defaults to 2.
+        schedule (str, optional): 'rounds' or 'single'. Defaults to 'rounds'.
+        claim_batch (int, optional): Number of instances claimed at once. Defaults to 1.
+        lease_seconds (int, optional): Seconds without heartbeat after which a claimed instance is requeued.
+            Defaults to 300.
+        cursor_interval (int, optional): Save the cursor every this many pages. Defaults to 10.
+        sort_field (str, optional): Field the instances are claimed by, largest first. Defaults to 'statuses'.
+    """
+    crawler = AsyncCrawler(config, collections, token_pool, worker_id, global_duration, max_round,
+                           max_concurrency=max_concurrency, per_host=per_host, schedule=schedule,
+                           claim_batch=claim_batch, lease_seconds=lease_seconds, cursor_interval=cursor_interval,
+                           sort_field=sort_field)
+    asyncio.run(crawler.run())
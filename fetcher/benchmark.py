@@ -0,0 +1,266 @@
+# fetcher/benchmark.py
+import time
+import asyncio
+import argparse
+import threading
+import logging
+from collections import Counter
+from multiprocessing import Process, Manager
+from pymongo import MongoClient
+from config import Config
+from utils import compute_round_time, create_unique_index
+from token_pool import create_token_pool
+from scheduler import ensure_instance_indexes
+from task_queue import ensure_status_indexes
+from mock_server import MockMastodon
+import livefeeds_worker
+import reblog_favourite
+
+logger = logging.getLogger(__name__)
+
+DB_OPERATIONS = {'insert_one', 'insert_many', 'update_one', 'update_many', 'bulk_write', 'find', 'find_one',
+                 'find_one_and_update', 'count_documents', 'replace_one', 'delete_one', 'delete_many'}
+COLLECTIONS = ['instances', 'livefeeds', 'error_log', 'boostersfavourites', 'accounts', 'engagement_checkpoints',
+               'dead_letters']
+
+class CountingCollection:
+    """
+    Proxy of a MongoDB collection that counts the database operations made through it.
+    """
+    def __init__(self, collection, counter):
+        self._collection = collection
+        self._counter = counter
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if name in DB_OPERATIONS:
+            def counted(*args, **kwargs):
+                self._counter[name] += 1
+                return attribute(*args, **kwargs)
+            return counted
+        return attribute
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def run_worker(target, mongo_uri, db_name, db_ops, args, kwargs=None):
+    """
+    Runs one benchmark worker process with its own MongoDB client, as the workers of livefeeds_worker
+    and reblog_favourite do, and adds the database operations it made to the shared counts.
+
+    Args:
+        target (callable): process_task_single of livefeeds_worker or process_task of reblog_favourite.
+        mongo_uri (str): MongoDB URI.
+        db_name (str): Name of the benchmark database.
+        db_ops (dict-like): Shared counts of database operations by name.
+        args (tuple): Arguments of the target after the worker ID and the configuration, with the
+            collections first.
+        kwargs (dict, optional): Keyword arguments of the target.
+    """
+    counter = Counter()
+    client = MongoClient(mongo_uri)
+    db = client[db_name]
+    collections = {name: CountingCollection(db[name], counter) for name in COLLECTIONS}
+    try:
+        target(0, args[0], collections, *args[1:], **(kwargs or {}))
+    finally:
+        for name, count in counter.items():
+            db_ops[name] = db_ops.get(name, 0) + count
+        client.close()
+
+def run_async_crawl_worker(worker_id, config, collections, token_pool, global_duration, max_round, **kwargs):
+    from async_crawler import run_async_crawl
+    run_async_crawl(config, collections, token_pool, worker_id, global_duration, max_round, **kwargs)
+
+class Benchmark:
+    """
+    Runs livefeeds_worker and reblog_favourite end to end against a MockMastodon server and
+    reports throughput, latency and database operations per toot.
+    Workers are separate processes with their own MongoDB clients and lease owners, so the benchmark
+    needs a real MongoDB server.
+    """
+    def __init__(self, server, mongo_uri, config, processnum=1, engine='process', concurrency=200,
+                 db_name='fedilive_benchmark'):
+        """
+        Args:
+            server (MockMastodon): The mock server, not started yet.
+            mongo_uri (str): URI of the MongoDB server holding the benchmark database.
+            config (Config): Configuration object.
+            processnum (int, optional): Number of worker processes. Defaults to 1.
+            engine (str, optional): 'process' or 'async' for the livefeeds phase. Defaults to 'process'.
+            concurrency (int, optional): Maximum requests in flight of the async engine. Defaults to 200.
+            db_name (str, optional): Name of the benchmark database. Defaults to 'fedilive_benchmark'.
+        """
+        self.server = server
+        self.mongo_uri = mongo_uri
+        self.db_name = db_name
+        self.config = config
+        self.processnum = processnum
+        self.engine = engine
+        self.concurrency = concurrency
+        self.client = MongoClient(mongo_uri)
+        self.raw = {name: self.client[db_name][name] for name in COLLECTIONS}
+        self.manager = Manager()
+        self.db_ops = self.manager.dict()
+        self.loop = asyncio.new_event_loop()
+        self.server_thread = None
+
+    def start_server(self):
+        started = threading.Event()
+
+        def serve():
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(self.server.start())
+            started.set()
+            self.loop.run_forever()
+
+        self.server_thread = threading.Thread(target=serve, daemon=True)
+        self.server_thread.start()
+        started.wait()
+
+    def stop_server(self):
+        asyncio.run_coroutine_threadsafe(self.server.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def prepare(self):
+        for collection in self.raw.values():
+            collection.delete_many({})
+        create_unique_index(self.raw['livefeeds'], 'sid')
+        reblog_favourite.ensure_engagement_indexes(self.raw['boostersfavourites'])
+        reblog_favourite.ensure_checkpoint_indexes(self.raw['engagement_checkpoints'])
+        ensure_instance_indexes(self.raw['instances'])
+        ensure_status_indexes(self.raw['livefeeds'])
+        self.raw['instances'].insert_many([
+            {"name": name, "processable": True, "round": -1, "statuses": len(instance.ids)}
+            for name, instance in zip(self.server.instance_names, self.server.instances.values())
+        ])
+
+    def measure(self, phase, run, count):
+        """
+        Runs a phase and returns its report.
+
+        Args:
+            phase (str): Name of the phase.
+            run (callable): Function running the phase.
+            count (callable): Function returning the number of items stored by the phase.
+
+        Returns:
+            dict: The report of the phase.
+        """
+        self.server.stats.clear()
+        self.server.latencies.clear()
+        self.db_ops.clear()
+        start = time.monotonic()
+        run()
+        elapsed = time.monotonic() - start
+        items = count()
+        db_ops = sum(self.db_ops.values())
+        requests = sum(self.server.stats.values())
+        return {
+            'phase': phase,
+            'seconds': elapsed,
+            'items': items,
+            'items_per_sec': items / elapsed if elapsed else 0.0,
+            'requests': requests,
+            'requests_per_sec': requests / elapsed if elapsed else 0.0,
+            'status_codes': dict(Counter({status: n for (_, status), n in self.server.stats.items()})),
+            'p50_ms': percentile(self.server.latencies, 0.5) * 1000,
+            'p99_ms': percentile(self.server.latencies, 0.99) * 1000,
+            'db_ops': db_ops,
+            'db_ops_per_item': db_ops / items if items else 0.0,
+        }
+
+    def start_workers(self, target, args, kwargs=None, processes=None):
+        workers = [
+            Process(target=run_worker, args=(target, self.mongo_uri, self.db_name, self.db_ops, args, kwargs))
+            for _ in range(processes or self.processnum)
+        ]
+        for worker in workers:
+            worker.start()
+        return workers
+
+    def run_livefeeds(self, token_pool, global_duration, max_round):
+        if self.engine == 'async':
+            workers = self.start_workers(run_async_crawl_worker, (self.config, token_pool, global_duration, max_round),
+                                         {'max_concurrency': self.concurrency, 'schedule': 'single'}, processes=1)
+        else:
+            workers = self.start_workers(livefeeds_worker.process_task_single,
+                                         (self.config, token_pool, global_duration, max_round))
+        for worker in workers:
+            worker.join()
+
+    def run_engagements(self, token_pool):
+        terminate_flag = self.manager.dict(terminate=False)
+        workers = self.start_workers(reblog_favourite.process_task, (self.config, token_pool, terminate_flag),
+                                     {'idle_sleep': 0.5})
+        while self.raw['livefeeds'].count_documents({"$or": [{"status": "pending"}, {"lease_id": {"$exists": True}}]}):
+            time.sleep(0.5)
+        terminate_flag['terminate'] = True
+        for worker in workers:
+            worker.join()
+
+    def run(self):
+        """
+        Runs both phases.
+
+        Returns:
+            list: Reports of the livefeeds and engagement phases.
+        """
+        self.prepare()
+        self.start_server()
+        try:
+            global_duration = {'start_time': self.server.window_start, 'end_time': self.server.window_end}
+            max_round = compute_round_time(global_duration)
+            token_pool = create_token_pool(['benchmark-token'], 'host', manager=self.manager)
+            reports = [
+                self.measure('livefeeds', lambda: self.run_livefeeds(token_pool, global_duration, max_round),
+                             lambda: self.raw['livefeeds'].count_documents({})),
+                self.measure('engagements', lambda: self.run_engagements(token_pool),
+                             lambda: self.raw['livefeeds'].count_documents({"status": "read"}))
+            ]
+        finally:
+            self.stop_server()
+            self.manager.shutdown()
+            self.client.close()
+        return reports
+
+def format_report(report):
+    return (f"[{report['phase']}] {report['items']} items in {report['seconds']:.1f}s: "
+            f"{report['items_per_sec']:.1f} items/s, {report['requests']} requests ({report['requests_per_sec']:.1f}/s, "
+            f"codes {report['status_codes']}), latency p50 {report['p50_ms']:.1f} ms p99 {report['p99_ms']:.1f} ms, "
+            f"{report['db_ops_per_item']:.2f} DB ops per item")
+
+def main():
+    """
+    Main function to run the benchmark.
+    """
+    parser = argparse.ArgumentParser(description='FediLive Throughput Benchmark')
+    parser.add_argument('--instances', type=int, default=10, help='Number of mock instances')
+    parser.add_argument('--toots', type=int, default=2000, help='Statuses per instance')
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.01, help='Maximum random seconds added to the latency')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Probability that a request starts a 429/503 burst')
+    parser.add_argument('--ratelimit', type=int, default=100000, help='Requests per token and 5 minutes')
+    parser.add_argument('--processnum', type=int, default=4, help='Number of worker processes')
+    parser.add_argument('--engine', type=str, default='process', choices=['process', 'async'], help='Crawl engine of the livefeeds phase')
+    parser.add_argument('--concurrency', type=int, default=200, help='Maximum requests in flight (async engine)')
+    parser.add_argument('--mongo', type=str, required=True, help='URI of the MongoDB server holding the benchmark database')
+    parser.add_argument('--base_port', type=int, default=18000, help='Port of the first mock instance')
+    parser.add_argument('--log_level', type=str, default='WARNING', help='Log level during the benchmark')
+    args = parser.parse_args()
+
+    config = Config()
+    logging.getLogger().setLevel(args.log_level.upper())
+    config.api = dict(config.api, scheme='http')
+    server = MockMastodon(instances=args.instances, toots=args.toots, latency=args.latency, jitter=args.jitter,
+                          error_rate=args.error_rate, ratelimit=args.ratelimit, base_port=args.base_port)
+    benchmark = Benchmark(server, args.mongo, config, processnum=args.processnum, engine=args.engine,
+                          concurrency=args.concurrency)
+    for report in benchmark.run():
+        print(format_report(report))
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,61 @@
 # fetcher/config.py
 import yaml
 import os
+import time
+import atexit
+import threading
+import multiprocessing
 import logging
 import logging.config
+import logging.handlers
+
+_log_listener = None
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets at most burst records of one call site through per interval seconds. The number of records
+    dropped in the previous interval is appended to the next record of that call site.
+    Errors are never dropped.
+    """
+    def __init__(self, burst=20, interval=60):
+        """
+        Args:
+            burst (int, optional): Records per call site and interval. Defaults to 20.
+            interval (float, optional): Length of an interval in seconds. Defaults to 60.
+        """
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.sites = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            start, count, suppressed = self.sites.get(key, (now, 0, 0))
+            if now - start >= self.interval:
+                start, count = now, 0
+            count += 1
+            if count > self.burst:
+                self.sites[key] = (start, count, suppressed + 1)
+                return False
+            self.sites[key] = (start, count, 0)
+        if suppressed:
+            record.msg = f"{record.getMessage()} ({suppressed} similar messages suppressed)"
+            record.args = None
+        return True
+
+def stop_logging():
+    """
+    Writes the queued log records and stops the background logging thread.
+    """
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
 
 class Config:
     """
@@ -20,25 +73,52 @@ class Config:
         self.api = self.config.get('api', {})
         self.paths = self.config.get('paths', {})
         self.logging = self.config.get('logging', {})
+        self.writer = self.config.get('writer', {})
+        self.engagement = self.config.get('engagement', {})
+        self.storage = self.config.get('storage', {})
+        self.metrics = self.config.get('metrics', {})
+        self.merge = self.config.get('merge', {})
+        self.adaptive = self.config.get('adaptive', {})
+        self.sharding = self.config.get('sharding', {})
+        self.retry = self.config.get('retry', {})
         
         self.setup_logging()
     
     def setup_logging(self):
         """
         Sets up logging based on the configuration.
+        Records are put on a queue and written to the log file and the console by a background
+        thread, so the workers never block on log I/O. Worker processes forked after this call
+        log through the same queue. Repeated messages from one call site are rate limited, and
+        'modules' sets the level of individual loggers.
         """
+        global _log_listener
+        if _log_listener is not None:
+            return
         log_level = self.logging.get('level', 'INFO')
         log_file = self.logging.get('file', 'logs/app.log')
         os.makedirs(os.path.dirname(log_file), exist_ok=True)
         
-        logging.basicConfig(
-            level=getattr(logging, log_level.upper(), logging.INFO),
-            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-            handlers=[
-                logging.FileHandler(log_file),
-                logging.StreamHandler()
-            ]
-        )
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        handlers = [logging.FileHandler(log_file), logging.StreamHandler()]
+        for handler in handlers:
+            handler.setFormatter(formatter)
+        
+        log_queue = multiprocessing.Queue(-1)
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        rate_limit = self.logging.get('rate_limit', {})
+        if rate_limit.get('burst', 0) > 0:
+            queue_handler.addFilter(RateLimitFilter(rate_limit['burst'], rate_limit.get('interval', 60)))
+        
+        root = logging.getLogger()
+        root.setLevel(getattr(logging, log_level.upper(), logging.INFO))
+        root.handlers = [queue_handler]
+        for name, level in self.logging.get('modules', {}).items():
+            logging.getLogger(name).setLevel(getattr(logging, str(level).upper(), logging.INFO))
+        
+        _log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _log_listener.start()
+        atexit.register(stop_logging)
     
     def get_central_mongodb_uri(self):
         """
@@ -66,6 +146,22 @@ class Config:
         port = self.mongodb_local.get('port', 27017)
         return f"mongodb://{username}:{password}@{host}:{port}"
     
+    def get_merge_hosts(self):
+        """
+        Constructs the MongoDB URIs of the hosts whose local databases are merged.
+        
+        Returns:
+            list: (name, URI) of every host under 'merge.hosts'.
+        """
+        hosts = []
+        for host in self.merge.get('hosts', []):
+            username = host.get('username')
+            password = host.get('password')
+            address = host.get('host', 'localhost')
+            port = host.get('port', 27017)
+            hosts.append((host.get('name', f"{address}:{port}"), f"mongodb://{username}:{password}@{address}:{port}"))
+        return hosts
+    
     def get_api_token(self, worker_id):
         """
         Retrieves the API token for a given worker ID.
@@ -4,16 +4,21 @@ import time
 import argparse
 from datetime import datetime, timedelta
 from pymongo import MongoClient
-from pymongo.errors import DuplicateKeyError
-from multiprocessing import Process
-import random
-import re
+from multiprocessing import Process, Manager
 import logging
 from utils import (
-    create_unique_index, judge_sleep, save_error_log,
-    transform_ISO2datetime, transform_str2datetime, compute_round_time
+    create_unique_index, save_error_log,
+    transform_ISO2datetime, transform_str2datetime, compute_round_time, parse_next_max_id,
+    compute_seek_bounds, is_snowflake_status, instance_url
 )
 from config import Config
+from writer import close_writers
+from storage import create_storage
+from token_pool import create_token_pool
+from scheduler import InstanceScheduler, Heartbeat, ensure_instance_indexes, plan_instance_costs, record_crawl_stats
+from shards import ensure_shard_indexes, plan_shards, complete_shard, unshard_instance
+from retry import crawl_error, create_retry_policy, ensure_dead_letter_indexes
+from metrics import metrics, record_request, start_reporter, start_http_server
 
 logger = logging.getLogger(__name__)
 
@@ -36,170 +41,556 @@ def compute_current_duration(current_round, global_duration, max_round):
     new_end_time = global_duration['end_time'] - timedelta(hours=current_round - 1)
     return {'start_time': new_start_time, 'end_time': new_end_time}
 
-def fetch_instance(round_num, instances_collection, max_round):
+def save_instance_cursor(instances_collection, instance_name, cursor, round_num=0):
     """
-    Fetches an instance from the MongoDB collection based on the round number.
+    Saves the pagination cursor of an instance so a crashed crawl can be resumed.
     
     Args:
-        round_num (int): The current round number.
         instances_collection (pymongo.collection.Collection): The instances collection.
+        instance_name (str): Name of the instance.
+        cursor (str): 'max_id' of the next page.
+        round_num (int, optional): The round the cursor belongs to. Defaults to 0.
+    """
+    instances_collection.update_one({"name": instance_name}, {"$set": {"cursor": cursor, "cursor_round": round_num}})
+
+def resume_cursor(instance_info):
+    """
+    Returns the saved cursor of an instance if it belongs to the round being crawled.
+    
+    Args:
+        instance_info (dict): Information about the instance.
+    
+    Returns:
+        str or int: 'max_id' of the next page, or -1 to start from the first page.
+    """
+    if 'cursor' not in instance_info or instance_info.get('cursor_round', instance_info['round']) != instance_info['round']:
+        return -1
+    logger.info(f"Resuming {instance_info['name']} from cursor {instance_info['cursor']}.")
+    return instance_info['cursor']
+
+def mark_instance_done(instances_collection, instance_name, max_round):
+    """
+    Marks an instance as done after a single-pass crawl.
+    
+    Args:
+        instances_collection (pymongo.collection.Collection): The instances collection.
+        instance_name (str): Name of the instance.
+        max_round (int): The maximum number of rounds.
+    """
+    instances_collection.update_one(
+        {"name": instance_name},
+        {"$set": {"round": max_round, "crawl_state": "done"}, "$unset": {"cursor": "", "cursor_round": ""}}
+    )
+
+def finish_instance(instances_collection, instance_name, max_round, processable=True):
+    """
+    Marks an instance as finished for all remaining rounds.
+    
+    Args:
+        instances_collection (pymongo.collection.Collection): The instances collection.
+        instance_name (str): Name of the instance.
         max_round (int): The maximum number of rounds.
+        processable (bool, optional): Whether the instance stays processable. Defaults to True.
+    """
+    update = {"round": max_round}
+    if not processable:
+        update["processable"] = False
+    instances_collection.update_one({"name": instance_name}, {"$set": update})
+
+def prepare_livefeed(item, instance_name):
+    """
+    Adds the crawl metadata to a status before it is stored.
+    
+    Args:
+        item (dict): Status returned by the Mastodon API.
+        instance_name (str): Name of the instance the status was fetched from.
     
     Returns:
-        dict or None: The instance information or None if not found.
+        dict: The status with 'instance_name', 'sid', 'loadtime' and 'status' set.
+    """
+    item['instance_name'] = instance_name
+    item['sid'] = f"{instance_name}#{item['id']}"
+    item['loadtime'] = datetime.now()
+    item['status'] = 'pending'
+    return item
+
+def save_livefeed(item, instance_name, local_collections):
     """
-    if round_num < 0:
-        query = {
-            "round": round_num,
-            "processable": True
-        }
+    Queues a single status for the local livefeeds collection.
+    Duplicates are counted by the BufferedWriter when the batch is flushed.
+    
+    Args:
+        item (dict): Status returned by the Mastodon API.
+        instance_name (str): Name of the instance the status was fetched from.
+        local_collections (dict): Local MongoDB collections, with 'livefeeds' as a BufferedWriter.
+    
+    Returns:
+        bool: True if the status was queued, False if the seen filter already knows it.
+    """
+    seen = local_collections.get('seen')
+    if seen:
+        if seen.seen(instance_name, item['id']):
+            metrics.inc('statuses_known_total')
+            return False
+        seen.add(instance_name, item['id'])
+    prepare_livefeed(item, instance_name)
+    local_collections['livefeeds'].write(item)
+    logger.debug(f"Saved a tweet from {instance_name}.")
+    return True
+
+def page_known(data, saved, instance_name, local_collections, global_duration):
+    """
+    Checks whether a page only held known statuses and the stored statuses reach back to the start
+    of the window, in which case the rest of the window was stored by an earlier crawl.
+    
+    Args:
+        data (list): Statuses of the page.
+        saved (int): Number of statuses of the page that were queued.
+        instance_name (str): Name of the instance.
+        local_collections (dict): Local MongoDB collections, with the SeenFilter as 'seen'.
+        global_duration (dict): Dictionary containing 'start_time' and 'end_time'.
+    
+    Returns:
+        bool: True if paging can stop.
+    """
+    seen = local_collections.get('seen')
+    if not seen or saved or not data or not is_snowflake_status(data[-1]):
+        return False
+    return seen.covers(instance_name, int(compute_seek_bounds(global_duration)['since_id']))
+
+def forget_instance(local_collections, instance_name):
+    """
+    Drops the known statuses of an instance from the seen filter once its crawl is over.
+    
+    Args:
+        local_collections (dict): Local MongoDB collections, with the SeenFilter as 'seen'.
+        instance_name (str): Name of the instance.
+    """
+    if local_collections.get('seen'):
+        local_collections['seen'].forget(instance_name)
+
+def save_livefeeds_page(data, instance_info, local_collections, global_duration, max_round, id_range, stats=None):
+    """
+    Saves the statuses of one timeline page that fall into the crawl window.
+    With a seen filter, known statuses are skipped and paging stops at the first page that only
+    holds known statuses if the stored statuses reach back to the start of the window. The crawl
+    then only covered part of the window, so its stats are marked 'partial'.
+    
+    Args:
+        data (list): Statuses returned by the timeline endpoint.
+        instance_info (dict): Information about the instance.
+        local_collections (dict): Local MongoDB collections.
+        global_duration (dict): Dictionary containing 'start_time' and 'end_time'.
+        max_round (int): The maximum number of rounds.
+        id_range (dict): ID range of the statuses saved so far, updated in place.
+        stats (dict, optional): Crawl stats, marked 'partial' if paging stops early.
+    
+    Returns:
+        bool: True if the end of the window was reached and paging should stop.
+    """
+    instance_name = instance_info['name']
+    current_round = instance_info['round']
+    saved = 0
+    if current_round == 0:
+        for item in data:
+            created_at = transform_ISO2datetime(item['created_at'])
+            if global_duration['start_time'] <= created_at <= global_duration['end_time']:
+                id_range['max'] = item['id']
+                id_range['min'] = item['id']
+                saved += save_livefeed(item, instance_name, local_collections)
+            elif created_at < global_duration['start_time']:
+                logger.info(f"{instance_name} has no tweets in the specified duration.")
+                finish_instance(local_collections['instances'], instance_name, max_round, processable=False)
+                return True
     else:
-        query = {
-            "round": round_num,
-            "processable": True,
-            f"round{round_num}_id_range": {"$exists": True}
-        }
-    return instances_collection.find_one_and_update(
-        query,
-        {"$set": {"round": round_num + 1}},
-        return_document=True,
-        sort=[("statuses", -1)]
-    )
+        current_duration = compute_current_duration(current_round, global_duration, max_round)
+        for item in data:
+            created_at = transform_ISO2datetime(item['created_at'])
+            if current_duration['start_time'] <= created_at <= current_duration['end_time']:
+                saved += save_livefeed(item, instance_name, local_collections)
+            else:
+                finish_instance(local_collections['instances'], instance_name, max_round)
+                return True
+    if page_known(data, saved, instance_name, local_collections, global_duration):
+        logger.info(f"The rest of the window of {instance_name} is already stored.")
+        if stats is not None:
+            stats['partial'] = True
+        finish_instance(local_collections['instances'], instance_name, max_round)
+        return True
+    return False
 
-def fetch_livefeeds(instance_info, config, local_collections, tokens, worker_id, global_duration, max_round):
+def build_livefeeds_params(current_round, last_page_flag, id_range, seek_bounds=None):
+    """
+    Builds the query parameters for the next public timeline request.
+    
+    Args:
+        current_round (int): The current round number.
+        last_page_flag (str or int): 'max_id' of the next page, or -1 for the first page.
+        id_range (dict): ID range of the previous round.
+        seek_bounds (dict, optional): Snowflake 'max_id' and 'since_id' of the window.
+    
+    Returns:
+        dict: Query parameters for the timeline endpoint.
+    """
+    params = {
+        "local": True,
+        "limit": 40
+    }
+    if last_page_flag != -1:
+        params['max_id'] = last_page_flag
+    elif current_round != 0:
+        params['max_id'] = id_range.get('min')
+    elif seek_bounds:
+        params['max_id'] = seek_bounds['max_id']
+    if seek_bounds:
+        params['since_id'] = seek_bounds['since_id']
+    return params
+
+def get_seek_bounds(instance_info, global_duration):
+    """
+    Returns the snowflake bounds used to jump straight to the window, if the instance supports them.
+    
+    Args:
+        instance_info (dict): Information about the instance.
+        global_duration (dict): Dictionary containing 'start_time' and 'end_time'.
+    
+    Returns:
+        dict or None: Seek bounds, or None to scan from the newest status.
+    """
+    if instance_info['round'] != 0 or not instance_info.get('snowflake', True):
+        return None
+    return compute_seek_bounds(global_duration)
+
+def check_seek_page(data, instances_collection, instance_name):
+    """
+    Checks the first page fetched with seek bounds.
+    
+    Args:
+        data (list): Statuses of the first page.
+        instances_collection (pymongo.collection.Collection): The instances collection.
+        instance_name (str): Name of the instance.
+    
+    Returns:
+        str: 'seek' if the instance uses snowflake IDs, 'scan' if it does not and the caller should
+            fall back to scanning, 'verify' if the page was empty and the caller should check the newest
+            page with confirm_empty_window.
+    """
+    if not data:
+        return 'verify'
+    if is_snowflake_status(data[0]):
+        return 'seek'
+    logger.info(f"{instance_name} does not use snowflake IDs, falling back to scanning.")
+    instances_collection.update_one({"name": instance_name}, {"$set": {"snowflake": False}})
+    return 'scan'
+
+def confirm_empty_window(data, instance_name, local_collections, max_round):
+    """
+    Finishes an instance whose seek page was empty if its newest page shows that it uses snowflake IDs.
+    
+    Args:
+        data (list): Statuses of the newest page.
+        instance_name (str): Name of the instance.
+        local_collections (dict): Local MongoDB collections.
+        max_round (int): The maximum number of rounds.
+    
+    Returns:
+        bool: True if the window is empty and the instance was finished, False to keep scanning.
+    """
+    if data and is_snowflake_status(data[0]):
+        logger.info(f"{instance_name} has no tweets in the specified duration.")
+        finish_instance(local_collections['instances'], instance_name, max_round, processable=False)
+        return True
+    if data:
+        local_collections['instances'].update_one({"name": instance_name}, {"$set": {"snowflake": False}})
+    return False
+
+def window_hours(global_duration):
+    """
+    Returns the length of the crawl window in hours.
+
+    Args:
+        global_duration (dict): Dictionary containing 'start_time' and 'end_time'.
+
+    Returns:
+        float: Hours.
+    """
+    return (global_duration['end_time'] - global_duration['start_time']).total_seconds() / 3600
+
+# Failed requests of a timeline page that are sent again before the crawl gives up.
+MAX_PAGE_RETRIES = 4
+
+def check_response(instance_name, code, token, retries, message=None):
+    """
+    Decides what happens after a timeline request that did not return 200. Shared by the thread and
+    asyncio engines so both retry the same way. A rejected token is replaced by the next lease; 429 and
+    503 responses and timeouts are sent again up to MAX_PAGE_RETRIES times, after the wait the token
+    pool imposes on the next lease once it has seen the response; any other response is final.
+    
+    Args:
+        instance_name (str): Name of the instance.
+        code (int or str): HTTP status code or 'timeout'.
+        token (str or None): The token the request was sent with.
+        retries (int): Retries of the page so far.
+        message (str, optional): Response body.
+    
+    Returns:
+        tuple: The retries of the page so far and None to send the request again, or the error from
+            retry.crawl_error to give up.
+    """
+    if code == 401 and token:
+        logger.warning(f"Token rejected by {instance_name}, retrying with another token...")
+        return retries, None
+    if code in (429, 503, 'timeout'):
+        retries += 1
+        if code == 'timeout':
+            logger.warning("Request timed out, retrying...")
+        else:
+            metrics.inc('retries_total', code=code)
+            logger.warning("Encountered 429 or 503 error, retrying...")
+        return retries, crawl_error(code, message) if retries > MAX_PAGE_RETRIES else None
+    logger.error(f"Error fetching tweets from {instance_name}: {code}")
+    return retries, crawl_error(code, message)
+
+def fetch_timeline_page(url, instance_name, params, token_pool, timeout=5):
+    """
+    Requests one page of a timeline with a leased token and retries it as decided by check_response.
+    
+    Args:
+        url (str): Request URL.
+        instance_name (str): Name of the instance.
+        params (dict): Query parameters.
+        token_pool (TokenPool): Pool of API tokens shared by all processes.
+        timeout (int, optional): Request timeout in seconds. Defaults to 5.
+    
+    Returns:
+        tuple: The decoded statuses, the lower-cased response headers and None, or None, None and the
+            error from retry.crawl_error if the page could not be fetched.
+    """
+    retries = 0
+    while True:
+        logger.debug(f"Request parameters: {params}")
+        token, wait_time = token_pool.lease(instance_name)
+        if wait_time > 0:
+            metrics.inc('ratelimit_sleep_seconds_total', wait_time)
+            time.sleep(wait_time)
+        request_start = time.monotonic()
+        try:
+            response = requests.get(url, headers=token_pool.headers(token), params=params, timeout=timeout)
+        except requests.exceptions.Timeout:
+            record_request('timeout', time.monotonic() - request_start, 'timeline')
+            token_pool.report_timeout(instance_name)
+            retries, error = check_response(instance_name, 'timeout', token, retries)
+        else:
+            latency = time.monotonic() - request_start
+            record_request(response.status_code, latency, 'timeline')
+            res_headers = {k.lower(): v for k, v in response.headers.items()}
+            token_pool.report(instance_name, token, response.status_code, res_headers, latency)
+            if response.status_code == 200:
+                data = response.json()
+                logger.debug(f"Successfully fetched {len(data)} tweets.")
+                return data, res_headers, None
+            retries, error = check_response(instance_name, response.status_code, token, retries, response.text)
+        if error:
+            return None, None, error
+
+def fetch_livefeeds(instance_info, config, local_collections, token_pool, worker_id, global_duration, max_round, cursor_interval=0,
+                    stats=None):
     """
     Fetches livefeeds (tweets) from a specific Mastodon instance.
+    Paging resumes from the instance's saved 'cursor' if it was saved in the current round.
+    Every request leases the token with the most rate limit budget left on the instance.
     
     Args:
         instance_info (dict): Information about the instance.
         config (Config): Configuration object.
         local_collections (dict): Local MongoDB collections.
-        tokens (list): List of API tokens.
+        token_pool (TokenPool): Pool of API tokens shared by all processes.
         worker_id (int): ID of the worker.
         global_duration (dict): Dictionary containing 'start_time' and 'end_time'.
         max_round (int): The maximum number of rounds.
+        cursor_interval (int, optional): Save the cursor every this many pages, 0 to never save it. Defaults to 0.
+        stats (dict, optional): Counts of the 'pages' and 'statuses' fetched in the window and whether the crawl
+            'resumed' from a cursor or stopped early as 'partial', updated in place.
+    
+    Returns:
+        dict or None: None if the instance was crawled, otherwise the error from retry.crawl_error. The
+            instance is left to the caller, which schedules a retry.
     """
     instance_name = instance_info['name']
     current_round = instance_info['round']
     logger.info(f"Starting to fetch tweets from {instance_name}")
-    livefeeds_url = f"https://{instance_name}/api/v1/timelines/public"
-    last_page_flag = -1
-    retry_time = 0
+    livefeeds_url = instance_url(instance_name, "/api/v1/timelines/public", config.api.get('scheme', 'https'))
+    last_page_flag = resume_cursor(instance_info)
+    if stats is not None:
+        stats['resumed'] = last_page_flag != -1
     id_range = {}
     if current_round != 0:
         id_range = instance_info.get(f'round{current_round-1}_id_range', {})
     r_in_nowround = -1
-    token = tokens[worker_id % len(tokens)]
-    headers = {'Authorization': f'Bearer {token}', 'Email': config.api.get('email', '')}
+    seek_bounds = get_seek_bounds(instance_info, global_duration)
+    verify_seek = False
     
     while True:
         r_in_nowround += 1
-        params = {
-            "local": True,
-            "limit": 40
-        }
-        if last_page_flag != -1:
-            params['max_id'] = last_page_flag
-        elif current_round != 0:
-            params['max_id'] = id_range.get('min')
+        params = build_livefeeds_params(current_round, last_page_flag, id_range, seek_bounds)
         
         try:
-            logger.debug(f"Request parameters: {params}")
-            response = requests.get(livefeeds_url, headers=headers, params=params, timeout=5)
-            if response.status_code == 200:
-                res_headers = {k.lower(): v for k, v in response.headers.items()}
-                judge_sleep(res_headers, instance_name)
-                data = response.json()
-                logger.info(f"Successfully fetched {len(data)} tweets.")
-                
-                if current_round == 0:
-                    for item in data:
-                        created_at = transform_ISO2datetime(item['created_at'])
-                        if global_duration['start_time'] <= created_at <= global_duration['end_time']:
-                            id_range['max'] = item['id']
-                            id_range['min'] = item['id']
-                            item['instance_name'] = instance_name
-                            item['sid'] = f"{instance_name}#{item['id']}"
-                            item['loadtime'] = datetime.now()
-                            item['status'] = 'pending'
-                            try:
-                                local_collections['livefeeds'].insert_one(item)
-                                logger.info(f"Saved a tweet from {instance_name}.")
-                            except DuplicateKeyError:
-                                logger.warning("Duplicate tweet found, skipping.")
-                            except Exception as e:
-                                logger.error(f"Error saving tweet: {e}")
-                        elif created_at < global_duration['start_time']:
-                            logger.info(f"{instance_name} has no tweets in the specified duration.")
-                            local_collections['instances'].update_one(
-                                {"name": instance_name},
-                                {"$set": {"round": max_round, "processable": False}}
-                            )
-                            return
-                else:
-                    current_duration = compute_current_duration(current_round, global_duration, max_round)
-                    for item in data:
-                        created_at = transform_ISO2datetime(item['created_at'])
-                        if current_duration['start_time'] <= created_at <= current_duration['end_time']:
-                            item['instance_name'] = instance_name
-                            item['sid'] = f"{instance_name}#{item['id']}"
-                            item['loadtime'] = datetime.now()
-                            item['status'] = 'pending'
-                            try:
-                                local_collections['livefeeds'].insert_one(item)
-                                logger.info(f"Saved a tweet from {instance_name}.")
-                            except DuplicateKeyError:
-                                logger.warning("Duplicate tweet found, skipping.")
-                            except Exception as e:
-                                logger.error(f"Error saving tweet: {e}")
-                        else:
-                            local_collections['instances'].update_one(
-                                {"name": instance_name},
-                                {"$set": {"round": max_round}}
-                            )
-                            return
-                
-                if 'link' not in res_headers or len(data) < 40:
-                    return
-                match = re.search(r'max_id=(\d+)', res_headers.get('link', ''))
-                if match:
-                    last_page_flag = match.group(1)
-            elif response.status_code in [503, 429]:
-                retry_time += 1
-                time.sleep(random.random())
-                logger.warning("Encountered 429 or 503 error, retrying...")
-                if retry_time > 4:
-                    local_collections['instances'].update_one(
-                        {"name": instance_name},
-                        {"$set": {"processable": False, "round": max_round}}
-                    )
+            data, res_headers, error = fetch_timeline_page(livefeeds_url, instance_name, params, token_pool)
+            if error:
+                return error
+            
+            if seek_bounds and last_page_flag == -1:
+                seek_state = check_seek_page(data, local_collections['instances'], instance_name)
+                if seek_state != 'seek':
+                    seek_bounds = None
+                    verify_seek = seek_state == 'verify'
+                    continue
+            elif verify_seek:
+                verify_seek = False
+                if confirm_empty_window(data, instance_name, local_collections, max_round):
                     return
-            else:
-                logger.error(f"Error fetching tweets from {instance_name}: {response.status_code}")
-                local_collections['instances'].update_one(
-                    {"name": instance_name},
-                    {"$set": {"round": max_round, "processable": False}}
-                )
+            
+            if stats is not None:
+                stats['pages'] = stats.get('pages', 0) + 1
+                stats['statuses'] = stats.get('statuses', 0) + len(data)
+            if save_livefeeds_page(data, instance_info, local_collections, global_duration, max_round, id_range, stats):
                 return
-        except requests.exceptions.Timeout:
-            retry_time += 1
-            time.sleep(0.1)
-            logger.warning("Request timed out, retrying...")
-            if retry_time > 4:
-                local_collections['instances'].update_one(
-                    {"name": instance_name},
-                    {"$set": {"processable": False, "round": max_round}}
-                )
+            
+            if 'link' not in res_headers or len(data) < 40:
                 return
+            next_max_id = parse_next_max_id(res_headers)
+            if next_max_id:
+                last_page_flag = next_max_id
+                if cursor_interval and (r_in_nowround + 1) % cursor_interval == 0:
+                    save_instance_cursor(local_collections['instances'], instance_name, last_page_flag, current_round)
+        except Exception as e:
+            logger.exception(f"Exception while connecting to {instance_name}")
+            return crawl_error('exception', repr(e))
+
+def fetch_shard(shard_info, config, local_collections, token_pool, cursor_interval=0, stats=None):
+    """
+    Fetches the livefeeds of one sub-window shard of an instance.
+    The shard seeks to its sub-window with snowflake ID bounds and pages down to its start, so the
+    shards of an instance can be crawled by different workers at the same time without overlap.
+    Paging resumes from the shard's saved 'cursor'.
+    
+    Args:
+        shard_info (dict): The claimed shard with 'name', 'start_time' and 'end_time'.
+        config (Config): Configuration object.
+        local_collections (dict): Local MongoDB collections and the central 'instance_shards' collection.
+        token_pool (TokenPool): Pool of API tokens shared by all processes.
+        cursor_interval (int, optional): Save the cursor every this many pages, 0 to never save it. Defaults to 0.
+        stats (dict, optional): Counts of the 'pages' and 'statuses' fetched and whether the crawl
+            'resumed' from a cursor, updated in place.
+    
+    Returns:
+        dict or None: None if the sub-window was crawled, otherwise the error from retry.crawl_error,
+            with the code 'not_snowflake' if the instance does not use snowflake IDs and cannot be sharded.
+    """
+    stats = stats if stats is not None else {}
+    instance_name = shard_info['name']
+    livefeeds_url = instance_url(instance_name, "/api/v1/timelines/public", config.api.get('scheme', 'https'))
+    seek_bounds = compute_seek_bounds(shard_info)
+    max_id = shard_info.get('cursor', seek_bounds['max_id'])
+    stats['resumed'] = 'cursor' in shard_info
+    checked = stats['resumed']
+    
+    while True:
+        params = {"local": True, "limit": 40, "max_id": max_id, "since_id": seek_bounds['since_id']}
+        try:
+            data, res_headers, error = fetch_timeline_page(livefeeds_url, instance_name, params, token_pool)
+            if error:
+                return error
+            if data and not checked:
+                checked = True
+                if not is_snowflake_status(data[0]):
+                    return crawl_error('not_snowflake')
+            stats['pages'] = stats.get('pages', 0) + 1
+            stats['statuses'] = stats.get('statuses', 0) + len(data)
+            for item in data:
+                save_livefeed(item, instance_name, local_collections)
+            next_max_id = parse_next_max_id(res_headers) if 'link' in res_headers else None
+            if len(data) < 40 or not next_max_id:
+                return None
+            max_id = next_max_id
+            if cursor_interval and stats['pages'] % cursor_interval == 0:
+                local_collections['instance_shards'].update_one({"_id": shard_info["_id"]}, {"$set": {"cursor": max_id}})
         except Exception as e:
             logger.exception(f"Exception while connecting to {instance_name}")
-            local_collections['instances'].update_one(
-                {"name": instance_name},
-                {"$set": {"round": max_round, "processable": False}}
-            )
-            return
+            return crawl_error('exception', repr(e))
 
-def process_task(worker_id, config, collections, tokens, global_duration, max_round):
+def retry_instance(scheduler, collections, instance_info, error):
+    """
+    Logs a failed crawl to the error log and schedules a retry of the instance or shard, or gives it up.
+    
+    Args:
+        scheduler (InstanceScheduler): Scheduler the instance or shard was claimed from.
+        collections (dict): Collections with 'error_log' as a Writer.
+        instance_info (dict): The claimed instance or shard.
+        error (dict): Error from retry.crawl_error.
+    
+    Returns:
+        bool: True if a retry was scheduled, False if the instance or shard was given up.
+    """
+    object_name = instance_info['_id'] if 'shard' in instance_info else instance_info['name']
+    save_error_log(collections['error_log'], "livefeeds", object_name, "Error", res_code=error['code'],
+                   error_message=error['message'])
+    return scheduler.retry(instance_info, error)
+
+def create_scheduler(collections, name, config, **kwargs):
+    """
+    Creates the scheduler of the instances or instance_shards collection with the 'retry' configuration.
+    
+    Args:
+        collections (dict): Collections with 'instances', optionally 'instance_shards' and 'dead_letters'.
+        name (str): 'instances' or 'instance_shards'.
+        config (Config): Configuration object.
+        **kwargs: Further arguments of InstanceScheduler.
+    
+    Returns:
+        InstanceScheduler: The scheduler.
+    """
+    return InstanceScheduler(collections[name], retry_policy=create_retry_policy(config.retry),
+                             dead_letters=collections.get('dead_letters'),
+                             kind='shard' if name == 'instance_shards' else 'instance', **kwargs)
+
+def crawl_shards(scheduler, config, collections, token_pool, max_round, cursor_interval=10, wait=False):
+    """
+    Claims and crawls shards until none are left.
+    
+    Args:
+        scheduler (InstanceScheduler): Scheduler of the instance_shards collection.
+        config (Config): Configuration object.
+        collections (dict): Local MongoDB collections and the central 'instances' and 'instance_shards' collections.
+        token_pool (TokenPool): Pool of API tokens shared by all processes.
+        max_round (int): The maximum number of rounds.
+        cursor_interval (int, optional): Save the cursor every this many pages. Defaults to 10.
+        wait (bool, optional): Keep polling while other workers hold shard leases. Defaults to False.
+    
+    Returns:
+        int: Number of instances given back to the single pass because they do not use snowflake IDs.
+    """
+    unsharded = 0
+    while True:
+        shard_info = scheduler.get(None, wait)
+        if not shard_info:
+            return unsharded
+        logger.info(f"Found shard {shard_info['shard'] + 1}/{shard_info['shards']} of {shard_info['name']}, starting processing.")
+        stats = {}
+        crawl_start = time.monotonic()
+        error = fetch_shard(shard_info, config, collections, token_pool, cursor_interval, stats)
+        forget_instance(collections, shard_info['name'])
+        if error and error['code'] == 'not_snowflake':
+            unshard_instance(collections['instance_shards'], collections['instances'], shard_info)
+            unsharded += 1
+        elif error and retry_instance(scheduler, collections, shard_info, error):
+            continue
+        complete_shard(collections['instance_shards'], collections['instances'], shard_info, stats,
+                       time.monotonic() - crawl_start, max_round, failed=error is not None)
+        scheduler.complete(shard_info)
+
+def process_task(worker_id, config, collections, token_pool, global_duration, max_round, claim_batch=1, lease_seconds=300,
+                 cursor_interval=10, sort_field='statuses', metrics_store=None):
     """
     Processes tasks by fetching instances and their tweets.
     
@@ -207,19 +598,111 @@ def process_task(worker_id, config, collections, tokens, global_duration, max_ro
         worker_id (int): The ID of the worker.
         config (Config): Configuration object.
         local_collections (dict): Local MongoDB collections.
-        tokens (list): List of API tokens.
+        token_pool (TokenPool): Pool of API tokens shared by all processes.
         global_duration (dict): Dictionary containing 'start_time' and 'end_time'.
         max_round (int): The maximum number of rounds.
+        claim_batch (int, optional): Number of instances claimed at once. Defaults to 1.
+        lease_seconds (int, optional): Seconds without heartbeat after which a claimed instance is requeued. Defaults to 300.
+        cursor_interval (int, optional): Save the cursor every this many pages. Defaults to 10.
+        sort_field (str, optional): Field the instances are claimed by, largest first. Defaults to 'statuses'.
+        metrics_store (dict-like, optional): Shared store the metrics of this process are published to.
     """
-    for round_num in range(max_round + 1):
+    collections = create_storage(collections, ['livefeeds', 'error_log'], config)
+    scheduler = create_scheduler(collections, 'instances', config, batch_size=claim_batch, lease_seconds=lease_seconds,
+                                 sort_field=sort_field)
+    heartbeat = Heartbeat(scheduler)
+    heartbeat.start()
+    reporter = start_reporter(config.metrics, metrics_store, summarize=False) if metrics_store is not None else None
+    try:
+        for round_num in range(max_round + 1):
+            while True:
+                instance_info = scheduler.get(round_num - 1)
+                if instance_info:
+                    logger.info(f"Found instance: {instance_info['name']}, starting processing.")
+                    error = fetch_livefeeds(instance_info, config, collections, token_pool, worker_id, global_duration,
+                                            max_round, cursor_interval)
+                    forget_instance(collections, instance_info['name'])
+                    if error:
+                        retry_instance(scheduler, collections, instance_info, error)
+                    else:
+                        scheduler.complete(instance_info)
+                else:
+                    logger.info(f"No more instances to process for round {round_num}.")
+                    break
+    finally:
+        heartbeat.stop()
+        scheduler.release_all()
+        close_writers(collections)
+        if reporter:
+            reporter.stop()
+
+def process_task_single(worker_id, config, collections, token_pool, global_duration, max_round,
+                        claim_batch=1, lease_seconds=300, cursor_interval=10, sort_field='statuses', metrics_store=None):
+    """
+    Processes tasks by walking each instance once from the end of the window to the start.
+    The pages, statuses and time of each crawl are recorded as 'crawl_stats' on the instance,
+    from which the cost of later crawls is estimated. With an 'instance_shards' collection, the
+    sub-window shards of large instances are crawled first, before and after the other instances.
+    Instances given back to the single pass by a shard after the other instances were crawled are
+    crawled by another single pass.
+    
+    Args:
+        worker_id (int): The ID of the worker.
+        config (Config): Configuration object.
+        collections (dict): Local MongoDB collections and the central instances and, optionally, instance_shards collections.
+        token_pool (TokenPool): Pool of API tokens shared by all processes.
+        global_duration (dict): Dictionary containing 'start_time' and 'end_time'.
+        max_round (int): The maximum number of rounds.
+        claim_batch (int, optional): Number of instances claimed at once. Defaults to 1.
+        lease_seconds (int, optional): Seconds without heartbeat after which a claimed instance is requeued. Defaults to 300.
+        cursor_interval (int, optional): Save the cursor every this many pages. Defaults to 10.
+        sort_field (str, optional): Field the instances are claimed by, largest first. Defaults to 'statuses'.
+        metrics_store (dict-like, optional): Shared store the metrics of this process are published to.
+    """
+    collections = create_storage(collections, ['livefeeds', 'error_log'], config)
+    scheduler = create_scheduler(collections, 'instances', config, batch_size=claim_batch, lease_seconds=lease_seconds,
+                                 sort_field=sort_field)
+    heartbeat = Heartbeat(scheduler)
+    heartbeat.start()
+    shard_scheduler = None
+    if 'instance_shards' in collections:
+        shard_scheduler = create_scheduler(collections, 'instance_shards', config, lease_seconds=lease_seconds, sort_field='cost')
+        shard_heartbeat = Heartbeat(shard_scheduler)
+        shard_heartbeat.start()
+    reporter = start_reporter(config.metrics, metrics_store, summarize=False) if metrics_store is not None else None
+    try:
+        if shard_scheduler:
+            crawl_shards(shard_scheduler, config, collections, token_pool, max_round, cursor_interval)
         while True:
-            instance_info = fetch_instance(round_num - 1, collections['instances'], max_round)
-            if instance_info:
-                logger.info(f"Found instance: {instance_info['name']}, starting processing.")
-                fetch_livefeeds(instance_info, config, collections, tokens, worker_id, global_duration, max_round)
-            else:
-                logger.info(f"No more instances to process for round {round_num}.")
+            instance_info = scheduler.get(None)
+            if not instance_info:
+                logger.info("No more instances to process.")
+                if shard_scheduler and crawl_shards(shard_scheduler, config, collections, token_pool, max_round,
+                                                    cursor_interval, wait=True):
+                    continue
                 break
+            logger.info(f"Found instance: {instance_info['name']}, starting processing.")
+            stats = {}
+            crawl_start = time.monotonic()
+            error = fetch_livefeeds(instance_info, config, collections, token_pool, worker_id, global_duration, max_round,
+                                    cursor_interval, stats)
+            forget_instance(collections, instance_info['name'])
+            if error:
+                retry_instance(scheduler, collections, instance_info, error)
+                continue
+            record_crawl_stats(collections['instances'], instance_info['name'], stats,
+                               time.monotonic() - crawl_start, window_hours(global_duration))
+            mark_instance_done(collections['instances'], instance_info['name'], max_round)
+            scheduler.complete(instance_info)
+    finally:
+        heartbeat.stop()
+        scheduler.release_all()
+        if shard_scheduler:
+            shard_heartbeat.stop()
+            shard_scheduler.release_all()
+        close_writers(collections)
+        if reporter:
+            reporter.stop()
 
 def main():
     """
@@ -228,11 +711,26 @@ def main():
     parser = argparse.ArgumentParser(description='Mastodon Livefeeds Worker')
     parser.add_argument('--id', type=int, required=True, help='Worker ID')
     parser.add_argument('--processnum', type=int, default=1, help='Number of parallel processes')
-    parser.add_argument('--start', type=str, required=True, help='Start time (YYYY-MM-DD HH:MM:SS)')
-    parser.add_argument('--end', type=str, required=True, help='End time (YYYY-MM-DD HH:MM:SS)')
+    parser.add_argument('--start', type=str, help='Start time (YYYY-MM-DD HH:MM:SS)')
+    parser.add_argument('--end', type=str, help='End time (YYYY-MM-DD HH:MM:SS), optional for the stream engine')
+    parser.add_argument('--schedule', type=str, default='rounds', choices=['rounds', 'single'], help='Hourly rounds or a single pass per instance')
+    parser.add_argument('--engine', type=str, default='process', choices=['process', 'async', 'stream'], help='Crawl engine')
+    parser.add_argument('--concurrency', type=int, default=200, help='Maximum requests in flight (async engine)')
+    parser.add_argument('--ratelimit', type=str, default='host', choices=['host', 'cluster'], help='Share rate limits between the processes of this host or all hosts')
+    parser.add_argument('--per_host', type=int, default=2, help='Maximum requests in flight per instance (async engine)')
+    parser.add_argument('--claim_batch', type=int, default=1, help='Number of instances each process claims at once')
+    parser.add_argument('--lease', type=int, default=300, help='Seconds without heartbeat after which a claimed instance is requeued')
+    parser.add_argument('--order', type=str, default='cost', choices=['cost', 'statuses'], help='Claim instances by estimated crawl cost or by total statuses, largest first')
+    parser.add_argument('--checkpoint', type=int, default=10, help='Save the pagination cursor of an instance every this many pages, 0 to disable')
+    parser.add_argument('--streams', type=int, default=500, help='Maximum instances followed by this host (stream engine)')
+    parser.add_argument('--poll_interval', type=int, default=60, help='Seconds between polls of instances without streaming (stream engine)')
+    parser.add_argument('--metrics_port', type=int, default=None, help='Port of the Prometheus metrics endpoint, 0 to disable (default from config)')
     args = parser.parse_args()
+    if args.engine != 'stream' and not (args.start and args.end):
+        parser.error('--start and --end are required unless --engine stream is used')
     
     config = Config()
+    metrics_port = args.metrics_port if args.metrics_port is not None else config.metrics.get('port', 0)
     central_mongodb_uri = config.get_central_mongodb_uri()
     client = MongoClient(central_mongodb_uri)
     db = client['mastodon']
@@ -243,12 +741,41 @@ def main():
     local_db = local_client['mastodon']
     local_livefeeds_collection = local_db['livefeeds']
     local_error_collection = local_db['error_log']
+    local_accounts_collection = local_db['accounts']
     
     create_unique_index(local_livefeeds_collection, 'sid')
+    if config.storage.get('compact', False):
+        create_unique_index(local_accounts_collection, 'aid')
+    ensure_instance_indexes(instances_collection)
+    ensure_dead_letter_indexes(db['dead_letters'])
     
     with open(config.paths.get('token_list', 'tokens/token_list.txt'), 'r', encoding='utf-8') as f:
         tokens = f.read().splitlines()
     
+    collections = {
+        'livefeeds': local_livefeeds_collection,
+        'error_log': local_error_collection,
+        'instances': instances_collection,
+        'accounts': local_accounts_collection,
+        'dead_letters': db['dead_letters']
+    }
+    
+    if args.engine == 'stream':
+        from streaming import run_streaming
+        token_pool = create_token_pool(tokens, args.ratelimit, email=config.api.get('email', ''),
+                                       central_db=db, adaptive=config.adaptive)
+        end_time = transform_str2datetime(args.end) if args.end else None
+        reporter = start_reporter(config.metrics)
+        if metrics_port:
+            start_http_server(metrics_port)
+        run_streaming(config, collections, token_pool, max_streams=args.streams,
+                      poll_interval=args.poll_interval, end_time=end_time, lease_seconds=args.lease)
+        reporter.stop()
+        client.close()
+        local_client.close()
+        logger.info("Livefeeds Worker task completed.")
+        return
+    
     global_duration = {
         'start_time': transform_str2datetime(args.start),
         'end_time': transform_str2datetime(args.end)
@@ -256,22 +783,50 @@ def main():
     
     max_round = compute_round_time(global_duration)
     logger.info(f"Maximum rounds: {max_round}")
+    token_count = len([t for t in tokens if t.strip()])
+    if args.order == 'cost':
+        plan_instance_costs(instances_collection, global_duration, tokens=token_count)
+    if args.engine == 'process' and args.schedule == 'single' and config.sharding.get('enabled', True):
+        shards_collection = db['instance_shards']
+        ensure_shard_indexes(shards_collection)
+        plan_shards(instances_collection, shards_collection, global_duration, max_round, config.sharding, tokens=token_count)
+        collections['instance_shards'] = shards_collection
     
-    collections = {
-        'livefeeds': local_livefeeds_collection,
-        'error_log': local_error_collection,
-        'instances': instances_collection
-    }
-    
-    process_list = []
-    for i in range(args.processnum):
-        p = Process(target=process_task, args=(args.id, config, collections, tokens, global_duration, max_round))
-        p.start()
-        process_list.append(p)
+    manager = Manager()
     
-    for p in process_list:
-        p.join()
+    if args.engine == 'async':
+        from async_crawler import run_async_crawl
+        token_pool = create_token_pool(tokens, args.ratelimit, email=config.api.get('email', ''),
+                                       central_db=db, adaptive=config.adaptive)
+        reporter = start_reporter(config.metrics)
+        if metrics_port:
+            start_http_server(metrics_port)
+        run_async_crawl(config, collections, token_pool, args.id, global_duration, max_round,
+                        max_concurrency=args.concurrency, per_host=args.per_host, schedule=args.schedule,
+                        claim_batch=args.claim_batch, lease_seconds=args.lease, cursor_interval=args.checkpoint,
+                        sort_field=args.order)
+        reporter.stop()
+    else:
+        token_pool = create_token_pool(tokens, args.ratelimit, email=config.api.get('email', ''),
+                                       manager=manager, central_db=db, adaptive=config.adaptive)
+        metrics_store = manager.dict()
+        reporter = start_reporter(config.metrics, metrics_store, aggregate=True)
+        if metrics_port:
+            start_http_server(metrics_port, metrics_store)
+        target = process_task_single if args.schedule == 'single' else process_task
+        process_list = []
+        for i in range(args.processnum):
+            p = Process(target=target, args=(args.id, config, collections, token_pool, global_duration, max_round,
+                                                  args.claim_batch, args.lease, args.checkpoint, args.order),
+                        kwargs={'metrics_store': metrics_store})
+            p.start()
+            process_list.append(p)
+        
+        for p in process_list:
+            p.join()
+        reporter.stop()
     
+    manager.shutdown()
     client.close()
     local_client.close()
     logger.info("Livefeeds Worker task completed.")
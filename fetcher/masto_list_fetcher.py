@@ -1,6 +1,7 @@
 # fetcher/masto_list_fetcher.py
 import requests
-from pymongo import MongoClient, errors
+import ijson
+from pymongo import MongoClient, UpdateOne
 from datetime import datetime
 import logging
 from utils import create_unique_index, save_error_log
@@ -8,10 +9,62 @@ from config import Config
 
 logger = logging.getLogger(__name__)
 
-def fetch_instances():
+# Fields owned by the crawl that a refresh must never overwrite.
+CRAWL_FIELDS = {'_id', 'name', 'loadtime', 'processable', 'round'}
+# Fields of instances.social that change between refreshes; known instances are refreshed when one of them changed.
+LISTED_FIELDS = ['users', 'statuses', 'connections', 'active_users', 'open_registrations', 'version',
+                 'up', 'dead', 'uptime', 'https_score', 'obs_score', 'checked_at', 'updated_at']
+
+def build_instance_upsert(item, existing, current_time):
+    """
+    Builds the upsert of one instance from the instances.social list.
+    New instances start unprocessed; for known instances only the LISTED_FIELDS that changed are set,
+    leaving the crawl state untouched.
+
+    Args:
+        item (dict): Instance returned by instances.social.
+        existing (dict or None): Stored fields of the instance, or None if it is new.
+        current_time (datetime): Time of the refresh.
+
+    Returns:
+        pymongo.UpdateOne or None: The upsert, or None if nothing changed.
+    """
+    item['statuses'] = int(item.get('statuses') or 0)
+    fields = {k: v for k, v in item.items() if k not in CRAWL_FIELDS}
+    if existing is None:
+        return UpdateOne(
+            {"name": item['name']},
+            {"$set": fields, "$setOnInsert": {"loadtime": current_time, "processable": True, "round": -1}},
+            upsert=True
+        )
+    changed = {k: fields[k] for k in LISTED_FIELDS if k in fields and existing.get(k) != fields[k]}
+    if not changed:
+        return None
+    changed['refreshed_at'] = current_time
+    return UpdateOne({"name": item['name']}, {"$set": changed})
+
+def load_listed_fields(instances_collection):
+    """
+    Loads the stored LISTED_FIELDS of every known instance, used to detect changes.
+
+    Args:
+        instances_collection (pymongo.collection.Collection): The instances collection.
+
+    Returns:
+        dict: Instance name to its stored fields.
+    """
+    projection = {"_id": 0, "name": 1, **{field: 1 for field in LISTED_FIELDS}}
+    return {doc['name']: doc for doc in instances_collection.find({}, projection)}
+
+def fetch_instances(batch_size=1000):
     """
     Fetches all Mastodon instances and stores their information in MongoDB.
+    The list is parsed while it is downloaded and applied as batched upserts, so repeated runs
+    refresh the stats of known instances without resetting their crawl state.
     Also saves the list of instance names to a file.
+    
+    Args:
+        batch_size (int, optional): Number of upserts sent with one bulk_write. Defaults to 1000.
     """
     config = Config()
     mongodb_uri = config.get_central_mongodb_uri()
@@ -28,13 +81,12 @@ def fetch_instances():
     headers = {'Authorization': f'Bearer {token}'}
     logger.info("Sending request to fetch instances list...")
     try:
-        response = requests.get("https://instances.social/api/1.0/instances/list", headers=headers, params=query)
+        response = requests.get("https://instances.social/api/1.0/instances/list", headers=headers, params=query, stream=True)
         if response.status_code != 200:
             save_error_log(None, "fetch_instances", "API", "Failed to fetch instances", res_code=response.status_code, error_message=response.text)
             logger.error(f"Failed to fetch instances: {response.status_code}")
             raise ConnectionError(f"Failed to fetch instances: {response.status_code}")
-        
-        data = response.json()
+        response.raw.decode_content = True
         current_time = datetime.now()
         
         client = MongoClient(mongodb_uri)
@@ -43,32 +95,45 @@ def fetch_instances():
         
         # Create unique index on 'name' field
         create_unique_index(instances_collection, 'name')
+        known = load_listed_fields(instances_collection)
         
-        # Prepare documents for insertion
-        instances = data.get("instances", [])
-        
-        insert_num = 0
-        for item in instances:
-            item['loadtime'] = current_time
-            item['processable'] = True
-            item['round'] = -1
-            item['statuses'] = int(item.get('statuses', 0))
-            try:
-                instances_collection.insert_one(item)
-                insert_num += 1
-            except errors.DuplicateKeyError:
-                logger.warning(f"Duplicate instance found: {item['name']}, skipping.")
-        
-        logger.info(f"Inserted {insert_num} instances into MongoDB.")
-        client.close()
-        
-        # Extract all names and save to file
-        names = [item['name'] for item in instances]
         paths = config.get_paths()
         instances_list_path = paths.get('instances_list', 'instances_list.txt')
+        stats = {'added': 0, 'changed': 0, 'unchanged': 0}
+        seen = set()
+        operations = []
+        
+        def apply(operations):
+            result = instances_collection.bulk_write(operations, ordered=False)
+            stats['added'] += result.upserted_count
+            stats['changed'] += result.modified_count
+        
         with open(instances_list_path, 'w', encoding='utf-8') as name_file:
-            for name in names:
+            for item in ijson.items(response.raw, 'instances.item', use_float=True):
+                name = item.get('name')
+                if not name or name in seen:
+                    continue
+                seen.add(name)
                 name_file.write(name + '\n')
+                operation = build_instance_upsert(item, known.get(name), current_time)
+                if operation is None:
+                    stats['unchanged'] += 1
+                    continue
+                operations.append(operation)
+                if len(operations) >= batch_size:
+                    apply(operations)
+                    operations = []
+            if operations:
+                apply(operations)
+        
+        removed = [name for name in known if name not in seen]
+        logger.info(
+            f"Instance list refreshed: {stats['added']} added, {stats['changed']} changed, "
+            f"{stats['unchanged']} unchanged, {len(removed)} no longer listed."
+        )
+        if removed:
+            logger.info(f"Instances no longer listed: {', '.join(removed[:50])}{' ...' if len(removed) > 50 else ''}")
+        client.close()
         
         logger.info(f"All instance names have been saved to {instances_list_path}")
     except Exception as e:
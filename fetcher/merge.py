@@ -0,0 +1,255 @@
+# fetcher/merge.py
+import time
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from pymongo import MongoClient, UpdateOne
+from config import Config
+from utils import create_unique_index
+from retry import RETRY_FIELDS
+
+logger = logging.getLogger(__name__)
+
+# Collections copied from every host: the key identifying a document in the central dataset, the field
+# whose increasing value marks new or changed documents, and worker bookkeeping that is not copied.
+# livefeeds, boostersfavourites and error_log are append-only apart from the excluded bookkeeping, so the
+# '_id' of new documents is enough; accounts are upserted again when a worker sees them, so they are
+# watermarked by 'loadtime'. A collection whose documents change after insertion needs such a field.
+MERGE_COLLECTIONS = {
+    'livefeeds': {'key': 'sid', 'watermark': '_id', 'exclude': ['status', 'lease_owner', 'lease_id', 'lease_expires'] + RETRY_FIELDS},
+    'boostersfavourites': {'key': 'bid', 'watermark': '_id', 'exclude': []},
+    'accounts': {'key': 'aid', 'watermark': 'loadtime', 'exclude': []},
+    'error_log': {'key': '_id', 'watermark': '_id', 'exclude': []},
+}
+
+def watermark_bound(field, lag):
+    """
+    Returns the upper bound of the watermark values that are safe to copy.
+    Documents written in the last lag seconds are left for the next pass, because concurrent writers
+    can commit a document with a smaller value after a larger one.
+
+    Args:
+        field (str): The watermark field, '_id' or a datetime field.
+        lag (float): Seconds.
+
+    Returns:
+        ObjectId or datetime: The bound.
+    """
+    if field == '_id':
+        return ObjectId.from_datetime(datetime.now(timezone.utc) - timedelta(seconds=lag))
+    return datetime.now() - timedelta(seconds=lag)
+
+def watermark_query(field, mark, bound):
+    """
+    Builds the query of the documents after a high-water mark and before the bound.
+
+    Args:
+        field (str): The watermark field.
+        mark (dict or None): Last copied 'value' and '_id', or None to start from the beginning.
+        bound (ObjectId or datetime): Upper bound from watermark_bound.
+
+    Returns:
+        dict: The query.
+    """
+    if field == '_id':
+        query = {"_id": {"$lt": bound}}
+        if mark:
+            query["_id"]["$gt"] = mark['_id']
+        return query
+    query = {field: {"$lt": bound}}
+    if mark:
+        query["$or"] = [
+            {field: {"$gt": mark['value']}},
+            {field: mark['value'], "_id": {"$gt": mark['_id']}}
+        ]
+    return query
+
+def build_merge_upsert(document, spec, host_name):
+    """
+    Builds the upsert copying a local document into the central collection.
+
+    Args:
+        document (dict): The local document.
+        spec (dict): Entry of MERGE_COLLECTIONS.
+        host_name (str): Name of the host the document comes from.
+
+    Returns:
+        pymongo.UpdateOne: The upsert.
+    """
+    key = spec['key']
+    fields = {k: v for k, v in document.items() if k != '_id' and k not in spec['exclude']}
+    fields['merged_from'] = host_name
+    return UpdateOne({key: document[key]}, {"$set": fields}, upsert=True)
+
+class HostMerger:
+    """
+    Copies the new and changed documents of one host's local database into the central database.
+    Each collection is read in watermark order and written with unordered bulk upserts; the
+    high-water mark is stored in the central 'merge_state' collection after every batch, so an
+    interrupted merge continues where it stopped.
+    """
+    def __init__(self, host_name, local_db, central_db, batch_size=1000, lag=60):
+        """
+        Args:
+            host_name (str): Name of the host.
+            local_db (pymongo.database.Database): The host's local database.
+            central_db (pymongo.database.Database): The central database.
+            batch_size (int, optional): Number of documents per bulk write. Defaults to 1000.
+            lag (float, optional): Seconds documents must be old before they are copied. Defaults to 60.
+        """
+        self.host_name = host_name
+        self.local_db = local_db
+        self.central_db = central_db
+        self.batch_size = batch_size
+        self.lag = lag
+        self.state = central_db['merge_state']
+
+    def load_mark(self, name):
+        state = self.state.find_one({"_id": f"{self.host_name}/{name}"})
+        return state.get('mark') if state else None
+
+    def save_mark(self, name, mark, merged):
+        self.state.update_one(
+            {"_id": f"{self.host_name}/{name}"},
+            {"$set": {"mark": mark, "updated_at": datetime.now()}, "$inc": {"merged": merged}},
+            upsert=True
+        )
+
+    def merge_collection(self, name, spec):
+        """
+        Copies the documents of one collection written since the last merge.
+
+        Args:
+            name (str): Name of the collection.
+            spec (dict): Entry of MERGE_COLLECTIONS.
+
+        Returns:
+            int: Number of documents copied.
+        """
+        field = spec['watermark']
+        mark = self.load_mark(name)
+        bound = watermark_bound(field, self.lag)
+        sort = [("_id", 1)] if field == '_id' else [(field, 1), ("_id", 1)]
+        cursor = self.local_db[name].find(watermark_query(field, mark, bound)).sort(sort).batch_size(self.batch_size)
+        central = self.central_db[name]
+        copied = 0
+        batch = []
+        for document in cursor:
+            batch.append(document)
+            if len(batch) >= self.batch_size:
+                mark = self.write_batch(name, central, spec, batch)
+                copied += len(batch)
+                batch = []
+        if batch:
+            mark = self.write_batch(name, central, spec, batch)
+            copied += len(batch)
+        if copied:
+            logger.info(f"Merged {copied} documents of {name} from {self.host_name}.")
+        return copied
+
+    def write_batch(self, name, central, spec, batch):
+        """
+        Upserts a batch into the central collection and advances the high-water mark.
+
+        Args:
+            name (str): Name of the collection.
+            central (pymongo.collection.Collection): The central collection.
+            spec (dict): Entry of MERGE_COLLECTIONS.
+            batch (list): Local documents in watermark order.
+
+        Returns:
+            dict: The new high-water mark.
+        """
+        central.bulk_write([build_merge_upsert(doc, spec, self.host_name) for doc in batch], ordered=False)
+        last = batch[-1]
+        mark = {"_id": last['_id'], "value": last.get(spec['watermark'])}
+        self.save_mark(name, mark, len(batch))
+        return mark
+
+    def merge(self):
+        """
+        Copies every collection of MERGE_COLLECTIONS.
+
+        Returns:
+            dict: Number of documents copied per collection.
+        """
+        for name, spec in MERGE_COLLECTIONS.items():
+            if spec['watermark'] != '_id':
+                self.local_db[name].create_index([(spec['watermark'], 1), ("_id", 1)], name=f"{spec['watermark']}_id")
+        return {name: self.merge_collection(name, spec) for name, spec in MERGE_COLLECTIONS.items()}
+
+def ensure_merge_indexes(central_db):
+    """
+    Creates the unique keys of the merged collections in the central database.
+
+    Args:
+        central_db (pymongo.database.Database): The central database.
+    """
+    for name, spec in MERGE_COLLECTIONS.items():
+        if spec['key'] != '_id':
+            create_unique_index(central_db[name], spec['key'])
+
+def merge_hosts(hosts, central_db, batch_size=1000, lag=60):
+    """
+    Merges all hosts in parallel, one thread per host.
+
+    Args:
+        hosts (list): (name, MongoDB URI) of every host.
+        central_db (pymongo.database.Database): The central database.
+        batch_size (int, optional): Number of documents per bulk write. Defaults to 1000.
+        lag (float, optional): Seconds documents must be old before they are copied. Defaults to 60.
+
+    Returns:
+        dict: Number of documents copied per host and collection.
+    """
+    def merge_host(host_name, uri):
+        client = MongoClient(uri)
+        try:
+            return HostMerger(host_name, client['mastodon'], central_db, batch_size=batch_size, lag=lag).merge()
+        except Exception:
+            logger.exception(f"Failed to merge {host_name}")
+            return {}
+        finally:
+            client.close()
+
+    with ThreadPoolExecutor(max_workers=max(len(hosts), 1)) as executor:
+        futures = {name: executor.submit(merge_host, name, uri) for name, uri in hosts}
+        return {name: future.result() for name, future in futures.items()}
+
+def main():
+    """
+    Main function to merge the local databases of all hosts into the central database.
+    """
+    parser = argparse.ArgumentParser(description='Merge local databases into the central database')
+    parser.add_argument('--interval', type=int, default=0, help='Seconds between merges, 0 to merge once')
+    parser.add_argument('--batch_size', type=int, default=None, help='Documents per bulk write (default from config)')
+    parser.add_argument('--lag', type=int, default=None, help='Seconds documents must be old before they are merged (default from config)')
+    args = parser.parse_args()
+
+    config = Config()
+    hosts = config.get_merge_hosts()
+    if not hosts:
+        logger.error("No hosts configured under merge.hosts.")
+        return
+    batch_size = args.batch_size or config.merge.get('batch_size', 1000)
+    lag = args.lag if args.lag is not None else config.merge.get('lag', 60)
+    client = MongoClient(config.get_central_mongodb_uri())
+    central_db = client['mastodon']
+    ensure_merge_indexes(central_db)
+    try:
+        while True:
+            results = merge_hosts(hosts, central_db, batch_size=batch_size, lag=lag)
+            total = sum(sum(counts.values()) for counts in results.values())
+            logger.info(f"Merged {total} documents from {len(hosts)} hosts.")
+            if not args.interval:
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        logger.info("Merge interrupted, it will resume from the saved high-water marks.")
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+# fetcher/metrics.py
+import os
+import time
+import threading
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Metrics:
+    """
+    Process-local counters, gauges and histograms with labels.
+    Snapshots of several processes can be merged and rendered in the Prometheus text format.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        Args:
+            buckets (tuple, optional): Upper bounds of the histogram buckets in seconds.
+        """
+        self.buckets = buckets
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increases a counter.
+
+        Args:
+            name (str): Name of the counter.
+            value (float, optional): Amount to add. Defaults to 1.
+            **labels: Label values.
+        """
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """
+        Sets a gauge.
+
+        Args:
+            name (str): Name of the gauge.
+            value (float): Current value.
+            **labels: Label values.
+        """
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        """
+        Records a value in a histogram.
+
+        Args:
+            name (str): Name of the histogram.
+            value (float): Observed value, e.g. seconds.
+            **labels: Label values.
+        """
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+                self.histograms[key] = histogram
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def snapshot(self):
+        """
+        Returns a copy of all values that can be pickled and merged.
+
+        Returns:
+            dict: 'counters', 'gauges' and 'histograms'.
+        """
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'histograms': {k: {'buckets': list(v['buckets']), 'sum': v['sum'], 'count': v['count']}
+                               for k, v in self.histograms.items()}
+            }
+
+metrics = Metrics()
+
+def merge_snapshots(snapshots):
+    """
+    Adds up the snapshots of several processes.
+
+    Args:
+        snapshots (iterable): Snapshots returned by Metrics.snapshot.
+
+    Returns:
+        dict: The merged snapshot.
+    """
+    merged = {'counters': {}, 'gauges': {}, 'histograms': {}}
+    for snapshot in snapshots:
+        for key, value in snapshot['counters'].items():
+            merged['counters'][key] = merged['counters'].get(key, 0) + value
+        for key, value in snapshot['gauges'].items():
+            merged['gauges'][key] = merged['gauges'].get(key, 0) + value
+        for key, value in snapshot['histograms'].items():
+            histogram = merged['histograms'].setdefault(
+                key, {'buckets': [0] * len(value['buckets']), 'sum': 0.0, 'count': 0}
+            )
+            histogram['buckets'] = [a + b for a, b in zip(histogram['buckets'], value['buckets'])]
+            histogram['sum'] += value['sum']
+            histogram['count'] += value['count']
+    return merged
+
+def format_labels(labels, extra=None):
+    pairs = list(labels) + (extra or [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{str(v)}"' for k, v in pairs) + '}'
+
+def render_prometheus(snapshot, buckets=DEFAULT_BUCKETS):
+    """
+    Renders a snapshot in the Prometheus text exposition format.
+
+    Args:
+        snapshot (dict): Snapshot returned by Metrics.snapshot or merge_snapshots.
+        buckets (tuple, optional): Upper bounds of the histogram buckets.
+
+    Returns:
+        str: The metrics page.
+    """
+    lines = []
+    for (name, labels), value in sorted(snapshot['counters'].items()):
+        lines.append(f"fedilive_{name}{format_labels(labels)} {value}")
+    for (name, labels), value in sorted(snapshot['gauges'].items()):
+        lines.append(f"fedilive_{name}{format_labels(labels)} {value}")
+    for (name, labels), histogram in sorted(snapshot['histograms'].items()):
+        cumulative = 0
+        for bound, count in zip(buckets, histogram['buckets']):
+            cumulative += count
+            lines.append(f"fedilive_{name}_bucket{format_labels(labels, [('le', bound)])} {cumulative}")
+        lines.append(f"fedilive_{name}_bucket{format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+        lines.append(f"fedilive_{name}_sum{format_labels(labels)} {histogram['sum']}")
+        lines.append(f"fedilive_{name}_count{format_labels(labels)} {histogram['count']}")
+    return '\n'.join(lines) + '\n'
+
+def total(snapshot, name, kind='counters', **labels):
+    """
+    Sums a metric over all label values that match the given labels.
+
+    Args:
+        snapshot (dict): A snapshot.
+        name (str): Name of the metric.
+        kind (str, optional): 'counters' or 'gauges'. Defaults to 'counters'.
+        **labels: Label values to match.
+
+    Returns:
+        float: The sum.
+    """
+    result = 0
+    for (metric, metric_labels), value in snapshot[kind].items():
+        if metric == name and all((k, v) in metric_labels for k, v in labels.items()):
+            result += value
+    return result
+
+def histogram_quantile(snapshot, name, quantile, buckets=DEFAULT_BUCKETS):
+    """
+    Estimates a quantile of a histogram over all label values as the upper bound of its bucket.
+
+    Returns:
+        float or None: The estimate, or None without observations.
+    """
+    counts = [0] * len(buckets)
+    observed = 0
+    for (metric, _), histogram in snapshot['histograms'].items():
+        if metric == name:
+            counts = [a + b for a, b in zip(counts, histogram['buckets'])]
+            observed += histogram['count']
+    if not observed:
+        return None
+    cumulative = 0
+    for bound, count in zip(buckets, counts):
+        cumulative += count
+        if cumulative >= observed * quantile:
+            return bound
+    return float('inf')
+
+def summary_line(snapshot, previous, elapsed):
+    """
+    Builds the periodic summary of a snapshot compared to the previous one.
+
+    Args:
+        snapshot (dict): The current snapshot.
+        previous (dict): The snapshot of the previous summary.
+        elapsed (float): Seconds between both snapshots.
+
+    Returns:
+        str: The summary.
+    """
+    def delta(name, **labels):
+        return total(snapshot, name, **labels) - total(previous, name, **labels)
+
+    requests = delta('requests_total')
+    p50 = histogram_quantile(snapshot, 'request_seconds', 0.5)
+    p99 = histogram_quantile(snapshot, 'request_seconds', 0.99)
+    write_p50 = histogram_quantile(snapshot, 'db_write_seconds', 0.5)
+    return (
+        f"{requests / elapsed:.1f} req/s ({requests:.0f} requests, {delta('retries_total'):.0f} 429/503 retries), "
+        f"{delta('documents_written_total', result='inserted'):.0f} documents written, "
+        f"{delta('documents_written_total', result='duplicates'):.0f} duplicates, "
+        f"{delta('ratelimit_sleep_seconds_total'):.1f}s rate limit sleep, "
+        f"request p50/p99 <= {p50}/{p99}s, DB write p50 <= {write_p50}s, "
+        f"pending statuses {total(snapshot, 'pending_statuses', kind='gauges'):.0f}"
+    )
+
+class MetricsReporter(threading.Thread):
+    """
+    Background thread that publishes the snapshot of this process to a store shared with the
+    process serving the metrics endpoint, and periodically logs a summary line.
+    """
+    def __init__(self, interval=60, store=None, gauges=None, summarize=True, aggregate=False):
+        """
+        Args:
+            interval (float, optional): Seconds between summaries. Defaults to 60.
+            store (dict-like, optional): Shared store of snapshots by process ID.
+            gauges (callable, optional): Function called before every summary to update gauges.
+            summarize (bool, optional): Log a summary line every interval. Defaults to True.
+            aggregate (bool, optional): Summarize the snapshots of all processes in store instead of
+                only this one. Defaults to False.
+        """
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.store = store
+        self.gauges = gauges
+        self.summarize = summarize
+        self.aggregate = aggregate
+        self.stopped = threading.Event()
+
+    def publish(self):
+        if self.gauges:
+            try:
+                self.gauges()
+            except Exception:
+                logger.exception("Failed to update gauges")
+        snapshot = metrics.snapshot()
+        if self.store is not None:
+            self.store[os.getpid()] = snapshot
+            if self.aggregate:
+                snapshot = merge_snapshots(self.store.values())
+        return snapshot
+
+    def run(self):
+        previous = self.publish()
+        last = time.monotonic()
+        while not self.stopped.wait(self.interval):
+            try:
+                snapshot = self.publish()
+            except Exception:
+                logger.exception("Failed to publish metrics")
+                continue
+            now = time.monotonic()
+            if self.summarize:
+                logger.info(f"Progress: {summary_line(snapshot, previous, now - last)}")
+            previous, last = snapshot, now
+
+    def stop(self):
+        self.stopped.set()
+        self.publish()
+
+def start_reporter(metrics_config, store=None, gauges=None, summarize=True, aggregate=False):
+    """
+    Starts a MetricsReporter.
+
+    Args:
+        metrics_config (dict): The 'metrics' configuration.
+        store (dict-like, optional): Shared store of snapshots by process ID.
+        gauges (callable, optional): Function called before every summary to update gauges.
+        summarize (bool, optional): Log a summary line every interval. Defaults to True.
+        aggregate (bool, optional): Summarize the snapshots of all processes in store. Defaults to False.
+
+    Returns:
+        MetricsReporter: The started reporter.
+    """
+    reporter = MetricsReporter(metrics_config.get('summary_interval', 60), store, gauges, summarize, aggregate)
+    reporter.start()
+    return reporter
+
+def start_http_server(port, store=None, host='127.0.0.1'):
+    """
+    Serves the merged metrics of this process and of the snapshots in store on /metrics.
+
+    Args:
+        port (int): Port to listen on.
+        store (dict-like, optional): Shared store of snapshots by process ID.
+        host (str, optional): Address to listen on. Defaults to '127.0.0.1'.
+
+    Returns:
+        ThreadingHTTPServer: The running server.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            snapshots = dict(store.items()) if store is not None else {}
+            snapshots[os.getpid()] = metrics.snapshot()
+            body = render_prometheus(merge_snapshots(snapshots.values())).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+def record_request(status, seconds, endpoint):
+    """
+    Records an API request. Requests are not labelled with their instance, since a crawl reaches
+    thousands of instances and every label value is a separate series; the per-instance picture is in
+    the crawl stats of the instances collection.
+
+    Args:
+        status (int or str): HTTP status code, or 'timeout'/'error' if there was no response.
+        seconds (float): Duration of the request.
+        endpoint (str): Kind of endpoint, e.g. 'timeline'.
+    """
+    metrics.inc('requests_total', code=status, endpoint=endpoint)
+    metrics.observe('request_seconds', seconds, endpoint=endpoint)
+
+def record_write(collection, result, seconds):
+    """
+    Records a batch write.
+
+    Args:
+        collection (str): Name of the collection or sink.
+        result (dict): Number of documents 'inserted', skipped as 'duplicates' and failed ('errors').
+        seconds (float): Duration of the write.
+    """
+    for key, value in result.items():
+        if value:
+            metrics.inc('documents_written_total', value, collection=collection, result=key)
+    metrics.observe('db_write_seconds', seconds, collection=collection)
@@ -0,0 +1,357 @@
+# fetcher/mock_server.py
+import json
+import time
+import random
+import asyncio
+import argparse
+import logging
+from bisect import bisect_left
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from aiohttp import web
+from utils import datetime2snowflake
+
+logger = logging.getLogger(__name__)
+
+def format_iso(dt):
+    """
+    Formats a naive UTC datetime the way Mastodon does, e.g. '2024-01-01T00:00:00.000Z'.
+    """
+    return dt.strftime('%Y-%m-%dT%H:%M:%S.') + f"{dt.microsecond // 1000:03d}Z"
+
+class MockInstance:
+    """
+    Synthetic timeline of one mock instance. Statuses are spread evenly over the window and get
+    snowflake IDs derived from their creation time, so seeking by ID works as on Mastodon.
+    """
+    def __init__(self, index, toots, window_start, window_end, engagement_max=20, seed=0):
+        """
+        Args:
+            index (int): Number of the instance.
+            toots (int): Number of statuses in the window.
+            window_start (datetime): Start of the window (naive UTC).
+            window_end (datetime): End of the window (naive UTC).
+            engagement_max (int, optional): Maximum reblogs and favourites per status. Defaults to 20.
+            seed (int, optional): Random seed. Defaults to 0.
+        """
+        rng = random.Random(seed * 1000003 + index)
+        step = (window_end - window_start) / max(toots, 1)
+        self.index = index
+        self.created = {}
+        self.counts = {}
+        ids = []
+        for k in range(toots):
+            created_at = window_start + step * (k + 0.5)
+            status_id = datetime2snowflake(created_at) + index
+            ids.append(status_id)
+            self.created[status_id] = created_at
+            self.counts[status_id] = (rng.randint(0, engagement_max), rng.randint(0, engagement_max))
+        self.ids = sorted(ids)
+
+    def publish(self, created_at):
+        """
+        Adds a new status, e.g. one posted while a stream is open.
+
+        Args:
+            created_at (datetime): Creation time of the status (naive UTC).
+
+        Returns:
+            int: ID of the status, greater than every earlier one.
+        """
+        status_id = max(datetime2snowflake(created_at) + self.index, self.ids[-1] + 1 if self.ids else 0)
+        self.ids.append(status_id)
+        self.created[status_id] = created_at
+        self.counts[status_id] = (0, 0)
+        return status_id
+
+    def account(self, account_id):
+        return {
+            "id": str(account_id),
+            "username": f"user{account_id}",
+            "acct": f"user{account_id}",
+            "display_name": f"User {account_id}",
+            "locked": False,
+            "bot": False,
+            "created_at": "2023-01-01T00:00:00.000Z",
+            "note": "",
+            "url": f"https://mock{self.index}.example/@user{account_id}",
+            "followers_count": account_id % 1000,
+            "following_count": account_id % 500,
+            "statuses_count": account_id % 5000,
+        }
+
+    def status(self, status_id):
+        reblogs, favourites = self.counts[status_id]
+        return {
+            "id": str(status_id),
+            "created_at": format_iso(self.created[status_id]),
+            "in_reply_to_id": None,
+            "in_reply_to_account_id": None,
+            "sensitive": False,
+            "spoiler_text": "",
+            "visibility": "public",
+            "language": "en",
+            "uri": f"https://mock{self.index}.example/statuses/{status_id}",
+            "url": f"https://mock{self.index}.example/@user/{status_id}",
+            "replies_count": 0,
+            "reblogs_count": reblogs,
+            "favourites_count": favourites,
+            "content": f"<p>Synthetic status {status_id}</p>",
+            "account": self.account(status_id % 997 + 1),
+            "media_attachments": [],
+            "mentions": [],
+            "tags": [],
+            "emojis": [],
+            "card": None,
+            "poll": None,
+        }
+
+    def page(self, max_id=None, since_id=None, min_id=None, limit=40):
+        """
+        Returns the IDs of one timeline page, newest first, like Mastodon's paginated endpoints.
+        """
+        lower = bisect_left(self.ids, int(min_id if min_id else since_id or 0) + 1)
+        upper = bisect_left(self.ids, int(max_id)) if max_id else len(self.ids)
+        if upper <= lower:
+            return []
+        if min_id:
+            return list(reversed(self.ids[lower:min(lower + limit, upper)]))
+        return list(reversed(self.ids[max(upper - limit, lower):upper]))
+
+class MockMastodon:
+    """
+    aiohttp application serving synthetic Mastodon instances, one per port on localhost.
+    Responses carry Link headers, snowflake IDs and x-ratelimit headers; rate limits are enforced
+    per token, and each instance randomly starts bursts of 429/503 responses. Statuses added with
+    'publish' are pushed to the open 'public:local' streams of their instance. Request counts and
+    latencies are kept in 'stats', and the most requests in flight at once per port and in 'total' in 'max_in_flight'.
+    """
+    def __init__(self, instances=10, toots=2000, window_start=None, window_end=None, latency=0.02, jitter=0.01,
+                 error_rate=0.0, burst_length=3, ratelimit=300, ratelimit_window=300, engagement_max=20,
+                 streaming=True, host='localhost', base_port=18000, seed=0):
+        """
+        Args:
+            instances (int, optional): Number of mock instances. Defaults to 10.
+            toots (int, optional): Statuses per instance in the window. Defaults to 2000.
+            window_start (datetime, optional): Start of the window (naive UTC). Defaults to 24 hours before window_end.
+            window_end (datetime, optional): End of the window (naive UTC). Defaults to the current hour.
+            latency (float, optional): Seconds added to every response. Defaults to 0.02.
+            jitter (float, optional): Maximum random seconds added on top of latency. Defaults to 0.01.
+            error_rate (float, optional): Probability that a request starts a 429/503 burst. Defaults to 0.
+            burst_length (int, optional): Number of failed responses per burst. Defaults to 3.
+            ratelimit (int, optional): Requests per token and window. Defaults to 300.
+            ratelimit_window (int, optional): Seconds per rate limit window. Defaults to 300.
+            engagement_max (int, optional): Maximum reblogs and favourites per status. Defaults to 20.
+            streaming (bool, optional): Advertise and serve the streaming API. Defaults to True.
+            host (str, optional): Host name to listen on. Defaults to 'localhost'.
+            base_port (int, optional): Port of the first instance. Defaults to 18000.
+            seed (int, optional): Random seed. Defaults to 0.
+        """
+        self.window_end = window_end or datetime.now(timezone.utc).replace(tzinfo=None, minute=0, second=0, microsecond=0)
+        self.window_start = window_start or self.window_end - timedelta(hours=24)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.burst_length = burst_length
+        self.ratelimit = ratelimit
+        self.ratelimit_window = ratelimit_window
+        self.streaming = streaming
+        self.host = host
+        self.base_port = base_port
+        self.rng = random.Random(seed)
+        self.instances = {
+            base_port + i: MockInstance(i, toots, self.window_start, self.window_end, engagement_max, seed)
+            for i in range(instances)
+        }
+        self.buckets = {}
+        self.bursts = Counter()
+        self.stats = Counter()
+        self.in_flight = Counter()
+        self.max_in_flight = Counter()
+        self.latencies = []
+        self.streams = {port: set() for port in self.instances}
+        self.runner = None
+
+    @property
+    def instance_names(self):
+        return [f"{self.host}:{port}" for port in self.instances]
+
+    def ratelimit_headers(self, port, token):
+        now = time.time()
+        key = (port, token)
+        remaining, reset = self.buckets.get(key, (self.ratelimit, now + self.ratelimit_window))
+        if now >= reset:
+            remaining, reset = self.ratelimit, now + self.ratelimit_window
+        remaining -= 1
+        self.buckets[key] = (remaining, reset)
+        reset_time = datetime.fromtimestamp(reset, timezone.utc).replace(tzinfo=None)
+        headers = {
+            'X-RateLimit-Limit': str(self.ratelimit),
+            'X-RateLimit-Remaining': str(max(remaining, 0)),
+            'X-RateLimit-Reset': format_iso(reset_time)
+        }
+        return headers, remaining < 0
+
+    def publish(self, port):
+        """
+        Posts a new status on an instance and pushes it to the instance's open streams.
+
+        Args:
+            port (int): Port of the instance.
+
+        Returns:
+            str: ID of the status.
+        """
+        instance = self.instances[port]
+        status_id = instance.publish(datetime.now(timezone.utc).replace(tzinfo=None))
+        for queue in self.streams[port]:
+            queue.put_nowait(instance.status(status_id))
+        return str(status_id)
+
+    def link_header(self, request, ids):
+        if not ids:
+            return {}
+        base = f"{request.scheme}://{request.host}{request.path}"
+        return {'Link': f'<{base}?max_id={ids[-1]}>; rel="next", <{base}?min_id={ids[0]}>; rel="prev"'}
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        start = time.monotonic()
+        port = request.url.port
+        kind = request.match_info.route.name or 'other'
+        headers, limited = self.ratelimit_headers(port, request.headers.get('Authorization'))
+        for key in (port, 'total'):
+            self.in_flight[key] += 1
+            self.max_in_flight[key] = max(self.max_in_flight[key], self.in_flight[key])
+        try:
+            await asyncio.sleep(self.latency + self.rng.random() * self.jitter)
+        finally:
+            self.in_flight[port] -= 1
+            self.in_flight['total'] -= 1
+        if limited:
+            response = web.json_response({"error": "Too many requests"}, status=429, headers=headers)
+        elif self.bursts[port] or self.rng.random() < self.error_rate:
+            if not self.bursts[port]:
+                self.bursts[port] = self.burst_length
+            self.bursts[port] -= 1
+            response = web.json_response({"error": "Unavailable"}, status=self.rng.choice([429, 503]), headers=headers)
+        else:
+            response = await handler(request)
+            response.headers.update(headers)
+        self.stats[(kind, response.status)] += 1
+        self.latencies.append(time.monotonic() - start)
+        return response
+
+    def get_instance(self, request):
+        instance = self.instances.get(request.url.port)
+        if instance is None:
+            raise web.HTTPNotFound()
+        return instance
+
+    async def handle_instance(self, request):
+        return web.json_response({
+            "uri": request.host,
+            "title": f"Mock instance {request.host}",
+            "version": "4.2.0",
+            "urls": {"streaming_api": f"ws://{request.host}"} if self.streaming else {}
+        })
+
+    async def handle_timeline(self, request):
+        instance = self.get_instance(request)
+        query = request.query
+        limit = min(int(query.get('limit', 20)), 40)
+        ids = instance.page(query.get('max_id'), query.get('since_id'), query.get('min_id'), limit)
+        return web.json_response([instance.status(i) for i in ids], headers=self.link_header(request, ids))
+
+    async def handle_stream(self, request):
+        instance = self.get_instance(request)
+        if not self.streaming:
+            raise web.HTTPNotFound()
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        queue = asyncio.Queue()
+        streams = self.streams[request.url.port]
+        streams.add(queue)
+        try:
+            await response.write(b':)\n')
+            while True:
+                status = await queue.get()
+                if status is None:
+                    break
+                await response.write(f"event: update\ndata: {json.dumps(status)}\n\n".encode('utf-8'))
+        except ConnectionResetError:
+            logger.debug(f"Stream of mock instance {instance.index} closed by the client.")
+        finally:
+            streams.discard(queue)
+        return response
+
+    async def handle_engagement(self, request):
+        instance = self.get_instance(request)
+        status_id = int(request.match_info['status_id'])
+        if status_id not in instance.counts:
+            return web.json_response({"error": "Record not found"}, status=404)
+        reblogs, favourites = instance.counts[status_id]
+        count = reblogs if request.match_info['endpoint'] == 'reblogged_by' else favourites
+        limit = min(int(request.query.get('limit', 40)), 80)
+        max_id = int(request.query.get('max_id', count + 1))
+        account_ids = list(range(min(max_id, count + 1) - 1, 0, -1))[:limit]
+        offset = 0 if request.match_info['endpoint'] == 'reblogged_by' else 100000
+        accounts = [instance.account(status_id % 997 + offset + i) for i in account_ids]
+        return web.json_response(accounts, headers=self.link_header(request, account_ids))
+
+    def make_app(self):
+        app = web.Application(middlewares=[self.middleware])
+        app.router.add_get('/api/v1/instance', self.handle_instance, name='instance')
+        app.router.add_get('/api/v1/timelines/public', self.handle_timeline, name='timeline')
+        app.router.add_get('/api/v1/streaming/public/local', self.handle_stream, name='stream')
+        app.router.add_get('/api/v1/statuses/{status_id}/{endpoint:reblogged_by|favourited_by}',
+                           self.handle_engagement, name='engagement')
+        return app
+
+    async def start(self):
+        """
+        Starts listening on one port per instance.
+        """
+        self.runner = web.AppRunner(self.make_app(), access_log=None)
+        await self.runner.setup()
+        for port in self.instances:
+            await web.TCPSite(self.runner, self.host, port).start()
+        logger.info(f"Mock Mastodon serving {len(self.instances)} instances on {self.host}:{self.base_port}+")
+
+    async def stop(self):
+        for streams in self.streams.values():
+            for queue in streams:
+                queue.put_nowait(None)
+        if self.runner:
+            await self.runner.cleanup()
+
+def main():
+    """
+    Runs the mock server until interrupted, e.g. to point a worker at it by hand.
+    """
+    parser = argparse.ArgumentParser(description='Mock Mastodon Server')
+    parser.add_argument('--instances', type=int, default=10, help='Number of mock instances')
+    parser.add_argument('--toots', type=int, default=2000, help='Statuses per instance')
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds added to every response')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Probability that a request starts a 429/503 burst')
+    parser.add_argument('--base_port', type=int, default=18000, help='Port of the first instance')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    server = MockMastodon(instances=args.instances, toots=args.toots, latency=args.latency,
+                          error_rate=args.error_rate, base_port=args.base_port)
+
+    async def serve():
+        await server.start()
+        print(f"Window: {server.window_start} - {server.window_end}")
+        print("Instances: " + ", ".join(server.instance_names))
+        while True:
+            await asyncio.sleep(3600)
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
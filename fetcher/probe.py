@@ -0,0 +1,313 @@
+# fetcher/probe.py
+import time
+import errno
+import socket
+import asyncio
+import argparse
+import logging
+from datetime import datetime, timedelta
+import aiohttp
+from pymongo import MongoClient, UpdateOne
+from config import Config
+from utils import instance_url
+from token_pool import create_token_pool
+
+logger = logging.getLogger(__name__)
+
+# Responses of '/api/v1/instance' showing that no Mastodon instance is served under the name.
+GONE_CODES = {404, 410}
+
+def ensure_probe_indexes(collection):
+    """
+    Creates the index used to find instances whose probe result expired.
+
+    Args:
+        collection (pymongo.collection.Collection): The instances collection.
+    """
+    collection.create_index([("probe.checked_at", 1)], name="probe_checked_at")
+    logger.info(f"Probe index ensured for collection '{collection.name}'.")
+
+def probe_candidates(instances_collection, ttl):
+    """
+    Finds the instances that need to be probed: processable instances and instances disabled by an
+    earlier probe, whose probe result is missing or older than the TTL.
+
+    Args:
+        instances_collection (pymongo.collection.Collection): The instances collection.
+        ttl (int): Seconds a probe result stays valid.
+
+    Returns:
+        list: Instance documents with 'name' and 'probe'.
+    """
+    stale = datetime.now() - timedelta(seconds=ttl)
+    query = {
+        "$and": [
+            {"$or": [{"processable": True}, {"probe.disabled": True}]},
+            {"$or": [{"probe.checked_at": {"$exists": False}}, {"probe.checked_at": {"$lt": stale}}]}
+        ]
+    }
+    return list(instances_collection.find(query, {"name": 1, "probe": 1}))
+
+def is_inconclusive(result):
+    """
+    Checks whether a probe result is inconclusive, i.e. the instance or its public timeline answered
+    with a failure that may go away by itself.
+
+    Args:
+        result (dict): Result of InstanceProber.probe_instance.
+
+    Returns:
+        bool: True if the result must not change 'processable'.
+    """
+    return result['reachable'] is None or (result['reachable'] and result['public_timeline'] is None)
+
+def build_probe_update(instance_info, result):
+    """
+    Builds the update recording a probe result on an instance.
+    Instances that are unreachable or have no public timeline are marked unprocessable, and instances
+    disabled by an earlier probe are enabled again once they pass. Inconclusive results, e.g. a 429 or
+    5xx response, are recorded with None and leave 'processable' unchanged.
+
+    Args:
+        instance_info (dict): The instance document.
+        result (dict): Result of InstanceProber.probe_instance.
+
+    Returns:
+        pymongo.UpdateOne: The update.
+    """
+    if is_inconclusive(result):
+        result['disabled'] = instance_info.get('probe', {}).get('disabled', False)
+        return UpdateOne({"_id": instance_info["_id"]}, {"$set": {"probe": result}})
+    healthy = result['reachable'] and result['public_timeline']
+    result['disabled'] = not healthy
+    update = {"probe": result}
+    if not healthy:
+        update["processable"] = False
+    elif instance_info.get('probe', {}).get('disabled'):
+        update["processable"] = True
+    return UpdateOne({"_id": instance_info["_id"]}, {"$set": update})
+
+def is_unreachable_error(error):
+    """
+    Checks whether a request failed because nothing answers under the instance name, i.e. the name
+    does not resolve or the connection was refused.
+
+    Args:
+        error (Exception): The exception raised by the request.
+
+    Returns:
+        bool: True for DNS failures and refused connections.
+    """
+    if not isinstance(error, aiohttp.ClientConnectorError):
+        return False
+    os_error = error.os_error
+    return isinstance(os_error, socket.gaierror) or getattr(os_error, 'errno', None) == errno.ECONNREFUSED
+
+class InstanceProber:
+    """
+    Checks '/api/v1/instance' and the local public timeline of many instances concurrently.
+    """
+    def __init__(self, token_pool, scheme='https', max_concurrency=500, timeout=5, batch_size=500, timeout_attempts=3):
+        """
+        Args:
+            token_pool (TokenPool): Pool of API tokens.
+            scheme (str, optional): URL scheme of the instances. Defaults to 'https'.
+            max_concurrency (int, optional): Maximum number of instances probed at once. Defaults to 500.
+            timeout (int, optional): Request timeout in seconds. Defaults to 5.
+            batch_size (int, optional): Number of probe results written with one bulk_write. Defaults to 500.
+            timeout_attempts (int, optional): Timeouts of '/api/v1/instance' in a row after which an instance
+                counts as unreachable. Defaults to 3.
+        """
+        self.token_pool = token_pool
+        self.scheme = scheme
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.timeout_attempts = timeout_attempts
+
+    async def get(self, session, instance_name, path, params=None):
+        """
+        Sends a GET request with a leased token.
+
+        Args:
+            session (aiohttp.ClientSession): HTTP session.
+            instance_name (str): Name of the instance.
+            path (str): API path.
+            params (dict, optional): Query parameters.
+
+        Returns:
+            tuple: Status code, decoded JSON body (None unless 200) and lower-cased response headers.
+        """
+        token, wait_time = self.token_pool.lease(instance_name)
+        if wait_time > 0:
+            await asyncio.sleep(wait_time)
+        url = instance_url(instance_name, path, self.scheme)
+        async with session.get(url, headers=self.token_pool.headers(token), params=params) as response:
+            res_headers = {k.lower(): v for k, v in response.headers.items()}
+            self.token_pool.report(instance_name, token, response.status, res_headers)
+            data = await response.json(content_type=None) if response.status == 200 else None
+            return response.status, data, res_headers
+
+    async def probe_instance(self, session, instance_name):
+        """
+        Probes one instance.
+        Only DNS failures, refused connections, 404/410 responses and repeated timeouts make an instance
+        unreachable. Failures that may go away by themselves, such as 429 and 5xx responses, leave
+        'reachable' or 'public_timeline' None.
+
+        Args:
+            session (aiohttp.ClientSession): HTTP session.
+            instance_name (str): Name of the instance.
+
+        Returns:
+            dict: 'reachable' (True, False or None if inconclusive), 'latency' (seconds, None if unreachable),
+                'public_timeline' (True, False or None if inconclusive), 'status_code' of the instance request
+                if it failed or else of the timeline request, 'ratelimit_limit' (requests per window, None if not
+                sent), 'weekly_statuses' (statuses of the last complete week, None if unknown) and 'checked_at'.
+        """
+        result = {
+            "reachable": False,
+            "latency": None,
+            "public_timeline": False,
+            "status_code": None,
+            "ratelimit_limit": None,
+            "weekly_statuses": None,
+            "checked_at": datetime.now()
+        }
+        try:
+            for attempt in range(self.timeout_attempts):
+                try:
+                    start = time.monotonic()
+                    status_code, data, _ = await self.get(session, instance_name, "/api/v1/instance")
+                    break
+                except asyncio.TimeoutError:
+                    logger.debug(f"Probe of {instance_name} timed out ({attempt + 1}/{self.timeout_attempts}).")
+            else:
+                return result
+            result["latency"] = round(time.monotonic() - start, 3)
+            if status_code != 200:
+                result["status_code"] = status_code
+                if status_code not in GONE_CODES:
+                    result["reachable"] = result["public_timeline"] = None
+                return result
+            result["reachable"] = isinstance(data, dict)
+            if not result["reachable"]:
+                return result
+            status_code, data, res_headers = await self.get(
+                session, instance_name, "/api/v1/timelines/public", {"local": "true", "limit": 1}
+            )
+            result["status_code"] = status_code
+            if status_code == 429 or status_code >= 500:
+                result["public_timeline"] = None
+            else:
+                result["public_timeline"] = status_code == 200 and isinstance(data, list)
+            if 'x-ratelimit-limit' in res_headers:
+                result["ratelimit_limit"] = int(res_headers['x-ratelimit-limit'])
+            if result["public_timeline"]:
+                result["weekly_statuses"] = await self.weekly_statuses(session, instance_name)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logger.debug(f"Probe of {instance_name} failed: {e!r}")
+            if result["reachable"]:
+                result["public_timeline"] = None
+            elif not is_unreachable_error(e):
+                result["reachable"] = result["public_timeline"] = None
+        return result
+
+    async def weekly_statuses(self, session, instance_name):
+        """
+        Reads the number of statuses of the last complete week from '/api/v1/instance/activity'.
+
+        Args:
+            session (aiohttp.ClientSession): HTTP session.
+            instance_name (str): Name of the instance.
+
+        Returns:
+            int or None: Statuses of the last complete week, None if the instance does not publish its activity.
+        """
+        try:
+            status_code, data, _ = await self.get(session, instance_name, "/api/v1/instance/activity")
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            return None
+        # The first entry is the current, incomplete week.
+        if status_code != 200 or not isinstance(data, list) or len(data) < 2:
+            return None
+        try:
+            return int(data[1]['statuses'])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    async def run(self, instances_collection, candidates):
+        """
+        Probes all candidates and writes the results in batches.
+
+        Args:
+            instances_collection (pymongo.collection.Collection): The instances collection.
+            candidates (list): Instance documents to probe.
+
+        Returns:
+            dict: Counts of 'probed', 'unreachable', 'no_public_timeline', 'inconclusive' and 'enabled' instances.
+        """
+        stats = {'probed': 0, 'unreachable': 0, 'no_public_timeline': 0, 'inconclusive': 0, 'enabled': 0}
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        pending_updates = []
+
+        async def probe(session, instance_info):
+            async with semaphore:
+                return instance_info, await self.probe_instance(session, instance_info['name'])
+
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            tasks = [asyncio.create_task(probe(session, instance_info)) for instance_info in candidates]
+            for task in asyncio.as_completed(tasks):
+                instance_info, result = await task
+                stats['probed'] += 1
+                if is_inconclusive(result):
+                    stats['inconclusive'] += 1
+                elif not result['reachable']:
+                    stats['unreachable'] += 1
+                elif not result['public_timeline']:
+                    stats['no_public_timeline'] += 1
+                elif instance_info.get('probe', {}).get('disabled'):
+                    stats['enabled'] += 1
+                pending_updates.append(build_probe_update(instance_info, result))
+                if len(pending_updates) >= self.batch_size:
+                    await asyncio.to_thread(instances_collection.bulk_write, pending_updates, ordered=False)
+                    pending_updates = []
+        if pending_updates:
+            await asyncio.to_thread(instances_collection.bulk_write, pending_updates, ordered=False)
+        return stats
+
+def main():
+    """
+    Main function to probe all instances before the crawl.
+    """
+    parser = argparse.ArgumentParser(description='Mastodon Instance Probe')
+    parser.add_argument('--concurrency', type=int, default=500, help='Maximum instances probed at once')
+    parser.add_argument('--timeout', type=int, default=5, help='Request timeout in seconds')
+    parser.add_argument('--ttl', type=int, default=86400, help='Seconds a probe result stays valid')
+    args = parser.parse_args()
+
+    config = Config()
+    client = MongoClient(config.get_central_mongodb_uri())
+    instances_collection = client['mastodon']['instances']
+    ensure_probe_indexes(instances_collection)
+
+    with open(config.paths.get('token_list', 'tokens/token_list.txt'), 'r', encoding='utf-8') as f:
+        tokens = f.read().splitlines()
+    token_pool = create_token_pool(tokens, 'host', email=config.api.get('email', ''))
+
+    candidates = probe_candidates(instances_collection, args.ttl)
+    logger.info(f"Probing {len(candidates)} instances.")
+    prober = InstanceProber(token_pool, scheme=config.api.get('scheme', 'https'),
+                            max_concurrency=args.concurrency, timeout=args.timeout)
+    stats = asyncio.run(prober.run(instances_collection, candidates))
+    logger.info(
+        f"Probed {stats['probed']} instances: {stats['unreachable']} unreachable, "
+        f"{stats['no_public_timeline']} without public timeline, {stats['inconclusive']} inconclusive, "
+        f"{stats['enabled']} enabled again."
+    )
+    client.close()
+
+if __name__ == "__main__":
+    main()
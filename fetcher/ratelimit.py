@@ -0,0 +1,402 @@
+# fetcher/ratelimit.py
+import math
+import time
+import threading
+import logging
+from utils import parse_ratelimit_reset
+
+logger = logging.getLogger(__name__)
+
+class MongoBucketStore:
+    """
+    Dictionary-like store that keeps rate limit state in a MongoDB collection,
+    so that the workers of every host share the same buckets.
+    """
+    def __init__(self, collection, kind):
+        """
+        Args:
+            collection (pymongo.collection.Collection): The collection holding the state.
+            kind (str): Kind of entries kept by this store, e.g. 'bucket' or 'blocked'.
+        """
+        self.collection = collection
+        self.kind = kind
+
+    def get(self, key, default=None):
+        doc = self.collection.find_one({"_id": f"{self.kind}:{key}"})
+        return doc['value'] if doc else default
+
+    def __setitem__(self, key, value):
+        self.collection.update_one(
+            {"_id": f"{self.kind}:{key}"},
+            {"$set": {"kind": self.kind, "key": key, "value": value}},
+            upsert=True
+        )
+
+    def __contains__(self, key):
+        return self.collection.count_documents({"_id": f"{self.kind}:{key}"}, limit=1) > 0
+
+    def pop(self, key, default=None):
+        doc = self.collection.find_one_and_delete({"_id": f"{self.kind}:{key}"})
+        return doc['value'] if doc else default
+
+    def items(self):
+        return [(doc['key'], doc['value']) for doc in self.collection.find({"kind": self.kind})]
+
+# Bucket key of requests sent without a token.
+ANONYMOUS = 'anonymous'
+
+class RateLimitRegistry:
+    """
+    Token bucket per instance and token built from the 'x-ratelimit-*' headers and shared by all worker processes.
+    The buckets of all tokens of an instance are kept in one entry, so a single lookup, one IPC call
+    or one query, returns the state of every token and the token to use is chosen locally.
+    Requests are spaced out once the remaining budget runs low, so the budget lasts until the reset
+    instead of being exhausted and waited out. Tokens whose budget is exhausted are listed as
+    blocked until the reset, so workers can pick other work; tokens rejected by an instance are retired
+    for it.
+    """
+    def __init__(self, buckets=None, blocked=None, lock=None, default_limit=300, pace_below=0.5, safety_margin=5):
+        """
+        Args:
+            buckets (dict-like, optional): Shared store of the buckets by instance. Defaults to a process-local dict.
+            blocked (dict-like, optional): Shared store of the blocked tokens by instance. Defaults to a process-local dict.
+            lock (Lock, optional): Lock guarding the stores. Defaults to a threading.Lock.
+            default_limit (int, optional): Budget assumed before the first response. Defaults to 300.
+            pace_below (float, optional): Fraction of the budget below which requests are spaced out. Defaults to 0.5.
+            safety_margin (int, optional): Requests kept in reserve for other clients of the token. Defaults to 5.
+        """
+        self.buckets = buckets if buckets is not None else {}
+        self.blocked = blocked if blocked is not None else {}
+        self.lock = lock if lock is not None else threading.Lock()
+        self.default_limit = default_limit
+        self.pace_below = pace_below
+        self.safety_margin = safety_margin
+
+    @classmethod
+    def from_manager(cls, manager, **kwargs):
+        """
+        Creates a registry shared by all processes of a host.
+
+        Args:
+            manager (multiprocessing.managers.SyncManager): A started multiprocessing manager.
+
+        Returns:
+            RateLimitRegistry: The registry.
+        """
+        return cls(manager.dict(), manager.dict(), manager.Lock(), **kwargs)
+
+    @classmethod
+    def from_mongo(cls, collection, **kwargs):
+        """
+        Creates a registry shared by all hosts through a MongoDB collection.
+        Updates from different hosts are not serialized, so the budget is tracked approximately.
+
+        Args:
+            collection (pymongo.collection.Collection): The collection holding the state.
+
+        Returns:
+            RateLimitRegistry: The registry.
+        """
+        return cls(MongoBucketStore(collection, 'token_buckets'), MongoBucketStore(collection, 'blocked_tokens'), **kwargs)
+
+    def _refresh(self, bucket, now):
+        if bucket is None or (bucket['reset'] and now >= bucket['reset']):
+            limit = bucket['limit'] if bucket else self.default_limit
+            bucket = {'limit': limit, 'remaining': limit, 'reset': None, 'next_at': 0,
+                      'blocked_until': bucket['blocked_until'] if bucket else 0,
+                      'retired': bucket['retired'] if bucket else False}
+        return bucket
+
+    def _get_buckets(self, instance, now):
+        return {token_id: self._refresh(bucket, now) for token_id, bucket in (self.buckets.get(instance) or {}).items()}
+
+    def _start(self, bucket, now):
+        start = max(now, bucket['next_at'], bucket['blocked_until'])
+        if bucket['reset'] and bucket['remaining'] - self.safety_margin <= 0:
+            start = max(start, bucket['reset'])
+        return start
+
+    def _block(self, instance, token_id, until):
+        blocked = self.blocked.get(instance) or {}
+        blocked[token_id] = max(blocked.get(token_id, 0), until)
+        self.blocked[instance] = blocked
+
+    def reserve(self, instance, token_ids):
+        """
+        Picks the token that can be used soonest on an instance and takes one request from its bucket.
+        Ties are broken by the remaining budget, so load spreads over all tokens. Retired tokens are
+        skipped, and the request is sent without a token if every token is retired.
+
+        Args:
+            instance (str): Instance name.
+            token_ids (list): Fingerprints of the tokens of the pool.
+
+        Returns:
+            tuple: The fingerprint of the chosen token (ANONYMOUS for none) and the seconds to wait before sending.
+        """
+        now = time.time()
+        with self.lock:
+            buckets = self._get_buckets(instance, now)
+            candidates = [token_id for token_id in token_ids if not buckets.get(token_id, {}).get('retired')]
+            states = {token_id: buckets.get(token_id) or self._refresh(None, now) for token_id in candidates or [ANONYMOUS]}
+            token_id = min(states, key=lambda t: (self._start(states[t], now), -states[t]['remaining']))
+            bucket = states[token_id]
+            start = self._start(bucket, now)
+            usable = bucket['remaining'] - self.safety_margin
+            if bucket['reset'] and usable > 0 and bucket['remaining'] < bucket['limit'] * self.pace_below:
+                bucket['next_at'] = start + max(bucket['reset'] - now, 0) / usable
+            bucket['remaining'] -= 1
+            buckets[token_id] = bucket
+            self.buckets[instance] = buckets
+        return token_id, start - now
+
+    def update(self, instance, token_id, res_headers):
+        """
+        Updates the bucket of a token from the rate limit headers of a response.
+
+        Args:
+            instance (str): Instance name.
+            token_id (str): Token fingerprint, or ANONYMOUS.
+            res_headers (dict): Lower-cased response headers from the API.
+        """
+        if 'x-ratelimit-remaining' not in res_headers:
+            return
+        reset = parse_ratelimit_reset(res_headers)
+        now = time.time()
+        with self.lock:
+            buckets = self._get_buckets(instance, now)
+            bucket = buckets.get(token_id) or self._refresh(None, now)
+            bucket['remaining'] = int(res_headers['x-ratelimit-remaining'])
+            bucket['limit'] = int(res_headers.get('x-ratelimit-limit', bucket['limit']))
+            if reset:
+                bucket['reset'] = reset.timestamp()
+            buckets[token_id] = bucket
+            self.buckets[instance] = buckets
+            if bucket['reset'] and bucket['remaining'] <= self.safety_margin:
+                self._block(instance, token_id, bucket['reset'])
+                logger.info(f"[{instance}#{token_id}] Rate limit budget exhausted until {reset.isoformat() if reset else bucket['reset']}")
+
+    def penalize(self, instance, token_id, seconds):
+        """
+        Blocks the bucket of a token for a fixed time, e.g. after repeated 429 or 503 responses.
+
+        Args:
+            instance (str): Instance name.
+            token_id (str): Token fingerprint, or ANONYMOUS.
+            seconds (float): Seconds to block the bucket for.
+        """
+        now = time.time()
+        with self.lock:
+            buckets = self._get_buckets(instance, now)
+            bucket = buckets.get(token_id) or self._refresh(None, now)
+            bucket['blocked_until'] = max(bucket['blocked_until'], now + seconds)
+            buckets[token_id] = bucket
+            self.buckets[instance] = buckets
+            self._block(instance, token_id, bucket['blocked_until'])
+        logger.info(f"[{instance}#{token_id}] Blocked for {seconds} seconds")
+
+    def retire(self, instance, token_id):
+        """
+        Stops using a token on an instance, e.g. after the instance rejected it with 401.
+
+        Args:
+            instance (str): Instance name.
+            token_id (str): Token fingerprint.
+        """
+        now = time.time()
+        with self.lock:
+            buckets = self._get_buckets(instance, now)
+            bucket = buckets.get(token_id) or self._refresh(None, now)
+            bucket['retired'] = True
+            buckets[token_id] = bucket
+            self.buckets[instance] = buckets
+            self._block(instance, token_id, math.inf)
+
+    def blocked_tokens(self):
+        """
+        Returns the tokens that are currently blocked or retired on each instance, with a single read of
+        the store, and drops the expired blocks.
+
+        Returns:
+            dict: Token fingerprints by instance name; retired tokens are blocked until math.inf.
+        """
+        now = time.time()
+        limited = {}
+        with self.lock:
+            for instance, tokens in list(self.blocked.items()):
+                active = {token_id: until for token_id, until in tokens.items() if until > now}
+                if not active:
+                    self.blocked.pop(instance, None)
+                    continue
+                limited[instance] = active
+                if len(active) < len(tokens):
+                    self.blocked[instance] = active
+        return limited
+
+OVERLOAD_CODES = {429, 502, 503, 504}
+
+class AdaptiveController:
+    """
+    AIMD controller of the load put on each instance, shared by all worker processes.
+    Every instance has a window, the number of requests it is allowed to have in flight. Requests
+    are spaced by the smoothed latency divided by the window, so a window below one leaves gaps
+    between requests. The window grows additively while responses are fast and healthy, and is cut
+    multiplicatively, at most once per round trip, on 429/502/503/504, timeouts or when the smoothed
+    latency rises above latency_factor times the lowest latency seen.
+    """
+    def __init__(self, states=None, lock=None, initial_window=2, min_window=0.25, max_window=32,
+                 increase=1, decrease=0.5, latency_factor=3, smoothing=0.2):
+        """
+        Args:
+            states (dict-like, optional): Shared store of the instance states. Defaults to a process-local dict.
+            lock (Lock, optional): Lock guarding the store. Defaults to a threading.Lock.
+            initial_window (float, optional): Window of an instance before the first response. Defaults to 2.
+            min_window (float, optional): Smallest window. Defaults to 0.25.
+            max_window (float, optional): Largest window. Defaults to 32.
+            increase (float, optional): Window added per round trip while the instance is healthy. Defaults to 1.
+            decrease (float, optional): Factor the window is multiplied with on overload. Defaults to 0.5.
+            latency_factor (float, optional): Smoothed latency, relative to the lowest one, treated as overload.
+                Defaults to 3.
+            smoothing (float, optional): Weight of a new latency sample in the smoothed latency. Defaults to 0.2.
+        """
+        self.states = states if states is not None else {}
+        self.lock = lock if lock is not None else threading.Lock()
+        self.initial_window = initial_window
+        self.min_window = min_window
+        self.max_window = max_window
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.smoothing = smoothing
+
+    @classmethod
+    def from_manager(cls, manager, **kwargs):
+        """
+        Creates a controller shared by all processes of a host.
+
+        Args:
+            manager (multiprocessing.managers.SyncManager): A started multiprocessing manager.
+
+        Returns:
+            AdaptiveController: The controller.
+        """
+        return cls(manager.dict(), manager.Lock(), **kwargs)
+
+    @classmethod
+    def from_mongo(cls, collection, **kwargs):
+        """
+        Creates a controller shared by all hosts through a MongoDB collection.
+
+        Args:
+            collection (pymongo.collection.Collection): The collection holding the state.
+
+        Returns:
+            AdaptiveController: The controller.
+        """
+        return cls(MongoBucketStore(collection, 'window'), **kwargs)
+
+    def _get_state(self, instance):
+        state = self.states.get(instance)
+        if state is None:
+            state = {'window': self.initial_window, 'latency': None, 'base': None, 'next_at': 0, 'cut_at': 0}
+        return state
+
+    def reserve(self, instance):
+        """
+        Schedules a request to an instance and returns how long to wait before sending it.
+
+        Args:
+            instance (str): Instance name.
+
+        Returns:
+            float: Seconds to wait before sending the request.
+        """
+        now = time.time()
+        with self.lock:
+            state = self._get_state(instance)
+            start = max(now, state['next_at'])
+            if state['latency']:
+                state['next_at'] = start + state['latency'] / state['window']
+                self.states[instance] = state
+        return start - now
+
+    def observe(self, instance, status_code, latency=None):
+        """
+        Adjusts the window of an instance from the outcome of a request.
+
+        Args:
+            instance (str): Instance name.
+            status_code (int or str): HTTP status code, or 'timeout'.
+            latency (float, optional): Seconds the request took, None if unknown.
+        """
+        now = time.time()
+        with self.lock:
+            state = self._get_state(instance)
+            if latency is not None and status_code not in OVERLOAD_CODES:
+                state['latency'] = latency if state['latency'] is None else (
+                    (1 - self.smoothing) * state['latency'] + self.smoothing * latency
+                )
+                state['base'] = latency if state['base'] is None else min(state['base'], latency)
+            slow = state['base'] and state['latency'] > self.latency_factor * max(state['base'], 0.01)
+            if status_code == 'timeout' or status_code in OVERLOAD_CODES or slow:
+                if now - state['cut_at'] >= (state['latency'] or 1):
+                    state['window'] = max(self.min_window, state['window'] * self.decrease)
+                    state['cut_at'] = now
+                    state['next_at'] = max(state['next_at'], now + (state['latency'] or 1) / state['window'])
+                    logger.debug(f"[{instance}] Overloaded ({status_code}), window cut to {state['window']:.2f}")
+                if slow:
+                    # Let the lowest latency drift up, so a lasting change of the instance is accepted.
+                    state['base'] *= 1 + self.smoothing
+            else:
+                state['window'] = min(self.max_window, state['window'] + self.increase / state['window'])
+            self.states[instance] = state
+
+    def window(self, instance):
+        """
+        Returns the current window of an instance.
+
+        Args:
+            instance (str): Instance name.
+
+        Returns:
+            float: Requests allowed in flight.
+        """
+        return self._get_state(instance)['window']
+
+def create_controller(mode, manager=None, central_db=None, **kwargs):
+    """
+    Creates the adaptive controller for a worker, shared like the rate limit registry.
+
+    Args:
+        mode (str): 'host' or 'cluster', as for create_registry.
+        manager (multiprocessing.managers.SyncManager, optional): Manager used in 'host' mode.
+        central_db (pymongo.database.Database, optional): Central database used in 'cluster' mode.
+
+    Returns:
+        AdaptiveController: The controller.
+    """
+    if mode == 'cluster':
+        return AdaptiveController.from_mongo(central_db['ratelimits'], **kwargs)
+    if manager is None:
+        return AdaptiveController(**kwargs)
+    return AdaptiveController.from_manager(manager, **kwargs)
+
+def create_registry(mode, manager=None, central_db=None, **kwargs):
+    """
+    Creates the rate limit registry for a worker.
+
+    Args:
+        mode (str): 'host' to share it between the processes of this host, 'cluster' to share it
+            between all hosts through the central MongoDB.
+        manager (multiprocessing.managers.SyncManager, optional): Manager used in 'host' mode.
+            Without a manager the registry is local to the calling process, e.g. for the async engine.
+        central_db (pymongo.database.Database, optional): Central database used in 'cluster' mode.
+
+    Returns:
+        RateLimitRegistry: The registry.
+    """
+    if mode == 'cluster':
+        return RateLimitRegistry.from_mongo(central_db['ratelimits'], **kwargs)
+    if manager is None:
+        return RateLimitRegistry(**kwargs)
+    return RateLimitRegistry.from_manager(manager, **kwargs)
@@ -1,111 +1,309 @@
 # fetcher/reblog_favourite.py
 import requests
 import time
-import re
-from datetime import datetime, timezone, timedelta
 import argparse
 from pymongo import MongoClient
-from pymongo.errors import DuplicateKeyError
-from multiprocessing import Process
+from multiprocessing import Process, Manager
 import logging
-import random
-from utils import judge_sleep_limit_table, judge_api_islimit, save_error_log, create_unique_index
+from utils import save_error_log, create_unique_index, parse_next_max_id, transform_ISO2datetime, instance_url
 from config import Config
+from writer import flush_writers, close_writers
+from storage import create_storage, minimal_account
+from token_pool import create_token_pool
+from task_queue import StatusQueue, ensure_status_indexes
+from scheduler import Heartbeat
+from retry import crawl_error, create_retry_policy, ensure_dead_letter_indexes
+from metrics import metrics, record_request, start_reporter, start_http_server
 
 logger = logging.getLogger(__name__)
 
-limit_dict = {}
-limit_set = set()
+MAX_RESERVE_WAIT = 10
+LIMIT_PENALTY = 300
+ENGAGEMENT_PAGE_SIZE = 80
+ENGAGEMENT_ENDPOINTS = [('reblogs', 'reblogs_count', 'reblogged_by'), ('favourites', 'favourites_count', 'favourited_by')]
 
-def get_favourite_boost(pid, instance, status_id, headers, local_collections):
+def plan_engagement(status, trust_counts_after=3600):
+    """
+    Plans the engagement requests of a status from the counts stored with it.
+    Counts are trusted if the status was at least trust_counts_after seconds old when it was stored;
+    endpoints with a trusted count of zero are skipped and the others are paged until the count is reached.
+    
+    Args:
+        status (dict): Status stored in the livefeeds collection.
+        trust_counts_after (int, optional): Minimum age in seconds of a status at load time for its counts
+            to be trusted. Defaults to 3600.
+    
+    Returns:
+        dict: Expected number of accounts per endpoint ('reblogs', 'favourites'), None if unknown.
+            Skipped endpoints are left out.
+    """
+    trusted = False
+    try:
+        age = status['loadtime'] - transform_ISO2datetime(status['created_at'])
+        trusted = age.total_seconds() >= trust_counts_after
+    except (KeyError, ValueError):
+        pass
+    plan = {}
+    for kind, count_field, _ in ENGAGEMENT_ENDPOINTS:
+        count = status.get(count_field)
+        if not trusted or count is None:
+            plan[kind] = None
+        elif count > 0:
+            plan[kind] = count
+    return plan
+
+def ensure_engagement_indexes(collection):
+    """
+    Creates the unique 'bid' index of the engagement buckets.
+    Collections written before engagements were bucketed have to be converted with
+    migrate_engagement_buckets ('--migrate') first.
+
+    Args:
+        collection (pymongo.collection.Collection): The boostersfavourites collection.
+
+    Raises:
+        RuntimeError: If the collection still holds documents without buckets.
+    """
+    indexes = collection.index_information()
+    if 'sid_1' in indexes or ('bid_1' not in indexes and collection.find_one({"bid": {"$exists": False}}, {"_id": 1})):
+        raise RuntimeError(f"Collection '{collection.name}' holds engagements written before bucketing, "
+                           f"run 'python ./fetcher/reblog_favourite.py --migrate local' (or 'central') first.")
+    create_unique_index(collection, 'bid')
+    collection.create_index([("sid", 1), ("seq", 1)], name="sid_seq")
+
+def migrate_engagement_buckets(collection):
+    """
+    Converts a boostersfavourites collection written before engagements were bucketed. Every document
+    without a 'bid' becomes bucket 0 of its status, and the unique 'sid' index is replaced by the bucket
+    indexes, since a status can now have several buckets. Running it again changes nothing.
+    Requires MongoDB 4.2 or newer, which runs the update pipeline.
+
+    Args:
+        collection (pymongo.collection.Collection): The boostersfavourites collection.
+
+    Returns:
+        int: Number of documents converted.
+    """
+    result = collection.update_many({"bid": {"$exists": False}}, [{"$set": {"seq": 0, "bid": {"$concat": ["$sid", "#0"]}}}])
+    if 'sid_1' in collection.index_information():
+        collection.drop_index('sid_1')
+    ensure_engagement_indexes(collection)
+    logger.info(f"Converted {result.modified_count} documents of '{collection.name}' to bucket 0 of their status.")
+    return result.modified_count
+
+def ensure_checkpoint_indexes(collection):
+    """
+    Creates the index used to look up the engagement checkpoint of a status.
+
+    Args:
+        collection (pymongo.collection.Collection): The engagement_checkpoints collection.
+    """
+    collection.create_index([("sid", 1)], name="sid", unique=True)
+    logger.info(f"Checkpoint indexes ensured for collection '{collection.name}'.")
+
+def load_engagement_checkpoint(collection, sid):
+    """
+    Loads the progress of a status that an earlier worker checkpointed before it stopped.
+
+    Args:
+        collection (pymongo.collection.Collection): The engagement_checkpoints collection.
+        sid (str): 'instance#status_id' of the status.
+
+    Returns:
+        dict or None: 'seq' of the next bucket and per endpoint ('reblogs', 'favourites') under 'endpoints'
+            the 'cursor' of the next page, the 'count' of accounts written and whether it is 'done'.
+    """
+    checkpoint = collection.find_one({"sid": sid})
+    if checkpoint:
+        logger.info(f"Resuming {sid} from bucket {checkpoint['seq']}.")
+    return checkpoint
+
+def save_engagement_checkpoint(collection, sid, seq, endpoints):
+    """
+    Stores the progress of a status after one of its buckets was written.
+
+    Args:
+        collection (pymongo.collection.Collection): The engagement_checkpoints collection.
+        sid (str): 'instance#status_id' of the status.
+        seq (int): Sequence number of the next bucket.
+        endpoints (dict): Per endpoint the 'cursor' of the next page, the 'count' of accounts and 'done'.
+    """
+    collection.update_one({"sid": sid}, {"$set": {"seq": seq, "endpoints": endpoints}}, upsert=True)
+
+class EngagementBuckets:
+    """
+    Collects the rebloggers and favouriters of a status into buckets of about bucket_size accounts.
+    Each bucket is written as its own boostersfavourites document ('sid', 'seq', 'bid', 'reblogs',
+    'favourites'), so neither the memory of a worker nor the size of a document grows with the
+    number of engagers. Statuses with fewer engagers are stored in a single bucket.
+    """
+    def __init__(self, sid, writer, bucket_size=1000, seq=0, minimal=False):
+        """
+        Args:
+            sid (str): 'instance#status_id' of the status.
+            writer (Writer): Writer of the boostersfavourites collection.
+            bucket_size (int, optional): Accounts after which a bucket is written. Defaults to 1000.
+            seq (int, optional): Sequence number of the first bucket. Defaults to 0.
+            minimal (bool, optional): Keep only ENGAGER_FIELDS of every account. Defaults to False.
+        """
+        self.sid = sid
+        self.writer = writer
+        self.bucket_size = bucket_size
+        self.seq = seq
+        self.minimal = minimal
+        self.bucket = {'reblogs': [], 'favourites': []}
+
+    def __len__(self):
+        return len(self.bucket['reblogs']) + len(self.bucket['favourites'])
+
+    def add(self, kind, accounts):
+        if self.minimal:
+            accounts = [minimal_account(account) for account in accounts]
+        self.bucket[kind].extend(accounts)
+
+    def full(self):
+        return len(self) >= self.bucket_size
+
+    def write(self):
+        """
+        Queues the current bucket unless it is empty and starts the next one.
+
+        Returns:
+            bool: True if a bucket was queued.
+        """
+        if not len(self):
+            return False
+        self.writer.write({"sid": self.sid, "seq": self.seq, "bid": f"{self.sid}#{self.seq}", **self.bucket})
+        logger.debug(f"Queued bucket {self.seq} of reblogs and favourites for {self.sid}.")
+        self.seq += 1
+        self.bucket = {'reblogs': [], 'favourites': []}
+        return True
+
+def get_favourite_boost(pid, instance, status_id, token_pool, local_collections, plan=None, scheme='https',
+                        bucket_size=1000, minimal=False):
     """
     Fetches reblogs and favourites for a specific status.
+    Gives the status back instead of waiting if every token's rate limit budget on the instance is exhausted.
+    Engagers are written in buckets of about bucket_size accounts while the pages are fetched. If
+    local_collections has 'engagement_checkpoints', the writer is flushed and the cursor of every endpoint
+    is stored after each bucket, and a status given back or left behind by a crashed worker continues
+    from the bucket after its last checkpoint when it is claimed again.
+    Without a checkpoint, a status that is claimed again restarts at bucket 0. Buckets an earlier attempt
+    wrote keep their contents, since their 'bid' exists, so if the engagers changed in between, the
+    buckets of the two attempts can overlap or leave gaps. This only happens without the
+    engagement_checkpoints collection or if a worker died before its first bucket was checkpointed.
     
     Args:
         pid (int): Process ID.
         instance (str): Mastodon instance name.
         status_id (str): ID of the status (tweet).
-        headers (dict): HTTP headers for the request.
-        local_collections (dict): Local MongoDB collections.
+        token_pool (TokenPool): Pool of API tokens shared by all processes.
+        local_collections (dict): Local MongoDB collections, with 'boostersfavourites' and 'error_log' as BufferedWriters.
+        plan (dict, optional): Expected accounts per endpoint from plan_engagement. Defaults to fetching both endpoints in full.
+        scheme (str, optional): URL scheme of the instance API. Defaults to 'https'.
+        bucket_size (int, optional): Accounts per bucket. Defaults to 1000.
+        minimal (bool, optional): Store only the 'id' and 'acct' of every account. Defaults to False.
     
     Returns:
-        bool: True if successful, False otherwise.
+        dict or None: None if successful, otherwise the error from retry.crawl_error; the code 'deferred'
+            with the 'delay' in seconds if the status was given back because of the rate limit.
     """
-    reblog_url = f"https://{instance}/api/v1/statuses/{status_id}/reblogged_by"
-    favourite_url = f"https://{instance}/api/v1/statuses/{status_id}/favourited_by"
+    if plan is None:
+        plan = {'reblogs': None, 'favourites': None}
     
-    reblogs = []
-    favourites = []
-    last_page_flag = -1
+    sid = f"{instance}#{status_id}"
+    checkpoints = local_collections.get('engagement_checkpoints')
+    checkpoint = load_engagement_checkpoint(checkpoints, sid) if checkpoints is not None else None
+    checkpointed = checkpoint is not None
+    endpoints = checkpoint['endpoints'] if checkpointed else {}
+    buckets = EngagementBuckets(sid, local_collections['boostersfavourites'], bucket_size,
+                                seq=checkpoint['seq'] if checkpointed else 0, minimal=minimal)
     retry_thresh = 4
     
-    for url, storage in [(reblog_url, reblogs), (favourite_url, favourites)]:
+    for kind, _, endpoint in ENGAGEMENT_ENDPOINTS:
+        if kind not in plan:
+            continue
+        state = endpoints.setdefault(kind, {'cursor': -1, 'count': 0, 'done': False})
+        if state['done']:
+            continue
+        url = instance_url(instance, f"/api/v1/statuses/{status_id}/{endpoint}", scheme)
+        expected = plan[kind]
         retry_time = 0
-        while True:
-            params = {'limit': 40}
-            if last_page_flag != -1:
-                params['max_id'] = last_page_flag
+        while not state['done']:
+            params = {'limit': ENGAGEMENT_PAGE_SIZE}
+            if state['cursor'] != -1:
+                params['max_id'] = state['cursor']
             try:
-                response = requests.get(url, headers=headers, params=params, timeout=5)
+                token, wait_time = token_pool.lease(instance)
+                if wait_time > MAX_RESERVE_WAIT:
+                    logger.info(f"Rate limit budget of {instance} exhausted, deferring {instance}#{status_id}.")
+                    return dict(crawl_error('deferred'), delay=wait_time)
+                if wait_time > 0:
+                    metrics.inc('ratelimit_sleep_seconds_total', wait_time)
+                    time.sleep(wait_time)
+                request_start = time.monotonic()
+                response = requests.get(url, headers=token_pool.headers(token), params=params, timeout=5)
+                latency = time.monotonic() - request_start
+                record_request(response.status_code, latency, 'engagement')
+                res_headers = {k.lower(): v for k, v in response.headers.items()}
+                token_pool.report(instance, token, response.status_code, res_headers, latency)
                 if response.status_code == 200:
-                    res_headers = {k.lower(): v for k, v in response.headers.items()}
-                    judge_sleep_limit_table(res_headers, instance,limit_dict,limit_set)
                     data = response.json()
-                    storage.extend(data)
-                    if 'link' not in res_headers or len(data) < 40:
-                        break
-                    match = re.search(r'max_id=(\d+)', res_headers.get('link', ''))
-                    if match:
-                        last_page_flag = match.group(1)
+                    buckets.add(kind, data)
+                    state['count'] += len(data)
+                    next_max_id = parse_next_max_id(res_headers) if 'link' in res_headers else None
+                    state['done'] = (len(data) < ENGAGEMENT_PAGE_SIZE or not next_max_id
+                                     or (expected is not None and state['count'] >= expected))
+                    if next_max_id:
+                        state['cursor'] = next_max_id
+                    if buckets.full():
+                        buckets.write()
+                        if checkpoints is not None:
+                            local_collections['boostersfavourites'].flush()
+                            save_engagement_checkpoint(checkpoints, sid, buckets.seq, endpoints)
+                            checkpointed = True
+                elif response.status_code == 401 and token:
+                    logger.warning(f"Token rejected by {instance}, retrying with another token...")
                 elif response.status_code in [503, 429]:
                     retry_time += 1
-                    time.sleep(random.random())
+                    metrics.inc('retries_total', code=response.status_code)
                     logger.warning("Encountered 429 or 503 error, retrying...")
                     if retry_time > retry_thresh:
-                        limit_set.add(instance)
-                        limit_dict[instance] = datetime.now(timezone.utc) + timedelta(minutes=5)
+                        token_pool.penalize(instance, token, LIMIT_PENALTY)
                         save_error_log(local_collections['error_log'], "booster_favouriter", f"{instance}#{status_id}", "429or503", error_message=response.text)
-                        return False
+                        return crawl_error(response.status_code, response.text)
                 else:
                     save_error_log(local_collections['error_log'], "booster_favouriter", f"{instance}#{status_id}", "Error", res_code=response.status_code, error_message=response.text)
                     logger.error(f"Error fetching reblogs/favourites for {instance}#{status_id}: {response.status_code}")
-                    return False
+                    return crawl_error(response.status_code, response.text)
             except requests.exceptions.Timeout:
                 retry_time += 1
-                time.sleep(0.1)
+                record_request('timeout', time.monotonic() - request_start, 'engagement')
+                token_pool.report_timeout(instance)
                 logger.warning("Request timed out, retrying...")
                 if retry_time > retry_thresh:
                     save_error_log(local_collections['error_log'], "booster_favouriter", f"{instance}#{status_id}", "TimeOut")
-                    return False
+                    return crawl_error('timeout')
             except Exception as e:
                 save_error_log(local_collections['error_log'], "booster_favouriter", f"{instance}#{status_id}", "Error", error_message=str(e))
                 logger.exception(f"Exception while connecting to {instance}#{status_id}: {e}")
-                return False
+                return crawl_error('exception', str(e))
     
-    if reblogs or favourites:
-        sid = f"{instance}#{status_id}"
-        try:
-            local_collections['boostersfavourites'].insert_one({
-                "sid": sid,
-                "reblogs": reblogs,
-                "favourites": favourites
-            })
-            logger.info(f"Successfully saved reblogs and favourites for {sid}.")
-        except DuplicateKeyError:
-            logger.warning(f"Reblogs and favourites for {sid} already exist, skipping.")
-        except Exception as e:
-            logger.error(f"Error saving reblogs/favourites for {sid}: {e}")
+    buckets.write()
+    if checkpointed:
+        local_collections['boostersfavourites'].flush()
+        checkpoints.delete_one({"sid": sid})
     
-    return True
+    return None
 
-def fetch_status_id(local_livefeeds_collection, limit_set, local_collections, retry_thresh=10):
+def fetch_status_id(status_queue, token_pool, retry_thresh=10):
     """
-    Fetches a status ID from the livefeeds collection that is pending processing.
+    Fetches a status that is pending processing from the prefetch queue of claimed statuses.
+    Statuses of instances on which every token is rate limited are skipped.
     
     Args:
-        local_livefeeds_collection (pymongo.collection.Collection): The livefeeds collection.
-        limit_set (set): Set of instances under rate limit.
-        local_collections (dict): Local MongoDB collections.
+        status_queue (StatusQueue): Queue claiming statuses from the livefeeds collection.
+        token_pool (TokenPool): Pool of API tokens shared by all processes.
         retry_thresh (int, optional): Retry threshold. Defaults to 10.
     
     Returns:
@@ -113,31 +311,22 @@ def fetch_status_id(local_livefeeds_collection, limit_set, local_collections, re
     """
     retry_time = 0
     while True:
-        judge_api_islimit(limit_dict,limit_set)
-        candidates = list(local_livefeeds_collection.find(
-            {
-                "status": "pending",
-                "instance_name": {"$nin": list(limit_set)}
-            }
-        ).limit(5))
-        if not candidates and not limit_set:
-            logger.info("No eligible statuses found and limit_set is empty. Terminating task.")
+        limited = token_pool.limited_instances()
+        status = status_queue.get(limited)
+        if status:
+            logger.debug(f"Found status ID: {status['instance_name']}#{status['id']}")
+            return status
+        if not limited:
+            logger.info("No eligible statuses found and no instance is rate limited. Terminating task.")
             return None
-        for candidate in candidates:
-            batch = local_livefeeds_collection.find_one_and_update(
-                {"_id": candidate["_id"], "status": "pending"},
-                {"$set": {"status": "read"}}
-            )
-            if batch:
-                logger.info(f"Found status ID: {batch['instance_name']}#{batch['id']}")
-                return batch
         logger.info(f"No matching statuses found, retrying... Attempt {retry_time}")
         time.sleep(2)
         retry_time += 1
         if retry_time >= retry_thresh:
             return None
 
-def process_task(worker_id, config, local_collections, tokens, terminate_flag):
+def process_task(worker_id, config, local_collections, token_pool, terminate_flag, batch_size=20, lease_seconds=600,
+                 idle_sleep=60, bucket_size=None, metrics_store=None):
     """
     Worker process task for fetching reblogs and favourites.
     
@@ -145,29 +334,52 @@ def process_task(worker_id, config, local_collections, tokens, terminate_flag):
         worker_id (int): ID of this host.
         config (Config): Configuration object.
         local_collections (dict): Local MongoDB collections.
-        tokens (list): List of API tokens.
+        token_pool (TokenPool): Pool of API tokens shared by all processes.
         terminate_flag (dict): Dictionary flag to terminate processes.
+        batch_size (int, optional): Number of statuses claimed at once. Defaults to 20.
+        lease_seconds (int, optional): Seconds after which an unfinished claim can be taken over. Defaults to 600.
+        idle_sleep (int, optional): Seconds to wait when no status is pending. Defaults to 60.
+        bucket_size (int, optional): Accounts per engagement bucket. Defaults to 'engagement.bucket_size'.
+        metrics_store (dict-like, optional): Shared store the metrics of this process are published to.
     """
-    while not terminate_flag['terminate']:
-        try:
-            info = fetch_status_id(local_collections['livefeeds'], limit_set, local_collections)
-            if info:
-                token = tokens[worker_id]
-                headers = {'Authorization': f'Bearer {token}', 'Email': config.api.get('email', '')}
-                success = get_favourite_boost(worker_id, info['instance_name'], info['id'], headers, local_collections)
-                if success:
-                    logger.info(f"Successfully fetched reblogs and favourites for {info['instance_name']}#{info['id']}")
+    local_collections = create_storage(local_collections, ['boostersfavourites', 'error_log'], config)
+    status_queue = StatusQueue(local_collections['livefeeds'], batch_size=batch_size, lease_seconds=lease_seconds,
+                               retry_policy=create_retry_policy(config.retry),
+                               dead_letters=local_collections.get('dead_letters'))
+    heartbeat = Heartbeat(status_queue)
+    heartbeat.start()
+    reporter = start_reporter(config.metrics, metrics_store, summarize=False) if metrics_store is not None else None
+    trust_counts_after = config.engagement.get('trust_counts_after', 3600)
+    bucket_size = bucket_size or config.engagement.get('bucket_size', 1000)
+    minimal = config.engagement.get('accounts', 'full') == 'ids'
+    try:
+        while not terminate_flag['terminate']:
+            try:
+                info = fetch_status_id(status_queue, token_pool)
+                if info:
+                    plan = plan_engagement(info, trust_counts_after)
+                    error = get_favourite_boost(worker_id, info['instance_name'], info['id'], token_pool, local_collections,
+                                                plan, config.api.get('scheme', 'https'), bucket_size, minimal)
+                    if error is None:
+                        status_queue.complete(info)
+                        logger.debug(f"Successfully fetched reblogs and favourites for {info['instance_name']}#{info['id']}")
+                    elif error['code'] == 'deferred':
+                        status_queue.defer(info, error['delay'])
+                    else:
+                        status_queue.retry(info, error)
                 else:
-                    local_collections['livefeeds'].update_one(
-                        {"_id": info["_id"]},
-                        {"$set": {"status": "pending"}}
-                    )
-            else:
-                logger.info("No pending statuses found, sleeping...")
-                time.sleep(60)
-        except Exception as e:
-            logger.exception(f"Exception during processing: {e}")
-            time.sleep(5)
+                    flush_writers(local_collections)
+                    logger.info("No pending statuses found, sleeping...")
+                    time.sleep(idle_sleep)
+            except Exception as e:
+                logger.exception(f"Exception during processing: {e}")
+                time.sleep(5)
+    finally:
+        heartbeat.stop()
+        status_queue.release_all()
+        close_writers(local_collections)
+        if reporter:
+            reporter.stop()
 
 def main():
     """
@@ -176,10 +388,31 @@ def main():
     parser = argparse.ArgumentParser(description='Mastodon Reblog and Favourite Worker')
     parser.add_argument('--processnum', type=int, default=1, help='Number of parallel processes')
     parser.add_argument('--worker_id', type=int, default=1, help='Number of parallel processes')
+    parser.add_argument('--ratelimit', type=str, default='host', choices=['host', 'cluster'], help='Share rate limits between the processes of this host or all hosts')
+    parser.add_argument('--batch_size', type=int, default=20, help='Number of statuses claimed at once')
+    parser.add_argument('--lease', type=int, default=600, help='Seconds after which an unfinished claim can be taken over')
+    parser.add_argument('--bucket_size', type=int, default=None, help='Accounts per engagement bucket, written and checkpointed as it fills (default from config)')
+    parser.add_argument('--metrics_port', type=int, default=None, help='Port of the Prometheus metrics endpoint, 0 to disable (default from config)')
+    parser.add_argument('--migrate', type=str, default=None, choices=['local', 'central'], help='Convert the local or central boostersfavourites collection to engagement buckets and exit')
     args = parser.parse_args()
     
     config = Config()
-
+    if args.migrate:
+        uri = config.get_local_mongodb_uri() if args.migrate == 'local' else config.get_central_mongodb_uri()
+        client = MongoClient(uri)
+        migrate_engagement_buckets(client['mastodon']['boostersfavourites'])
+        client.close()
+        return
+    if config.storage.get('sink', 'mongo') == 'file':
+        parser.error("storage.sink 'file' is not supported: toots are claimed from the local MongoDB livefeeds "
+                     "collection, which the file sink does not write. Collect engagements with 'sink: mongo'.")
+    metrics_port = args.metrics_port if args.metrics_port is not None else config.metrics.get('port', 0)
+    manager = Manager()
+    central_client = None
+    central_db = None
+    if args.ratelimit == 'cluster':
+        central_client = MongoClient(config.get_central_mongodb_uri())
+        central_db = central_client['mastodon']
     
     local_mongodb_uri = config.get_local_mongodb_uri()
     local_client = MongoClient(local_mongodb_uri)
@@ -187,23 +420,47 @@ def main():
     local_livefeeds_collection = local_db['livefeeds']
     local_error_collection = local_db['error_log']
     local_boostersfavourites_collection = local_db['boostersfavourites']
+    local_accounts_collection = local_db['accounts']
+    local_checkpoints_collection = local_db['engagement_checkpoints']
+    local_dead_letters_collection = local_db['dead_letters']
     
-    create_unique_index(local_boostersfavourites_collection, 'sid')
+    ensure_engagement_indexes(local_boostersfavourites_collection)
+    ensure_checkpoint_indexes(local_checkpoints_collection)
+    ensure_dead_letter_indexes(local_dead_letters_collection)
+    if config.storage.get('compact', False):
+        create_unique_index(local_accounts_collection, 'aid')
+    ensure_status_indexes(local_livefeeds_collection)
     
     with open(config.paths.get('token_list', 'tokens/token_list.txt'), 'r', encoding='utf-8') as f:
         tokens = f.read().splitlines()
+    token_pool = create_token_pool(tokens, args.ratelimit, email=config.api.get('email', ''),
+                                   manager=manager, central_db=central_db, adaptive=config.adaptive)
     
     local_collections = {
         'livefeeds': local_livefeeds_collection,
         'error_log': local_error_collection,
-        'boostersfavourites': local_boostersfavourites_collection
+        'boostersfavourites': local_boostersfavourites_collection,
+        'accounts': local_accounts_collection,
+        'engagement_checkpoints': local_checkpoints_collection,
+        'dead_letters': local_dead_letters_collection
     }
     
     terminate_flag = {'terminate': False}
     
+    metrics_store = manager.dict()
+    
+    def count_pending():
+        metrics.set('pending_statuses', local_livefeeds_collection.count_documents({'status': 'pending'}))
+    
+    reporter = start_reporter(config.metrics, metrics_store, gauges=count_pending, aggregate=True)
+    if metrics_port:
+        start_http_server(metrics_port, metrics_store)
+    
     process_list = []
     for i in range(args.processnum):
-        p = Process(target=process_task, args=(args.worker_id, config, local_collections, tokens, terminate_flag))
+        p = Process(target=process_task, args=(args.worker_id, config, local_collections, token_pool, terminate_flag,
+                                                args.batch_size, args.lease),
+                    kwargs={'bucket_size': args.bucket_size, 'metrics_store': metrics_store})
         p.start()
         process_list.append(p)
     
@@ -216,6 +473,10 @@ def main():
             p.terminate()
         logger.info("Terminated all processes.")
 
+    reporter.stop()
+    manager.shutdown()
+    if central_client:
+        central_client.close()
     local_client.close()
     logger.info("Reblog and Favourite Worker task completed.")
 
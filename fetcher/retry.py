@@ -0,0 +1,137 @@
+# fetcher/retry.py
+import random
+import logging
+from datetime import datetime, timedelta
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+RETRY_FIELDS = ["attempts", "next_attempt_at", "last_error"]
+# Failures that may go away by themselves; any other response, e.g. 404 or 410, is final.
+RETRYABLE_CODES = {429, 'timeout', 'exception'}
+
+def crawl_error(code, message=None):
+    """
+    Describes a failed crawl of an instance, shard or status.
+
+    Args:
+        code (int or str): HTTP status code, 'timeout' or 'exception'.
+        message (str, optional): Error message or response body.
+
+    Returns:
+        dict: 'code' and 'message'.
+    """
+    return {'code': code, 'message': message[:500] if message else message}
+
+def is_retryable(error):
+    """
+    Checks whether a failure is worth retrying.
+
+    Args:
+        error (dict): Error from crawl_error.
+
+    Returns:
+        bool: True for 429, 5xx responses, timeouts and connection errors.
+    """
+    code = error['code']
+    return code in RETRYABLE_CODES or (isinstance(code, int) and code >= 500)
+
+def due_query(now):
+    """
+    Returns the condition matching items that have no retry scheduled or whose retry is due.
+    Both branches are plain equality and range matches, so the claim queries can use an index on
+    'next_attempt_at'.
+
+    Args:
+        now (datetime): The current time.
+
+    Returns:
+        dict: The query condition.
+    """
+    return {"$or": [{"next_attempt_at": None}, {"next_attempt_at": {"$lte": now}}]}
+
+class RetryPolicy:
+    """
+    Exponential backoff with jitter for failed items, and the number of attempts after which an
+    item is given up and dead-lettered.
+    """
+    def __init__(self, base_delay=60, max_delay=3600, factor=2, jitter=0.5, max_attempts=5):
+        """
+        Args:
+            base_delay (float, optional): Seconds before the first retry. Defaults to 60.
+            max_delay (float, optional): Upper bound of the delay in seconds. Defaults to 3600.
+            factor (float, optional): Growth of the delay per attempt. Defaults to 2.
+            jitter (float, optional): Fraction of the delay that is randomized, so items that failed
+                together are not retried together. Defaults to 0.5.
+            max_attempts (int, optional): Failed attempts after which an item is dead-lettered. Defaults to 5.
+        """
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.jitter = jitter
+        self.max_attempts = max_attempts
+
+    def delay(self, attempts):
+        """
+        Returns the seconds to wait after a number of failed attempts.
+
+        Args:
+            attempts (int): Failed attempts so far, at least 1.
+
+        Returns:
+            float: Seconds.
+        """
+        delay = min(self.max_delay, self.base_delay * self.factor ** (attempts - 1))
+        return delay * (1 - self.jitter * random.random())
+
+    def next_attempt(self, attempts, error):
+        """
+        Plans the next attempt of an item after a failure.
+
+        Args:
+            attempts (int): Failed attempts including this one.
+            error (dict): Error from crawl_error.
+
+        Returns:
+            datetime or None: Time of the next attempt, or None if the item should be dead-lettered.
+        """
+        if not is_retryable(error) or attempts >= self.max_attempts:
+            return None
+        return datetime.now() + timedelta(seconds=self.delay(attempts))
+
+def create_retry_policy(retry_config=None):
+    """
+    Creates the retry policy of a worker from the 'retry' configuration.
+
+    Args:
+        retry_config (dict, optional): The 'retry' configuration.
+
+    Returns:
+        RetryPolicy: The policy.
+    """
+    return RetryPolicy(**(retry_config or {}))
+
+def ensure_dead_letter_indexes(collection):
+    """
+    Creates the index used to look up the dead letters of an item.
+
+    Args:
+        collection (pymongo.collection.Collection): The dead_letters collection.
+    """
+    collection.create_index([("kind", 1), ("key", 1)], name="kind_key")
+
+def dead_letter(collection, kind, key, attempts, error):
+    """
+    Records an item that was given up.
+
+    Args:
+        collection (pymongo.collection.Collection or None): The dead_letters collection, None to only log.
+        kind (str): 'instance', 'shard' or 'engagement'.
+        key (str): Instance name, shard ID or 'sid' of the status.
+        attempts (int): Failed attempts.
+        error (dict): The last error from crawl_error.
+    """
+    metrics.inc('dead_letters_total', kind=kind)
+    logger.warning(f"Giving up {kind} {key} after {attempts} attempts: {error['code']}.")
+    if collection is not None:
+        collection.insert_one({"kind": kind, "key": key, "attempts": attempts, "error": error, "loadtime": datetime.now()})
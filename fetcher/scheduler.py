@@ -0,0 +1,452 @@
+# fetcher/scheduler.py
+import math
+import time
+import uuid
+import random
+import threading
+import logging
+from collections import deque
+from datetime import datetime, timedelta
+from pymongo import UpdateOne
+from task_queue import default_owner
+from retry import RetryPolicy, RETRY_FIELDS, due_query, dead_letter
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+LEASE_FIELDS = ["lease_owner", "lease_id", "lease_expires", "lease_round", "heartbeat_at"]
+CURSOR_FIELDS = ["cursor", "cursor_round"]
+
+TIMELINE_PAGE_SIZE = 40
+# Mastodon's default budget of 300 requests per 5 minutes, assumed when an instance sent no rate limit headers.
+DEFAULT_RATELIMIT = 300
+RATELIMIT_WINDOW = 300
+DEFAULT_LATENCY = 0.5
+# Maximum seconds a worker waits before claiming again after other workers took all its candidates.
+CLAIM_RETRY_JITTER = 0.1
+
+def ensure_instance_indexes(collection):
+    """
+    Creates the indexes used to claim instances and to requeue expired leases.
+
+    Args:
+        collection (pymongo.collection.Collection): The instances collection.
+    """
+    collection.create_index([("processable", 1), ("round", 1), ("statuses", -1)], name="processable_round_statuses")
+    collection.create_index([("processable", 1), ("round", 1), ("cost", -1)], name="processable_round_cost")
+    collection.create_index([("lease_expires", 1)], name="lease_expires", sparse=True)
+    collection.create_index([("lease_id", 1)], name="lease_id", sparse=True)
+    logger.info(f"Claim indexes ensured for collection '{collection.name}'.")
+
+def estimate_toots_per_hour(instance_info):
+    """
+    Estimates how many local toots an instance publishes per hour.
+    Prefers the rate measured by earlier crawls, then the weekly activity recorded by the probe,
+    and falls back to spreading the instances.social 'statuses' total over a year.
+
+    Args:
+        instance_info (dict): The instance document.
+
+    Returns:
+        float: Toots per hour.
+    """
+    crawl_stats = instance_info.get('crawl_stats') or {}
+    if crawl_stats.get('toots_per_hour') is not None:
+        return crawl_stats['toots_per_hour']
+    weekly = (instance_info.get('probe') or {}).get('weekly_statuses')
+    if weekly is not None:
+        return weekly / (7 * 24)
+    return (instance_info.get('statuses') or 0) / (365 * 24)
+
+def estimate_cost(instance_info, window_hours, tokens=1):
+    """
+    Estimates the seconds a crawl of an instance over a window takes: the expected timeline pages
+    times the time per page, which is bounded by the latency and by the rate limit budget of the tokens.
+
+    Args:
+        instance_info (dict): The instance document.
+        window_hours (float): Length of the crawl window in hours.
+        tokens (int, optional): Number of tokens sharing the crawl. Defaults to 1.
+
+    Returns:
+        float: Expected seconds.
+    """
+    pages = math.ceil(estimate_toots_per_hour(instance_info) * window_hours / TIMELINE_PAGE_SIZE) + 1
+    crawl_stats = instance_info.get('crawl_stats') or {}
+    if crawl_stats.get('seconds_per_page'):
+        return pages * crawl_stats['seconds_per_page']
+    probe = instance_info.get('probe') or {}
+    latency = probe.get('latency') or DEFAULT_LATENCY
+    limit = probe.get('ratelimit_limit') or DEFAULT_RATELIMIT
+    return pages * max(latency, RATELIMIT_WINDOW / (limit * max(tokens, 1)))
+
+def plan_instance_costs(collection, global_duration, tokens=1, batch_size=1000):
+    """
+    Stores the estimated crawl cost of every processable instance as 'cost', which the scheduler
+    hands out largest first.
+
+    Args:
+        collection (pymongo.collection.Collection): The instances collection.
+        global_duration (dict): Dictionary containing 'start_time' and 'end_time'.
+        tokens (int, optional): Number of tokens of a worker. Defaults to 1.
+        batch_size (int, optional): Number of updates per bulk_write. Defaults to 1000.
+
+    Returns:
+        int: Number of instances planned.
+    """
+    window_hours = (global_duration['end_time'] - global_duration['start_time']).total_seconds() / 3600
+    projection = {"statuses": 1, "probe": 1, "crawl_stats": 1}
+    updates = []
+    planned = 0
+    for instance_info in collection.find({"processable": True}, projection):
+        cost = round(estimate_cost(instance_info, window_hours, tokens), 1)
+        updates.append(UpdateOne({"_id": instance_info["_id"]}, {"$set": {"cost": cost}}))
+        if len(updates) >= batch_size:
+            collection.bulk_write(updates, ordered=False)
+            planned += len(updates)
+            updates = []
+    if updates:
+        collection.bulk_write(updates, ordered=False)
+        planned += len(updates)
+    logger.info(f"Planned the crawl cost of {planned} instances.")
+    return planned
+
+def record_crawl_stats(collection, instance_name, stats, seconds, window_hours):
+    """
+    Records the toots per hour and seconds per page measured by a crawl of a whole window,
+    used by estimate_cost for later crawls. Crawls resumed from a cursor or stopped early because the
+    rest of the window was already stored only cover part of the window and are not recorded.
+
+    Args:
+        collection (pymongo.collection.Collection): The instances collection.
+        instance_name (str): Name of the instance.
+        stats (dict): 'pages' and 'statuses' fetched by the crawl and whether it 'resumed' from a cursor
+            or was 'partial'.
+        seconds (float): Duration of the crawl.
+        window_hours (float): Length of the crawl window in hours.
+    """
+    if not stats.get('pages') or stats.get('resumed') or stats.get('partial') or window_hours <= 0:
+        return
+    collection.update_one({"name": instance_name}, {"$set": {"crawl_stats": {
+        "toots_per_hour": round(stats['statuses'] / window_hours, 2),
+        "seconds_per_page": round(seconds / stats['pages'], 3),
+        "crawled_at": datetime.now()
+    }}})
+
+class InstanceScheduler:
+    """
+    Hands out instances of the central instances collection to crawl workers under a lease,
+    ordered by sort_field, largest first: the planned 'cost' or the instances.social 'statuses'.
+    Claiming an instance moves it to the next round as before and records the lease owner, a lease ID,
+    the round it was claimed from and an expiry that the owner's heartbeat keeps extending.
+    If a worker dies, its leases expire and the instances are moved back to their round, so another
+    worker picks them up and resumes from the cursor the crashed worker saved for that round.
+    A failed instance goes back to its round with a 'next_attempt_at' from the RetryPolicy, and workers
+    wait for it before leaving the round; after the last attempt it is made unprocessable and dead-lettered.
+    """
+    def __init__(self, collection, owner=None, batch_size=1, lease_seconds=300, poll_interval=10, sort_field='statuses',
+                 retry_policy=None, dead_letters=None, kind='instance', requeue_interval=None):
+        """
+        Args:
+            collection (pymongo.collection.Collection): The instances collection.
+            owner (str, optional): Lease owner name. Defaults to 'hostname:pid'.
+            batch_size (int, optional): Number of instances claimed at once. Defaults to 1.
+            lease_seconds (int, optional): Seconds without heartbeat after which a lease expires. Defaults to 300.
+            poll_interval (int, optional): Seconds between claim attempts while other workers still hold
+                leases of the round. Defaults to 10.
+            sort_field (str, optional): Field the instances are claimed by, largest first. Defaults to 'statuses'.
+            retry_policy (RetryPolicy, optional): Backoff of failed instances. Defaults to RetryPolicy().
+            dead_letters (pymongo.collection.Collection, optional): Collection of given up instances.
+            kind (str, optional): Kind of the items recorded in dead_letters. Defaults to 'instance'.
+            requeue_interval (float, optional): Minimum seconds between two requeues of expired leases.
+                Defaults to a third of the lease.
+        """
+        self.collection = collection
+        self.owner = owner or default_owner()
+        self.batch_size = batch_size
+        self.lease = timedelta(seconds=lease_seconds)
+        self.poll_interval = poll_interval
+        self.sort_field = sort_field
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.dead_letters = dead_letters
+        self.kind = kind
+        self.requeue_interval = requeue_interval if requeue_interval is not None else lease_seconds / 3
+        self.last_requeue = None
+        self.prefetched = deque()
+
+    @staticmethod
+    def round_query(round_num):
+        """
+        Builds the query matching the processable instances of a round.
+
+        Args:
+            round_num (int or None): The round the instances have to be in, or None for a single pass.
+
+        Returns:
+            dict: The query.
+        """
+        if round_num is None:
+            return {"round": -1, "processable": True}
+        query = {"round": round_num, "processable": True}
+        if round_num >= 0:
+            query[f"round{round_num}_id_range"] = {"$exists": True}
+        return query
+
+    @staticmethod
+    def claim_query(round_num):
+        """
+        Builds the query matching the instances of a round that can be claimed now.
+
+        Args:
+            round_num (int or None): The round the instances have to be in, or None for a single pass.
+
+        Returns:
+            dict: The query.
+        """
+        query = InstanceScheduler.round_query(round_num)
+        query.update(due_query(datetime.now()))
+        return query
+
+    @staticmethod
+    def claim_update(round_num):
+        """
+        Builds the fields set on a claimed instance.
+
+        Args:
+            round_num (int or None): The round the instances are claimed from, or None for a single pass.
+
+        Returns:
+            dict: The fields to set.
+        """
+        if round_num is None:
+            return {"round": 0, "crawl_state": "running"}
+        return {"round": round_num + 1}
+
+    def requeue_expired(self):
+        """
+        Moves the instances whose lease expired back to the round they were claimed from.
+
+        Returns:
+            int: Number of requeued instances.
+        """
+        result = self.collection.update_many(
+            {"lease_expires": {"$lt": datetime.now()}},
+            [
+                {"$set": {"round": "$lease_round"}},
+                {"$project": {field: 0 for field in LEASE_FIELDS + ["crawl_state"]}}
+            ]
+        )
+        if result.modified_count:
+            logger.warning(f"Requeued {result.modified_count} instances with expired leases.")
+        return result.modified_count
+
+    def maybe_requeue_expired(self):
+        """
+        Requeues expired leases unless this worker did so less than requeue_interval seconds ago.
+        Leases only expire after lease_seconds, so scanning for them before every claim is wasted work.
+
+        Returns:
+            int: Number of requeued instances.
+        """
+        now = time.monotonic()
+        if self.last_requeue is not None and now - self.last_requeue < self.requeue_interval:
+            return 0
+        self.last_requeue = now
+        return self.requeue_expired()
+
+    def claim_batch(self, round_num):
+        """
+        Atomically claims up to batch_size instances with a single lease ID.
+
+        Args:
+            round_num (int or None): The round the instances are claimed from, or None for a single pass.
+
+        Returns:
+            list or None: The claimed instances, largest first. None if no instance could be claimed,
+                an empty list if there were candidates but other workers claimed them first.
+        """
+        self.maybe_requeue_expired()
+        query = self.claim_query(round_num)
+        candidate_ids = [
+            doc['_id'] for doc in
+            self.collection.find(query, {"_id": 1}).sort(self.sort_field, -1).limit(self.batch_size)
+        ]
+        if not candidate_ids:
+            return None
+        now = datetime.now()
+        lease_id = uuid.uuid4().hex
+        update = self.claim_update(round_num)
+        update.update({
+            "lease_owner": self.owner,
+            "lease_id": lease_id,
+            "lease_expires": now + self.lease,
+            "lease_round": -1 if round_num is None else round_num,
+            "heartbeat_at": now
+        })
+        query["_id"] = {"$in": candidate_ids}
+        self.collection.update_many(query, {"$set": update})
+        claimed = list(self.collection.find({"lease_id": lease_id}).sort(self.sort_field, -1))
+        if claimed:
+            logger.info(f"Claimed {len(claimed)} instances.")
+        else:
+            metrics.inc('claim_conflicts_total', kind=self.kind)
+        return claimed
+
+    def leased_by_others(self, round_num):
+        """
+        Checks whether other workers still hold leases on instances claimed from a round.
+
+        Args:
+            round_num (int or None): The round, or None for a single pass.
+
+        Returns:
+            bool: True if such leases exist.
+        """
+        return self.collection.count_documents({
+            "lease_round": -1 if round_num is None else round_num,
+            "lease_owner": {"$ne": self.owner}
+        }, limit=1) > 0
+
+    def retries_pending(self, round_num):
+        """
+        Checks whether instances of a round wait for a retry.
+
+        Args:
+            round_num (int or None): The round, or None for a single pass.
+
+        Returns:
+            bool: True if such instances exist.
+        """
+        query = self.round_query(round_num)
+        query["next_attempt_at"] = {"$gt": datetime.now()}
+        return self.collection.count_documents(query, limit=1) > 0
+
+    def get(self, round_num, wait=True):
+        """
+        Returns the next claimed instance, claiming a new batch when the prefetch queue is empty.
+        If other workers claimed all candidates first, it claims again right away after a short random
+        delay instead of waiting for the next poll.
+
+        Args:
+            round_num (int or None): The round the instances are claimed from, or None for a single pass.
+            wait (bool, optional): Keep polling while other workers hold leases of the round, so their
+                instances are taken over if the leases expire, and while instances wait for a retry.
+                Defaults to True.
+
+        Returns:
+            dict or None: The instance information or None if the round is finished.
+        """
+        while True:
+            if not self.prefetched:
+                claimed = self.claim_batch(round_num)
+                if claimed is not None and not claimed:
+                    time.sleep(random.uniform(0, CLAIM_RETRY_JITTER))
+                    continue
+                self.prefetched.extend(claimed or [])
+            if self.prefetched:
+                return self.prefetched.popleft()
+            if not wait or not (self.leased_by_others(round_num) or self.retries_pending(round_num)):
+                return None
+            time.sleep(self.poll_interval)
+
+    def complete(self, instance_info):
+        """
+        Removes the lease and the saved cursor of a processed instance.
+
+        Args:
+            instance_info (dict): The claimed instance.
+        """
+        self.collection.update_one(
+            {"_id": instance_info["_id"], "lease_id": instance_info["lease_id"]},
+            {"$unset": {field: "" for field in LEASE_FIELDS + CURSOR_FIELDS + RETRY_FIELDS}}
+        )
+
+    def release(self, instance_info):
+        """
+        Gives a claimed instance back so that it can be claimed again.
+
+        Args:
+            instance_info (dict): The claimed instance.
+        """
+        self.collection.update_one(
+            {"_id": instance_info["_id"], "lease_id": instance_info["lease_id"]},
+            [
+                {"$set": {"round": "$lease_round"}},
+                {"$project": {field: 0 for field in LEASE_FIELDS + ["crawl_state"]}}
+            ]
+        )
+
+    def retry(self, instance_info, error):
+        """
+        Gives a failed instance back to the round it was claimed from with a delayed next attempt, or
+        makes it unprocessable and dead-letters it after the last attempt or a failure that is not worth
+        retrying. The saved cursor is kept, so the retry continues where the failed attempt stopped.
+
+        Args:
+            instance_info (dict): The claimed instance.
+            error (dict): Error from retry.crawl_error.
+
+        Returns:
+            bool: True if a retry was scheduled, False if the instance was given up.
+        """
+        attempts = instance_info.get('attempts', 0) + 1
+        next_attempt_at = self.retry_policy.next_attempt(attempts, error)
+        query = {"_id": instance_info["_id"], "lease_id": instance_info["lease_id"]}
+        if next_attempt_at:
+            metrics.inc('retries_scheduled_total', kind=self.kind)
+            self.collection.update_one(query, [
+                {"$set": {"round": "$lease_round", "attempts": attempts, "next_attempt_at": next_attempt_at,
+                          "last_error": {"$literal": error}}},
+                {"$project": {field: 0 for field in LEASE_FIELDS + ["crawl_state"]}}
+            ])
+            return True
+        self.collection.update_one(query, {
+            "$set": {"processable": False, "attempts": attempts, "last_error": error},
+            "$unset": {field: "" for field in LEASE_FIELDS}
+        })
+        key = instance_info['_id'] if self.kind == 'shard' else instance_info['name']
+        dead_letter(self.dead_letters, self.kind, key, attempts, error)
+        return False
+
+    def release_all(self):
+        """
+        Gives back every prefetched instance that was not handed out yet.
+        """
+        while self.prefetched:
+            self.release(self.prefetched.popleft())
+
+    def heartbeat(self):
+        """
+        Extends every lease held by this worker and requeues the expired leases of crashed workers.
+        """
+        now = datetime.now()
+        self.collection.update_many(
+            {"lease_owner": self.owner, "lease_id": {"$exists": True}},
+            {"$set": {"lease_expires": now + self.lease, "heartbeat_at": now}}
+        )
+        self.maybe_requeue_expired()
+
+class Heartbeat(threading.Thread):
+    """
+    Background thread that renews the leases of a scheduler until it is stopped.
+    """
+    def __init__(self, scheduler, interval=None):
+        """
+        Args:
+            scheduler (InstanceScheduler or StatusQueue): The scheduler whose leases are renewed.
+            interval (float, optional): Seconds between heartbeats. Defaults to a third of the lease.
+        """
+        super().__init__(daemon=True)
+        self.scheduler = scheduler
+        self.interval = interval or scheduler.lease.total_seconds() / 3
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.scheduler.heartbeat()
+            except Exception:
+                logger.exception("Failed to renew leases")
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,199 @@
+# fetcher/seen.py
+import os
+import re
+import bisect
+import sqlite3
+import threading
+import logging
+from array import array
+
+logger = logging.getLogger(__name__)
+
+class IdSet:
+    """
+    Compact set of the status IDs of one instance.
+    Numeric IDs loaded from the store are kept in a sorted array of 64-bit integers, IDs added
+    afterwards and non-numeric IDs in a regular set.
+    """
+    def __init__(self, ids):
+        """
+        Args:
+            ids (iterable): Status IDs as strings.
+        """
+        numeric = []
+        self.other = set()
+        for status_id in ids:
+            if status_id.isdigit():
+                numeric.append(int(status_id))
+            else:
+                self.other.add(status_id)
+        numeric.sort()
+        self.sorted = array('Q', numeric)
+        self.added = set()
+        self.min_id = numeric[0] if numeric else None
+
+    def __len__(self):
+        return len(self.sorted) + len(self.added) + len(self.other)
+
+    def __contains__(self, status_id):
+        if not status_id.isdigit():
+            return status_id in self.other
+        value = int(status_id)
+        if value in self.added:
+            return True
+        i = bisect.bisect_left(self.sorted, value)
+        return i < len(self.sorted) and self.sorted[i] == value
+
+    def add(self, status_id):
+        if not status_id.isdigit():
+            self.other.add(status_id)
+            return
+        value = int(status_id)
+        self.added.add(value)
+        if self.min_id is None or value < self.min_id:
+            self.min_id = value
+
+class SeenFilter:
+    """
+    Remembers the statuses already stored for the instances a worker is crawling, so known statuses
+    are dropped before they reach the writer. The IDs of an instance are loaded from the store the
+    first time the instance is looked up and dropped again with forget.
+    """
+    def __init__(self, loader):
+        """
+        Args:
+            loader (callable): Function returning the stored 'sid's of an instance name.
+        """
+        self.loader = loader
+        self.instances = {}
+        self.lock = threading.Lock()
+
+    def ids(self, instance_name):
+        """
+        Returns the known IDs of an instance, loading them on first use.
+
+        Args:
+            instance_name (str): Name of the instance.
+
+        Returns:
+            IdSet: The known IDs.
+        """
+        with self.lock:
+            ids = self.instances.get(instance_name)
+        if ids is not None:
+            return ids
+        prefix = f"{instance_name}#"
+        loaded = IdSet(sid[len(prefix):] for sid in self.loader(instance_name) if sid.startswith(prefix))
+        with self.lock:
+            ids = self.instances.setdefault(instance_name, loaded)
+        if ids is loaded and len(ids):
+            logger.info(f"Loaded {len(ids)} known statuses of {instance_name}.")
+        return ids
+
+    def seen(self, instance_name, status_id):
+        """
+        Checks whether a status was already stored.
+
+        Args:
+            instance_name (str): Name of the instance.
+            status_id (str): ID of the status on the instance.
+
+        Returns:
+            bool: True if the status is known.
+        """
+        ids = self.ids(instance_name)
+        with self.lock:
+            return status_id in ids
+
+    def add(self, instance_name, status_id):
+        """
+        Records a status that was handed to the writer.
+
+        Args:
+            instance_name (str): Name of the instance.
+            status_id (str): ID of the status on the instance.
+        """
+        ids = self.ids(instance_name)
+        with self.lock:
+            ids.add(status_id)
+
+    def covers(self, instance_name, min_id):
+        """
+        Checks whether the stored statuses of an instance reach back to a snowflake ID.
+
+        Args:
+            instance_name (str): Name of the instance.
+            min_id (int): Snowflake ID of the start of the window.
+
+        Returns:
+            bool: True if a known numeric ID is not greater than min_id.
+        """
+        ids = self.ids(instance_name)
+        with self.lock:
+            return ids.min_id is not None and ids.min_id <= min_id
+
+    def forget(self, instance_name):
+        """
+        Drops the IDs of an instance once it is no longer crawled.
+
+        Args:
+            instance_name (str): Name of the instance.
+        """
+        with self.lock:
+            self.instances.pop(instance_name, None)
+
+def mongo_loader(collection):
+    """
+    Returns a loader reading the 'sid's of an instance from the unique 'sid' index of a collection.
+
+    Args:
+        collection (pymongo.collection.Collection): The livefeeds collection.
+
+    Returns:
+        callable: The loader.
+    """
+    def load(instance_name):
+        query = {"sid": {"$regex": f"^{re.escape(instance_name)}#"}}
+        return (doc['sid'] for doc in collection.find(query, {"sid": 1, "_id": 0}))
+    return load
+
+def key_index_loader(path):
+    """
+    Returns a loader reading the 'sid's of an instance from the key index of a file sink.
+
+    Args:
+        path (str): Path of the SQLite key index.
+
+    Returns:
+        callable: The loader.
+    """
+    def load(instance_name):
+        if not os.path.exists(path):
+            return []
+        connection = sqlite3.connect(path, timeout=60)
+        try:
+            # '$' follows '#', so the range holds exactly the keys starting with 'instance#'.
+            rows = connection.execute("SELECT key FROM seen WHERE key >= ? AND key < ?",
+                                      (f"{instance_name}#", f"{instance_name}$")).fetchall()
+        finally:
+            connection.close()
+        return [row[0] for row in rows]
+    return load
+
+def create_seen_filter(collections, storage_config):
+    """
+    Creates the seen filter of the livefeeds store configured by the 'storage' settings.
+
+    Args:
+        collections (dict): MongoDB collections with the raw 'livefeeds' collection.
+        storage_config (dict): The 'storage' configuration.
+
+    Returns:
+        SeenFilter or None: The filter, or None if 'seen_filter' is disabled.
+    """
+    if not storage_config.get('seen_filter', True):
+        return None
+    if storage_config.get('sink', 'mongo') == 'file':
+        directory = storage_config.get('file', {}).get('directory', 'data')
+        return SeenFilter(key_index_loader(os.path.join(directory, 'livefeeds.sid.sqlite')))
+    return SeenFilter(mongo_loader(collections['livefeeds']))
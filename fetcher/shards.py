@@ -0,0 +1,175 @@
+# fetcher/shards.py
+import math
+import logging
+from datetime import datetime, timedelta
+from pymongo import UpdateOne
+from scheduler import estimate_cost
+
+logger = logging.getLogger(__name__)
+
+def ensure_shard_indexes(collection):
+    """
+    Creates the indexes used to claim shards, to requeue expired leases and to find the shards of an instance.
+
+    Args:
+        collection (pymongo.collection.Collection): The instance_shards collection.
+    """
+    collection.create_index([("processable", 1), ("round", 1), ("cost", -1)], name="processable_round_cost")
+    collection.create_index([("lease_expires", 1)], name="lease_expires", sparse=True)
+    collection.create_index([("lease_id", 1)], name="lease_id", sparse=True)
+    collection.create_index([("name", 1), ("window_start", 1)], name="name_window_start")
+    logger.info(f"Shard indexes ensured for collection '{collection.name}'.")
+
+def split_window(global_duration, shards):
+    """
+    Splits a window into disjoint sub-windows of equal length, newest last.
+    Each sub-window ends one millisecond before the next one starts, so their snowflake ID bounds
+    from compute_seek_bounds neither overlap nor leave a gap.
+
+    Args:
+        global_duration (dict): Dictionary containing 'start_time' and 'end_time'.
+        shards (int): Number of sub-windows.
+
+    Returns:
+        list: Dictionaries containing 'start_time' and 'end_time'.
+    """
+    total_ms = int((global_duration['end_time'] - global_duration['start_time']).total_seconds() * 1000)
+    step = timedelta(milliseconds=total_ms // shards)
+    starts = [global_duration['start_time'] + step * i for i in range(shards)]
+    ends = [start - timedelta(milliseconds=1) for start in starts[1:]] + [global_duration['end_time']]
+    return [{'start_time': start, 'end_time': end} for start, end in zip(starts, ends)]
+
+def shard_id(instance_name, window_start, shard):
+    return f"{instance_name}#{window_start:%Y%m%d%H%M%S}#{shard}"
+
+def plan_shards(instances_collection, shards_collection, global_duration, max_round, sharding, tokens=1):
+    """
+    Splits the instances whose estimated crawl takes longer than 'min_cost' seconds into sub-window shards
+    of about 'shard_seconds' each, which any worker can claim from the instance_shards collection.
+    Only instances a previous crawl showed to use snowflake IDs are split, because shards seek to their
+    sub-window by ID. A split instance is taken out of the single pass ('crawl_state: sharded') and marked
+    done when its last shard is completed.
+    Parents are marked before their shards are created and the shards have fixed IDs, so hosts planning
+    the same window at the same time, or a planner that crashed in between, create every shard exactly once.
+
+    Args:
+        instances_collection (pymongo.collection.Collection): The instances collection.
+        shards_collection (pymongo.collection.Collection): The instance_shards collection.
+        global_duration (dict): Dictionary containing 'start_time' and 'end_time'.
+        max_round (int): The maximum number of rounds.
+        sharding (dict): 'min_cost', 'shard_seconds' and 'max_shards' from the 'sharding' configuration.
+        tokens (int, optional): Number of tokens of a worker. Defaults to 1.
+
+    Returns:
+        int: Number of instances split.
+    """
+    window_hours = (global_duration['end_time'] - global_duration['start_time']).total_seconds() / 3600
+    min_cost = sharding.get('min_cost', 7200)
+    shard_seconds = sharding.get('shard_seconds', 1800)
+    max_shards = sharding.get('max_shards', 32)
+    window = {'start_time': global_duration['start_time'], 'end_time': global_duration['end_time']}
+    query = {"processable": True, "round": -1, "crawl_stats": {"$exists": True}, "snowflake": {"$ne": False}}
+    split = 0
+    for instance_info in instances_collection.find(query, {"name": 1, "statuses": 1, "probe": 1, "crawl_stats": 1}):
+        cost = estimate_cost(instance_info, window_hours, tokens)
+        shards = min(max_shards, math.ceil(cost / shard_seconds))
+        if cost < min_cost or shards < 2:
+            continue
+        result = instances_collection.update_one(
+            {"_id": instance_info["_id"], "round": -1, "lease_id": {"$exists": False}},
+            {"$set": {"round": max_round, "crawl_state": "sharded", "shards": shards, "shard_window": window,
+                      "cost": round(cost, 1)},
+             "$unset": {"shard_stats": ""}}
+        )
+        split += result.modified_count
+
+    updates = []
+    for parent in instances_collection.find({"crawl_state": "sharded", "shard_window": window}, {"name": 1, "shards": 1, "cost": 1}):
+        for shard, sub_window in enumerate(split_window(global_duration, parent['shards'])):
+            updates.append(UpdateOne({"_id": shard_id(parent['name'], global_duration['start_time'], shard)}, {"$setOnInsert": {
+                "name": parent['name'],
+                "shard": shard,
+                "shards": parent['shards'],
+                "window_start": global_duration['start_time'],
+                "start_time": sub_window['start_time'],
+                "end_time": sub_window['end_time'],
+                "round": -1,
+                "processable": True,
+                "cost": round(parent.get('cost', 0) / parent['shards'], 1)
+            }}, upsert=True))
+    if updates:
+        shards_collection.bulk_write(updates, ordered=False)
+    logger.info(f"Split {split} instances into sub-window shards.")
+    return split
+
+def complete_shard(shards_collection, instances_collection, shard_info, stats, seconds, max_round, failed=False):
+    """
+    Marks a shard as done or failed and adds its crawl stats to the parent instance.
+    When the last shard of the instance finishes, the parent is marked done and, if no shard failed
+    or resumed from a cursor, its 'crawl_stats' are updated from the totals of all shards.
+
+    Args:
+        shards_collection (pymongo.collection.Collection): The instance_shards collection.
+        instances_collection (pymongo.collection.Collection): The instances collection.
+        shard_info (dict): The claimed shard.
+        stats (dict): 'pages' and 'statuses' fetched by the shard and whether it 'resumed' from a cursor.
+        seconds (float): Duration of the shard crawl.
+        max_round (int): The maximum number of rounds.
+        failed (bool, optional): Whether the shard was given up. Defaults to False.
+    """
+    shards_collection.update_one(
+        {"_id": shard_info["_id"]},
+        {"$set": {"round": max_round, "crawl_state": "failed" if failed else "done"}, "$unset": {"cursor": "", "cursor_round": ""}}
+    )
+    update = {"$inc": {
+        "shard_stats.pages": stats.get('pages', 0),
+        "shard_stats.statuses": stats.get('statuses', 0),
+        "shard_stats.seconds": seconds
+    }}
+    if failed or stats.get('resumed'):
+        update["$set"] = {"shard_stats.partial": True}
+    instances_collection.update_one({"name": shard_info['name'], "crawl_state": "sharded"}, update)
+
+    remaining = shards_collection.count_documents({
+        "name": shard_info['name'],
+        "window_start": shard_info['window_start'],
+        "crawl_state": {"$nin": ["done", "failed"]}
+    }, limit=1)
+    if remaining:
+        return
+    parent = instances_collection.find_one_and_update(
+        {"name": shard_info['name'], "crawl_state": "sharded"},
+        {"$set": {"crawl_state": "done"}}
+    )
+    if not parent:
+        return
+    logger.info(f"All {shard_info['shards']} shards of {shard_info['name']} are finished.")
+    totals = parent.get('shard_stats', {})
+    window_hours = (parent['shard_window']['end_time'] - parent['shard_window']['start_time']).total_seconds() / 3600
+    if totals.get('pages') and not totals.get('partial') and window_hours > 0:
+        instances_collection.update_one({"_id": parent["_id"]}, {"$set": {"crawl_stats": {
+            "toots_per_hour": round(totals['statuses'] / window_hours, 2),
+            "seconds_per_page": round(totals['seconds'] / totals['pages'], 3),
+            "crawled_at": datetime.now()
+        }}})
+
+def unshard_instance(shards_collection, instances_collection, shard_info):
+    """
+    Gives a split instance back to the single pass after a shard found that it does not use snowflake IDs.
+    The pending shards are marked failed and the whole window of the instance is crawled by scanning.
+
+    Args:
+        shards_collection (pymongo.collection.Collection): The instance_shards collection.
+        instances_collection (pymongo.collection.Collection): The instances collection.
+        shard_info (dict): The claimed shard.
+    """
+    logger.info(f"{shard_info['name']} does not use snowflake IDs, crawling it without shards.")
+    shards_collection.update_many(
+        {"name": shard_info['name'], "window_start": shard_info['window_start'], "round": -1},
+        {"$set": {"crawl_state": "failed", "processable": False}}
+    )
+    instances_collection.update_one(
+        {"name": shard_info['name'], "crawl_state": "sharded"},
+        {"$set": {"round": -1, "snowflake": False},
+         "$unset": {"crawl_state": "", "shards": "", "shard_window": "", "shard_stats": ""}}
+    )
@@ -0,0 +1,381 @@
+# fetcher/sinks.py
+import io
+import os
+import gzip
+import json
+import time
+import socket
+import sqlite3
+import threading
+import logging
+from datetime import datetime
+from writer import Writer, start_flush_timer, stop_flush_timer
+from metrics import record_write
+
+logger = logging.getLogger(__name__)
+
+EXTENSIONS = {'gzip': '.jsonl.gz', 'zstd': '.jsonl.zst', 'none': '.jsonl'}
+# Field each collection is deduplicated on, 'sid' unless listed.
+DEDUP_KEYS = {'error_log': None, 'boostersfavourites': 'bid'}
+
+def json_default(value):
+    """
+    Serializes the values json cannot handle, e.g. the 'loadtime' datetimes.
+    """
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+def open_segment(path, compression):
+    """
+    Opens a segment file for writing text.
+
+    Args:
+        path (str): Path of the file.
+        compression (str): 'gzip', 'zstd' or 'none'. 'zstd' requires the zstandard package.
+
+    Returns:
+        io.TextIOBase: The open file.
+    """
+    if compression == 'gzip':
+        return gzip.open(path, 'wt', encoding='utf-8')
+    if compression == 'zstd':
+        import zstandard
+        return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(open(path, 'wb')), encoding='utf-8')
+    return open(path, 'w', encoding='utf-8')
+
+def open_segment_reader(path, compression):
+    """
+    Opens a segment file for reading text.
+
+    Args:
+        path (str): Path of the file.
+        compression (str): 'gzip', 'zstd' or 'none'. 'zstd' requires the zstandard package.
+
+    Returns:
+        io.TextIOBase: The open file.
+    """
+    if compression == 'gzip':
+        return gzip.open(path, 'rt', encoding='utf-8')
+    if compression == 'zstd':
+        import zstandard
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True),
+                                encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def recover_segments(directory, name):
+    """
+    Finishes the '.partial' segments that processes of this host left behind when they died.
+    The complete JSON lines of a segment are copied to a segment with the final name, and a torn last
+    line is dropped. Segments of processes that are still running are left alone.
+
+    Args:
+        directory (str): Directory of the segment files.
+        name (str): Name of the data set, e.g. 'livefeeds'.
+
+    Returns:
+        int: Number of segments recovered.
+    """
+    prefix = f"{name}-{socket.gethostname()}-"
+    recovered = 0
+    for filename in sorted(os.listdir(directory)):
+        if not (filename.startswith(prefix) and filename.endswith('.partial')):
+            continue
+        compression = next((c for c, ext in EXTENSIONS.items() if filename.endswith(ext + '.partial')), None)
+        pid = filename[len(prefix):].split('-', 1)[0]
+        if compression is None or not pid.isdigit() or process_alive(int(pid)):
+            continue
+        path = os.path.join(directory, filename[:-len('.partial')])
+        claimed = f"{path}.recovering-{os.getpid()}"
+        try:
+            os.rename(os.path.join(directory, filename), claimed)
+        except FileNotFoundError:
+            # Another process of this host is recovering it.
+            continue
+        lines = 0
+        with open_segment(path + '.tmp', compression) as target:
+            try:
+                with open_segment_reader(claimed, compression) as source:
+                    for line in source:
+                        if not line.endswith('\n'):
+                            break
+                        json.loads(line)
+                        target.write(line)
+                        lines += 1
+            except (EOFError, OSError, ValueError) as e:
+                logger.warning(f"Segment {filename} ends with a torn write: {e!r}")
+        os.replace(path + '.tmp', path)
+        os.remove(claimed)
+        recovered += 1
+        logger.info(f"Recovered {lines} documents from the unfinished segment {filename}.")
+    return recovered
+
+class KeyIndex:
+    """
+    SQLite index of the keys already written to a sink, shared by all processes of a host.
+    Keys are added in a transaction that the sink commits only after the documents were written, so
+    documents of a failed write are not reported as duplicates later.
+    """
+    def __init__(self, path):
+        """
+        Args:
+            path (str): Path of the SQLite database.
+        """
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY)")
+        self.connection.commit()
+
+    def add_new(self, keys):
+        """
+        Records keys in an open transaction and returns the ones that were not recorded before.
+        The transaction has to be finished with commit or rollback.
+
+        Args:
+            keys (list): Keys of a batch.
+
+        Returns:
+            set: The new keys.
+        """
+        new_keys = set()
+        for key in keys:
+            cursor = self.connection.execute("INSERT OR IGNORE INTO seen (key) VALUES (?)", (key,))
+            if cursor.rowcount:
+                new_keys.add(key)
+        return new_keys
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def close(self):
+        self.connection.close()
+
+class FileSink(Writer):
+    """
+    Writer that appends documents as compressed JSON lines to rotating segment files instead of MongoDB.
+    Each process writes its own segments, named '<name>-<host>-<pid>-<start time>-<sequence>', which are
+    suffixed '.partial' until they are rotated or closed; the unfinished segments of dead processes of
+    this host are recovered when a sink is created. Documents whose dedup key was already written on
+    this host are dropped.
+    """
+    def __init__(self, directory, name, compression='gzip', rotate_bytes=256 * 1024 * 1024, rotate_seconds=3600,
+                 batch_size=500, flush_interval=5, dedup_key='sid'):
+        """
+        Args:
+            directory (str): Directory of the segment files.
+            name (str): Name of the data set, e.g. 'livefeeds'.
+            compression (str, optional): 'gzip', 'zstd' or 'none'. Defaults to 'gzip'.
+            rotate_bytes (int, optional): Uncompressed bytes after which a segment is rotated. Defaults to 256 MiB.
+            rotate_seconds (int, optional): Seconds after which a segment is rotated. Defaults to 3600.
+            batch_size (int, optional): Number of documents per batch. Defaults to 500.
+            flush_interval (float, optional): Maximum seconds a document waits in the buffer. Defaults to 5.
+            dedup_key (str, optional): Field used to drop duplicates, None to keep every document. Defaults to 'sid'.
+        """
+        if compression not in EXTENSIONS:
+            raise ValueError(f"Unsupported compression: {compression}")
+        os.makedirs(directory, exist_ok=True)
+        recover_segments(directory, name)
+        self.directory = directory
+        self.name = name
+        self.compression = compression
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dedup_key = dedup_key
+        self.index = KeyIndex(os.path.join(directory, f"{name}.{dedup_key}.sqlite")) if dedup_key else None
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.timer = None
+        self.segment = None
+        self.segment_path = None
+        self.segment_bytes = 0
+        self.segment_opened = 0
+        self.segment_seq = 0
+        self.stats = {'inserted': 0, 'duplicates': 0, 'errors': 0}
+
+    def write(self, document):
+        """
+        Adds a document to the buffer and flushes it if the batch is full or due.
+
+        Args:
+            document (dict): The document to write.
+        """
+        with self.lock:
+            self.buffer.append(document)
+            due = len(self.buffer) >= self.batch_size
+            start_flush_timer(self)
+        if due:
+            self.flush()
+        else:
+            self.maybe_flush()
+
+    def maybe_flush(self):
+        """
+        Flushes the buffer if flush_interval seconds have passed since the last flush.
+        """
+        with self.lock:
+            due = self.buffer and time.monotonic() - self.last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def open_segment(self):
+        stamp = datetime.now().strftime('%Y%m%dT%H%M%S')
+        self.segment_seq += 1
+        filename = (f"{self.name}-{socket.gethostname()}-{os.getpid()}-{stamp}-{self.segment_seq:04d}"
+                    f"{EXTENSIONS[self.compression]}")
+        self.segment_path = os.path.join(self.directory, filename)
+        self.segment = open_segment(self.segment_path + '.partial', self.compression)
+        self.segment_bytes = 0
+        self.segment_opened = time.monotonic()
+
+    def close_segment(self):
+        if self.segment is None:
+            return
+        self.segment.close()
+        os.replace(self.segment_path + '.partial', self.segment_path)
+        logger.info(f"Closed segment {self.segment_path} ({self.segment_bytes} bytes).")
+        self.segment = None
+
+    def abandon_segment(self):
+        """
+        Stops writing to a segment after a failed write, which may have left a torn line. The segment keeps
+        its '.partial' suffix and is recovered by the first sink of this data set created on the host after
+        this process has exited.
+        """
+        if self.segment is None:
+            return
+        try:
+            self.segment.close()
+        except Exception as e:
+            logger.warning(f"Could not close segment {self.segment_path}: {e}")
+        logger.warning(f"Abandoned segment {self.segment_path}.partial after a failed write.")
+        self.segment = None
+
+    def flush(self):
+        """
+        Appends all buffered documents that were not written before to the current segment.
+        The keys of the documents are committed to the index only after the segment was flushed.
+
+        Returns:
+            dict: Number of documents written, skipped as duplicates and failed in this batch.
+        """
+        result = {'inserted': 0, 'duplicates': 0, 'errors': 0}
+        with self.write_lock:
+            with self.lock:
+                batch, self.buffer = self.buffer, []
+                self.last_flush = time.monotonic()
+            if not batch:
+                return result
+            write_start = time.monotonic()
+            try:
+                if self.index:
+                    new_keys = self.index.add_new([doc.get(self.dedup_key) for doc in batch if self.dedup_key in doc])
+                    unique = []
+                    for doc in batch:
+                        key = doc.get(self.dedup_key)
+                        if key is None or key in new_keys:
+                            new_keys.discard(key)
+                            unique.append(doc)
+                    result['duplicates'] = len(batch) - len(unique)
+                    batch = unique
+                if self.segment is None:
+                    self.open_segment()
+                lines = ''.join(json.dumps(doc, default=json_default, ensure_ascii=False) + '\n' for doc in batch)
+                self.segment.write(lines)
+                self.segment.flush()
+                if self.index:
+                    self.index.commit()
+                self.segment_bytes += len(lines)
+                result['inserted'] = len(batch)
+            except Exception as e:
+                result['errors'] = len(batch)
+                logger.error(f"Error writing batch of {len(batch)} documents to {self.name} segments: {e}")
+                if self.index:
+                    self.index.rollback()
+                self.abandon_segment()
+            if self.segment is not None and (self.segment_bytes >= self.rotate_bytes
+                                             or time.monotonic() - self.segment_opened >= self.rotate_seconds):
+                try:
+                    self.close_segment()
+                except OSError as e:
+                    logger.error(f"Error closing segment {self.segment_path}: {e}")
+                    self.abandon_segment()
+        for key, value in result.items():
+            self.stats[key] += value
+        record_write(self.name, result, time.monotonic() - write_start)
+        logger.debug(f"Flushed {result['inserted'] + result['duplicates'] + result['errors']} documents to "
+                    f"{self.name} segments: {result['inserted']} written, {result['duplicates']} duplicates, "
+                    f"{result['errors']} errors.")
+        return result
+
+    def close(self):
+        """
+        Stops the FlushTimer, flushes the remaining documents and closes the current segment.
+        """
+        stop_flush_timer(self)
+        self.flush()
+        with self.write_lock:
+            self.close_segment()
+            if self.index:
+                self.index.close()
+                self.index = None
+
+def create_file_sinks(collections, names, storage_config, writer_config=None):
+    """
+    Replaces the named collections with FileSinks configured by the 'storage.file' settings.
+
+    Args:
+        collections (dict): MongoDB collections.
+        names (list): Keys of the collections that are only written to.
+        storage_config (dict): The 'storage' configuration.
+        writer_config (dict, optional): 'batch_size' and 'flush_interval' settings.
+
+    Returns:
+        dict: A copy of collections with the named entries replaced by FileSinks.
+    """
+    sinks = dict(collections)
+    for name in names:
+        sinks[name] = create_file_sink(name, storage_config, writer_config,
+                                       dedup_key=DEDUP_KEYS.get(name, 'sid'))
+    return sinks
+
+def create_file_sink(name, storage_config, writer_config=None, dedup_key='sid'):
+    """
+    Creates a FileSink configured by the 'storage.file' settings.
+
+    Args:
+        name (str): Name of the data set.
+        storage_config (dict): The 'storage' configuration.
+        writer_config (dict, optional): 'batch_size' and 'flush_interval' settings.
+        dedup_key (str, optional): Field used to drop duplicates. Defaults to 'sid'.
+
+    Returns:
+        FileSink: The sink.
+    """
+    file_config = storage_config.get('file', {})
+    writer_config = writer_config or {}
+    return FileSink(
+        file_config.get('directory', 'data'),
+        name,
+        compression=file_config.get('compression', 'gzip'),
+        rotate_bytes=file_config.get('rotate_mb', 256) * 1024 * 1024,
+        rotate_seconds=file_config.get('rotate_seconds', 3600),
+        batch_size=writer_config.get('batch_size', 500),
+        flush_interval=writer_config.get('flush_interval', 5),
+        dedup_key=dedup_key
+    )
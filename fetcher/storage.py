@@ -0,0 +1,308 @@
+# fetcher/storage.py
+import time
+import threading
+import logging
+from datetime import datetime
+from pymongo import UpdateOne
+from writer import Writer, BufferedWriter, create_writers
+from sinks import create_file_sinks, create_file_sink
+from seen import create_seen_filter
+from metrics import record_write
+
+logger = logging.getLogger(__name__)
+
+# Fields every compact status keeps, since the engagement worker and the reader rely on them.
+REQUIRED_STATUS_FIELDS = ['id', 'sid', 'instance_name', 'loadtime', 'status', 'created_at',
+                          'reblogs_count', 'favourites_count']
+
+DEFAULT_STATUS_FIELDS = ['uri', 'url', 'content', 'language', 'visibility', 'sensitive', 'spoiler_text',
+                         'in_reply_to_id', 'in_reply_to_account_id', 'replies_count', 'edited_at',
+                         'tags', 'mentions', 'media_attachments', 'poll', 'card']
+
+# Account fields kept per reblogger and favouriter with 'engagement.accounts: ids'.
+ENGAGER_FIELDS = ['id', 'acct']
+
+def account_ref(instance_name, account):
+    """
+    Returns the reference of an account as seen from an instance.
+    Account IDs are local to the instance that returned them.
+
+    Args:
+        instance_name (str): Name of the instance that returned the account.
+        account (dict): Account returned by the Mastodon API.
+
+    Returns:
+        str: 'instance#account_id'.
+    """
+    return f"{instance_name}#{account['id']}"
+
+class UpsertWriter(BufferedWriter):
+    """
+    BufferedWriter that upserts documents on a key instead of inserting them.
+    """
+    def __init__(self, collection, key, batch_size=500, flush_interval=5):
+        """
+        Args:
+            collection (pymongo.collection.Collection): The MongoDB collection to write to.
+            key (str): Field identifying a document.
+            batch_size (int, optional): Number of documents per batch. Defaults to 500.
+            flush_interval (float, optional): Maximum seconds a document waits in the buffer. Defaults to 5.
+        """
+        super().__init__(collection, batch_size=batch_size, flush_interval=flush_interval)
+        self.key = key
+
+    def flush(self):
+        """
+        Writes all buffered documents with a single unordered bulk_write of upserts.
+
+        Returns:
+            dict: Number of documents inserted, updated ('duplicates') and failed in this batch.
+        """
+        with self.write_lock:
+            with self.lock:
+                batch, self.buffer = self.buffer, []
+                self.last_flush = time.monotonic()
+            result = {'inserted': 0, 'duplicates': 0, 'errors': 0}
+            if not batch:
+                return result
+            write_start = time.monotonic()
+            try:
+                written = self.collection.bulk_write(
+                    [UpdateOne({self.key: doc[self.key]}, {"$set": doc}, upsert=True) for doc in batch], ordered=False
+                )
+                result['inserted'] = written.upserted_count
+                result['duplicates'] = written.matched_count
+            except Exception as e:
+                result['errors'] = len(batch)
+                logger.error(f"Error writing batch of {len(batch)} documents to {self.name}: {e}")
+            for key, value in result.items():
+                self.stats[key] += value
+            record_write(self.name, result, time.monotonic() - write_start)
+            logger.debug(f"Flushed {len(batch)} documents to {self.name}: {result['inserted']} new, "
+                        f"{result['duplicates']} updated, {result['errors']} errors.")
+            return result
+
+class AccountWriter(Writer):
+    """
+    Writes each account once per process to the accounts sink.
+    """
+    def __init__(self, writer):
+        """
+        Args:
+            writer (Writer): Writer of the accounts, keyed by 'aid'.
+        """
+        self.writer = writer
+        self.name = writer.name
+        self.seen = set()
+        self.lock = threading.Lock()
+
+    def add(self, instance_name, account):
+        """
+        Queues an account unless it was already queued by this process and returns its reference.
+
+        Args:
+            instance_name (str): Name of the instance that returned the account.
+            account (dict): Account returned by the Mastodon API.
+
+        Returns:
+            str: Reference of the account.
+        """
+        aid = account_ref(instance_name, account)
+        with self.lock:
+            if aid in self.seen:
+                return aid
+            self.seen.add(aid)
+        document = dict(account)
+        document['aid'] = aid
+        document['instance_name'] = instance_name
+        document['loadtime'] = datetime.now()
+        self.writer.write(document)
+        return aid
+
+    def write(self, document):
+        self.writer.write(document)
+
+    def flush(self):
+        return self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+def compact_status(item, accounts, status_fields):
+    """
+    Projects a status to the configured fields and replaces its account with a reference.
+
+    Args:
+        item (dict): Status prepared by livefeeds_worker.prepare_livefeed.
+        accounts (AccountWriter): Writer of the accounts collection.
+        status_fields (list): Status fields kept in addition to REQUIRED_STATUS_FIELDS.
+
+    Returns:
+        dict: The compact status.
+    """
+    compact = {field: item[field] for field in REQUIRED_STATUS_FIELDS + status_fields if field in item}
+    if item.get('account'):
+        compact['account_id'] = accounts.add(item['instance_name'], item['account'])
+    return compact
+
+def minimal_account(account):
+    """
+    Projects an account to ENGAGER_FIELDS.
+
+    Args:
+        account (dict): Account returned by the Mastodon API.
+
+    Returns:
+        dict: The account's 'id' and 'acct'.
+    """
+    return {field: account[field] for field in ENGAGER_FIELDS if field in account}
+
+def compact_engagement(document, accounts):
+    """
+    Replaces the reblogger and favouriter accounts of an engagement document with references.
+    Accounts already reduced to ENGAGER_FIELDS are kept as they are.
+
+    Args:
+        document (dict): Document with 'sid', 'reblogs' and 'favourites'.
+        accounts (AccountWriter): Writer of the accounts collection.
+
+    Returns:
+        dict: The compact document.
+    """
+    instance_name = document['sid'].rsplit('#', 1)[0]
+    compact = dict(document)
+    for kind in ('reblogs', 'favourites'):
+        compact[kind] = [
+            account if set(account) <= set(ENGAGER_FIELDS) else accounts.add(instance_name, account)
+            for account in document.get(kind, [])
+        ]
+    return compact
+
+class CompactWriter(Writer):
+    """
+    Writer that stores documents in compact form: embedded accounts are written once to the
+    accounts collection and replaced by references before the documents reach the wrapped writer.
+    """
+    def __init__(self, writer, accounts, transform):
+        """
+        Args:
+            writer (Writer): Writer receiving the compact documents.
+            accounts (AccountWriter): Writer of the accounts collection.
+            transform (callable): Function turning a document and the AccountWriter into its compact form.
+        """
+        self.writer = writer
+        self.accounts = accounts
+        self.transform = transform
+        self.name = writer.name
+
+    def write(self, document):
+        self.writer.write(self.transform(document, self.accounts))
+
+    def flush(self):
+        self.accounts.flush()
+        return self.writer.flush()
+
+    def close(self):
+        self.accounts.close()
+        self.writer.close()
+
+def create_storage(collections, names, config):
+    """
+    Creates the writers of a worker according to the 'writer' and 'storage' configuration.
+    With 'storage.sink: file' the named collections are written to compressed segment files instead
+    of MongoDB. In compact mode the 'livefeeds' and 'boostersfavourites' writers store compact
+    documents and share an AccountWriter for the accounts. Workers writing 'livefeeds' also get the
+    SeenFilter of the stored statuses as 'seen'.
+
+    Args:
+        collections (dict): MongoDB collections, with 'accounts' in compact mode with the MongoDB sink.
+        names (list): Keys of the collections that are only written to.
+        config (Config): Configuration object.
+
+    Returns:
+        dict: A copy of collections with the named entries replaced by Writers.
+    """
+    file_sink = config.storage.get('sink', 'mongo') == 'file'
+    if file_sink:
+        writers = create_file_sinks(collections, names, config.storage, config.writer)
+    else:
+        writers = create_writers(collections, names, config.writer)
+    if 'livefeeds' in names:
+        writers['seen'] = create_seen_filter(collections, config.storage)
+    if not config.storage.get('compact', False):
+        return writers
+    if file_sink:
+        accounts = AccountWriter(create_file_sink('accounts', config.storage, config.writer, dedup_key='aid'))
+    else:
+        accounts = AccountWriter(UpsertWriter(
+            collections['accounts'], 'aid',
+            batch_size=config.writer.get('batch_size', 500),
+            flush_interval=config.writer.get('flush_interval', 5)
+        ))
+    status_fields = config.storage.get('status_fields', DEFAULT_STATUS_FIELDS)
+    if 'livefeeds' in names:
+        writers['livefeeds'] = CompactWriter(
+            writers['livefeeds'], accounts, lambda item, accounts: compact_status(item, accounts, status_fields)
+        )
+    if 'boostersfavourites' in names:
+        writers['boostersfavourites'] = CompactWriter(writers['boostersfavourites'], accounts, compact_engagement)
+    return writers
+
+def expand_documents(documents, accounts_collection):
+    """
+    Rebuilds the full view of compact statuses or engagement documents from the accounts collection.
+    Documents that are already full are returned unchanged.
+
+    Args:
+        documents (iterable): Compact documents, e.g. a cursor over livefeeds or boostersfavourites.
+        accounts_collection (pymongo.collection.Collection): The accounts collection.
+
+    Returns:
+        list: Documents with 'account', 'reblogs' and 'favourites' holding account objects.
+    """
+    documents = list(documents)
+    refs = set()
+    for document in documents:
+        if 'account_id' in document:
+            refs.add(document['account_id'])
+        for kind in ('reblogs', 'favourites'):
+            refs.update(ref for ref in document.get(kind, []) if isinstance(ref, str))
+    accounts = {}
+    if refs:
+        for account in accounts_collection.find({"aid": {"$in": list(refs)}}, {"_id": 0, "loadtime": 0, "instance_name": 0}):
+            accounts[account.pop('aid')] = account
+    for document in documents:
+        if 'account_id' in document:
+            document['account'] = accounts.get(document.pop('account_id'))
+        for kind in ('reblogs', 'favourites'):
+            if kind in document:
+                document[kind] = [accounts.get(ref, ref) if isinstance(ref, str) else ref for ref in document[kind]]
+    return documents
+
+def group_engagements(buckets):
+    """
+    Joins the engagement buckets of each status into one document, in bucket order.
+    An account that appears in several buckets of a status, e.g. after the status was retried
+    without a checkpoint, is kept once.
+
+    Args:
+        buckets (iterable): Documents of the boostersfavourites collection, e.g. a cursor.
+
+    Returns:
+        list: Documents with 'sid', 'reblogs' and 'favourites' holding every engager of a status.
+    """
+    grouped = {}
+    seen = {}
+    for bucket in sorted(buckets, key=lambda bucket: (bucket['sid'], bucket.get('seq', 0))):
+        document = grouped.setdefault(bucket['sid'], {'sid': bucket['sid'], 'reblogs': [], 'favourites': []})
+        for kind in ('reblogs', 'favourites'):
+            ids = seen.setdefault((bucket['sid'], kind), set())
+            for account in bucket.get(kind, []):
+                # Compact buckets hold 'instance#id' references instead of account documents.
+                key = account if isinstance(account, str) else account.get('id')
+                if key in ids:
+                    continue
+                if key is not None:
+                    ids.add(key)
+                document[kind].append(account)
+    return list(grouped.values())
@@ -0,0 +1,469 @@
+# fetcher/streaming.py
+import json
+import time
+import random
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+import aiohttp
+from pymongo import UpdateOne
+from livefeeds_worker import prepare_livefeed
+from utils import instance_url, transform_ISO2datetime
+from writer import close_writers
+from storage import create_storage
+from task_queue import default_owner
+from metrics import metrics, record_request
+
+logger = logging.getLogger(__name__)
+
+STREAM_PATH = "/api/v1/streaming/public/local"
+PAGE_SIZE = 40
+
+def ensure_stream_indexes(collection):
+    """
+    Creates the indexes used to find the instances followed by a host and the expired stream claims.
+
+    Args:
+        collection (pymongo.collection.Collection): The instances collection.
+    """
+    collection.create_index([("stream_owner", 1)], name="stream_owner", sparse=True)
+    collection.create_index([("stream_expires", 1)], name="stream_expires", sparse=True)
+    logger.info(f"Stream indexes ensured for collection '{collection.name}'.")
+
+def claim_stream_instances(instances_collection, owner, limit, lease_seconds=300):
+    """
+    Claims up to limit processable instances that no other host is streaming, or whose stream claim
+    expired because its host stopped renewing it.
+
+    Args:
+        instances_collection (pymongo.collection.Collection): The instances collection.
+        owner (str): Name of the claiming worker.
+        limit (int): Maximum number of instances to claim.
+        lease_seconds (int, optional): Seconds the claim lasts unless it is renewed. Defaults to 300.
+
+    Returns:
+        list: Claimed instance documents with 'name' and, if an earlier host saved it, 'stream_last_id'.
+    """
+    claimed = []
+    while len(claimed) < limit:
+        now = datetime.now()
+        instance_info = instances_collection.find_one_and_update(
+            {"processable": True,
+             "$or": [{"stream_owner": {"$exists": False}}, {"stream_expires": {"$lt": now}}]},
+            {"$set": {"stream_owner": owner, "stream_expires": now + timedelta(seconds=lease_seconds)}},
+            projection={"name": 1, "stream_owner": 1, "stream_last_id": 1},
+            return_document=True,
+            sort=[("statuses", -1)]
+        )
+        if not instance_info:
+            break
+        claimed.append(instance_info)
+    return claimed
+
+def renew_stream_instances(instances_collection, owner, lease_seconds, last_ids):
+    """
+    Extends the claims of a worker and saves the newest status ID of each followed instance, from
+    which a host taking over the instance backfills.
+
+    Args:
+        instances_collection (pymongo.collection.Collection): The instances collection.
+        owner (str): Name of the worker.
+        lease_seconds (int): Seconds the claims last unless they are renewed again.
+        last_ids (dict): Newest status ID by instance name.
+
+    Returns:
+        set: Names of the instances still claimed by the worker.
+    """
+    instances_collection.update_many(
+        {"stream_owner": owner},
+        {"$set": {"stream_expires": datetime.now() + timedelta(seconds=lease_seconds)}}
+    )
+    updates = [UpdateOne({"name": name, "stream_owner": owner}, {"$set": {"stream_last_id": last_id}})
+               for name, last_id in last_ids.items()]
+    if updates:
+        instances_collection.bulk_write(updates, ordered=False)
+    return {doc['name'] for doc in instances_collection.find({"stream_owner": owner}, {"name": 1})}
+
+def release_stream_instances(instances_collection, owner):
+    """
+    Releases every instance streamed by a worker.
+
+    Args:
+        instances_collection (pymongo.collection.Collection): The instances collection.
+        owner (str): Name of the worker.
+    """
+    instances_collection.update_many(
+        {"stream_owner": owner},
+        {"$unset": {"stream_owner": "", "stream_expires": "", "stream_last_id": ""}}
+    )
+
+def to_http_url(streaming_api):
+    """
+    Converts the 'streaming_api' URL advertised by an instance to the base URL of its SSE endpoints.
+
+    Args:
+        streaming_api (str): URL such as 'wss://streaming.example.com'.
+
+    Returns:
+        str: URL such as 'https://streaming.example.com'.
+    """
+    if streaming_api.startswith('wss://'):
+        return 'https://' + streaming_api[len('wss://'):]
+    if streaming_api.startswith('ws://'):
+        return 'http://' + streaming_api[len('ws://'):]
+    return streaming_api
+
+class StreamingCollector:
+    """
+    Collects new local statuses of many instances at once from their 'public:local' server-sent event streams.
+    Instances that do not offer streaming are polled instead. Statuses are stored in the same shape as
+    the statuses fetched by livefeeds_worker.
+    Instances are claimed with a lease that a background task renews, together with the newest status
+    ID seen on each instance. Claims of hosts that stopped renewing them are taken over, and every
+    (re)connected stream is backfilled by polling from the newest status ID, so statuses published while
+    no stream was open are not lost.
+    """
+    def __init__(self, config, collections, token_pool, poll_interval=60, end_time=None, owner=None,
+                 max_streams=500, lease_seconds=300):
+        """
+        Args:
+            config (Config): Configuration object.
+            collections (dict): MongoDB collections ('livefeeds', 'error_log', 'instances').
+            token_pool (TokenPool): Pool of API tokens.
+            poll_interval (int, optional): Seconds between polls of instances without streaming. Defaults to 60.
+            end_time (datetime, optional): Time at which collection stops. Defaults to running until cancelled.
+            owner (str, optional): Claim owner name. Defaults to 'hostname:pid'.
+            max_streams (int, optional): Maximum number of instances followed. Defaults to 500.
+            lease_seconds (int, optional): Seconds without renewal after which another host may take over
+                a followed instance. Defaults to 300.
+        """
+        self.config = config
+        self.collections = create_storage(collections, ['livefeeds'], config)
+        self.token_pool = token_pool
+        self.poll_interval = poll_interval
+        self.end_time = end_time
+        self.owner = owner or default_owner()
+        self.max_streams = max_streams
+        self.lease_seconds = lease_seconds
+        self.scheme = config.api.get('scheme', 'https')
+        self.started_at = datetime.now(timezone.utc).replace(tzinfo=None)
+        self.last_ids = {}
+        self.tasks = {}
+        self.backfills = set()
+
+    async def save_status(self, instance_name, item):
+        """
+        Stores a status received from an instance.
+
+        Args:
+            instance_name (str): Name of the instance.
+            item (dict): Status returned by the Mastodon API.
+        """
+        last_id = self.last_ids.get(instance_name)
+        if last_id is None or int(item['id']) > int(last_id):
+            self.last_ids[instance_name] = item['id']
+        prepare_livefeed(item, instance_name)
+        await asyncio.to_thread(self.collections['livefeeds'].write, item)
+        logger.debug(f"Saved a streamed tweet from {instance_name}.")
+
+    async def get_json(self, session, instance_name, url, params=None, endpoint='timeline'):
+        """
+        Sends a GET request with a leased token.
+
+        Args:
+            session (aiohttp.ClientSession): HTTP session.
+            instance_name (str): Name of the instance.
+            url (str): Request URL.
+            params (dict, optional): Query parameters.
+            endpoint (str, optional): Kind of endpoint recorded in the metrics. Defaults to 'timeline'.
+
+        Returns:
+            tuple: Status code, lower-cased response headers and decoded JSON body (None unless 200).
+        """
+        token, wait_time = self.token_pool.lease(instance_name)
+        if wait_time > 0:
+            metrics.inc('ratelimit_sleep_seconds_total', wait_time)
+            await asyncio.sleep(wait_time)
+        request_start = time.monotonic()
+        try:
+            async with session.get(url, headers=self.token_pool.headers(token), params=params) as response:
+                res_headers = {k.lower(): v for k, v in response.headers.items()}
+                self.token_pool.report(instance_name, token, response.status, res_headers)
+                data = await response.json(content_type=None) if response.status == 200 else None
+        except asyncio.TimeoutError:
+            record_request('timeout', time.monotonic() - request_start, endpoint)
+            raise
+        record_request(response.status, time.monotonic() - request_start, endpoint)
+        return response.status, res_headers, data
+
+    async def discover_stream_url(self, session, instance_name):
+        """
+        Looks up the streaming endpoint advertised in the instance's '/api/v1/instance' document.
+
+        Args:
+            session (aiohttp.ClientSession): HTTP session.
+            instance_name (str): Name of the instance.
+
+        Returns:
+            str or None: URL of the 'public:local' stream, or None if the instance does not advertise one.
+        """
+        try:
+            status_code, _, data = await self.get_json(
+                session, instance_name, instance_url(instance_name, "/api/v1/instance", self.scheme), endpoint='instance'
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Could not look up the streaming endpoint of {instance_name}: {e}")
+            return None
+        streaming_api = (data or {}).get('urls', {}).get('streaming_api') if status_code == 200 else None
+        if not streaming_api:
+            return None
+        return to_http_url(streaming_api).rstrip('/') + STREAM_PATH
+
+    async def stream_instance(self, session, instance_name, stream_url):
+        """
+        Reads the 'public:local' event stream of an instance until the connection drops.
+        Once the stream is established, the statuses published since the newest one seen on the instance,
+        or since the start of the collection, are fetched in the background.
+
+        Args:
+            session (aiohttp.ClientSession): HTTP session.
+            instance_name (str): Name of the instance.
+            stream_url (str): URL of the stream.
+
+        Returns:
+            bool: False if the instance refused the stream, True if an established stream ended.
+        """
+        token, _ = self.token_pool.lease(instance_name)
+        headers = self.token_pool.headers(token)
+        headers['Accept'] = 'text/event-stream'
+        request_start = time.monotonic()
+        async with session.get(stream_url, headers=headers) as response:
+            record_request(response.status, time.monotonic() - request_start, 'stream')
+            res_headers = {k.lower(): v for k, v in response.headers.items()}
+            self.token_pool.report(instance_name, token, response.status, res_headers)
+            if response.status == 401 and token:
+                return True
+            if response.status != 200:
+                logger.info(f"{instance_name} refused streaming ({response.status}), falling back to polling.")
+                return False
+            logger.info(f"Streaming local timeline of {instance_name}.")
+            backfill = asyncio.create_task(self.backfill(session, instance_name))
+            self.backfills.add(backfill)
+            backfill.add_done_callback(self.backfills.discard)
+            event, data_lines = None, []
+            async for raw_line in response.content:
+                line = raw_line.decode('utf-8').rstrip('\r\n')
+                if line.startswith(':'):
+                    continue
+                if line.startswith('event:'):
+                    event = line[len('event:'):].strip()
+                elif line.startswith('data:'):
+                    data_lines.append(line[len('data:'):].strip())
+                elif not line:
+                    if event == 'update' and data_lines:
+                        try:
+                            await self.save_status(instance_name, json.loads('\n'.join(data_lines)))
+                        except (ValueError, KeyError) as e:
+                            logger.warning(f"Malformed status streamed from {instance_name}: {e}")
+                    event, data_lines = None, []
+        return True
+
+    async def fetch_newer(self, session, instance_name):
+        """
+        Fetches the local statuses newer than the newest one seen on an instance, page by page.
+        Without a known status ID, only the newest page is read and statuses created before the
+        collector started are skipped.
+
+        Args:
+            session (aiohttp.ClientSession): HTTP session.
+            instance_name (str): Name of the instance.
+
+        Returns:
+            int: Status code of the last request.
+        """
+        url = instance_url(instance_name, "/api/v1/timelines/public", self.scheme)
+        while True:
+            params = {"local": "true", "limit": PAGE_SIZE}
+            last_id = self.last_ids.get(instance_name)
+            if last_id:
+                params['min_id'] = last_id
+            status_code, _, data = await self.get_json(session, instance_name, url, params)
+            if status_code != 200:
+                return status_code
+            for item in data:
+                if last_id or self.created_since_start(item):
+                    await self.save_status(instance_name, item)
+            if data and not last_id:
+                self.last_ids[instance_name] = max((item['id'] for item in data), key=int)
+            if not last_id or len(data) < PAGE_SIZE:
+                return status_code
+
+    def created_since_start(self, item):
+        try:
+            return transform_ISO2datetime(item['created_at']) >= self.started_at
+        except (KeyError, ValueError):
+            return False
+
+    async def backfill(self, session, instance_name):
+        """
+        Fetches the statuses an instance published while its stream was not connected.
+
+        Args:
+            session (aiohttp.ClientSession): HTTP session.
+            instance_name (str): Name of the instance.
+        """
+        try:
+            status_code = await self.fetch_newer(session, instance_name)
+            if status_code != 200:
+                logger.warning(f"Backfill of {instance_name} failed: {status_code}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Backfill of {instance_name} failed: {e}")
+
+    async def poll_instance(self, session, instance_name):
+        """
+        Polls the local public timeline of an instance for new statuses until cancelled, starting from the
+        newest status seen on the instance or, if none is known, from the start of the collection.
+
+        Args:
+            session (aiohttp.ClientSession): HTTP session.
+            instance_name (str): Name of the instance.
+        """
+        while True:
+            try:
+                status_code = await self.fetch_newer(session, instance_name)
+                if status_code not in [200, 429, 503]:
+                    logger.error(f"Error polling {instance_name}: {status_code}, giving up.")
+                    return
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f"Error polling {instance_name}: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    async def follow_instance(self, session, instance_name):
+        """
+        Follows an instance through its stream, reconnecting with backoff, or by polling if it has none.
+        Every connection backfills the statuses missed while the stream was down.
+
+        Args:
+            session (aiohttp.ClientSession): HTTP session.
+            instance_name (str): Name of the instance.
+        """
+        stream_url = await self.discover_stream_url(session, instance_name)
+        backoff = 1
+        while stream_url:
+            try:
+                if not await self.stream_instance(session, instance_name, stream_url):
+                    break
+                backoff = 1
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f"Stream of {instance_name} dropped: {e}")
+            await asyncio.sleep(backoff + random.random())
+            backoff = min(backoff * 2, 300)
+        await self.poll_instance(session, instance_name)
+
+    async def claim(self, session):
+        """
+        Claims instances until max_streams are followed and starts following them.
+
+        Args:
+            session (aiohttp.ClientSession): HTTP session.
+        """
+        free = self.max_streams - len(self.tasks)
+        if free <= 0:
+            return
+        claimed = await asyncio.to_thread(claim_stream_instances, self.collections['instances'], self.owner, free,
+                                          self.lease_seconds)
+        for instance_info in claimed:
+            name = instance_info['name']
+            if name in self.tasks:
+                continue
+            if instance_info.get('stream_last_id'):
+                self.last_ids[name] = instance_info['stream_last_id']
+                logger.info(f"Took over {name}, backfilling from status {instance_info['stream_last_id']}.")
+            task = asyncio.create_task(self.follow_instance(session, name))
+            task.add_done_callback(lambda task, name=name: self.forget(name, task))
+            self.tasks[name] = task
+        if claimed:
+            logger.info(f"Following {len(self.tasks)} instances.")
+
+    def forget(self, name, task):
+        """
+        Frees the slot of an instance once it is no longer followed, e.g. after polling gave up.
+        The claim is kept and renewed until the collector stops, so the instance is not claimed again.
+
+        Args:
+            name (str): Name of the instance.
+            task (asyncio.Task): The finished task that followed the instance.
+        """
+        if self.tasks.get(name) is task:
+            del self.tasks[name]
+        if not task.cancelled() and task.exception():
+            logger.error(f"Stopped following {name}: {task.exception()!r}")
+
+    async def keep_claims(self, session):
+        """
+        Renews the claims of the followed instances every third of the lease, stops following instances
+        another host took over, and claims instances whose claims expired while there is room.
+
+        Args:
+            session (aiohttp.ClientSession): HTTP session.
+        """
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                last_ids = {name: self.last_ids[name] for name in self.tasks if name in self.last_ids}
+                owned = await asyncio.to_thread(renew_stream_instances, self.collections['instances'], self.owner,
+                                                self.lease_seconds, last_ids)
+                for name in list(self.tasks):
+                    if name not in owned:
+                        logger.warning(f"{name} was taken over by another host, no longer following it.")
+                        self.tasks.pop(name).cancel()
+                await self.claim(session)
+            except Exception:
+                logger.exception("Failed to renew stream claims")
+
+    async def run(self):
+        """
+        Claims instances and follows them until end_time or until cancelled.
+        """
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=300)
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            await self.claim(session)
+            keeper = asyncio.create_task(self.keep_claims(session))
+            try:
+                if self.end_time:
+                    remaining = (self.end_time - datetime.now()).total_seconds()
+                    await asyncio.wait([keeper], timeout=max(remaining, 0))
+                else:
+                    await keeper
+            finally:
+                tasks = [keeper, *self.tasks.values(), *self.backfills]
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                await asyncio.to_thread(close_writers, self.collections)
+
+def run_streaming(config, collections, token_pool, max_streams=500, poll_interval=60, end_time=None, lease_seconds=300):
+    """
+    Claims instances and collects their new statuses until end_time or until interrupted.
+
+    Args:
+        config (Config): Configuration object.
+        collections (dict): MongoDB collections ('livefeeds', 'error_log', 'instances').
+        token_pool (TokenPool): Pool of API tokens.
+        max_streams (int, optional): Maximum number of instances followed by this host. Defaults to 500.
+        poll_interval (int, optional): Seconds between polls of instances without streaming. Defaults to 60.
+        end_time (datetime, optional): Time at which collection stops. Defaults to running until interrupted.
+        lease_seconds (int, optional): Seconds without renewal after which another host may take over a
+            followed instance. Defaults to 300.
+    """
+    owner = default_owner()
+    ensure_stream_indexes(collections['instances'])
+    collector = StreamingCollector(config, collections, token_pool, poll_interval=poll_interval, end_time=end_time,
+                                   owner=owner, max_streams=max_streams, lease_seconds=lease_seconds)
+    try:
+        asyncio.run(collector.run())
+    except KeyboardInterrupt:
+        logger.info("Streaming interrupted.")
+    finally:
+        release_stream_instances(collections['instances'], owner)
@@ -0,0 +1,229 @@
+# fetcher/task_queue.py
+import os
+import socket
+import uuid
+import logging
+from collections import deque
+from datetime import datetime, timedelta
+from retry import RetryPolicy, RETRY_FIELDS, due_query, dead_letter
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+def default_owner():
+    """
+    Returns the lease owner name of the calling process.
+
+    Returns:
+        str: 'hostname:pid'.
+    """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def ensure_status_indexes(collection):
+    """
+    Creates the indexes used to claim statuses from the livefeeds collection.
+    'status_next_attempt_at' was created sparse by earlier versions; a sparse index cannot serve the
+    statuses without 'next_attempt_at', so it is dropped and created again without the option.
+
+    Args:
+        collection (pymongo.collection.Collection): The livefeeds collection.
+    """
+    collection.create_index([("status", 1), ("instance_name", 1)], name="status_instance")
+    collection.create_index([("status", 1), ("lease_expires", 1)], name="status_lease_expires")
+    if collection.index_information().get('status_next_attempt_at', {}).get('sparse'):
+        collection.drop_index('status_next_attempt_at')
+    collection.create_index([("status", 1), ("next_attempt_at", 1)], name="status_next_attempt_at")
+    collection.create_index([("lease_id", 1)], name="lease_id", sparse=True)
+    logger.info(f"Claim indexes ensured for collection '{collection.name}'.")
+
+class StatusQueue:
+    """
+    Claims pending statuses in batches and hands them out from an in-process prefetch queue.
+    A claimed status is set to 'read' with a lease owner, lease ID and expiry. Completing it removes
+    the lease, releasing it sets it back to 'pending', and statuses whose lease expired, e.g. because
+    their worker crashed, are claimed again by any worker. Leases are renewed when a status is handed
+    out and by a scheduler.Heartbeat thread while it is processed, so slow statuses are not taken over.
+    A failed status is set back to 'pending' with a 'next_attempt_at' from the RetryPolicy and is not
+    claimed before then; after the last attempt it is set to 'dead' and recorded in the dead_letters
+    collection.
+    """
+    def __init__(self, collection, owner=None, batch_size=20, lease_seconds=600, retry_policy=None, dead_letters=None):
+        """
+        Args:
+            collection (pymongo.collection.Collection): The livefeeds collection.
+            owner (str, optional): Lease owner name. Defaults to 'hostname:pid'.
+            batch_size (int, optional): Number of statuses claimed at once. Defaults to 20.
+            lease_seconds (int, optional): Seconds after which an unfinished claim can be taken over. Defaults to 600.
+            retry_policy (RetryPolicy, optional): Backoff of failed statuses. Defaults to RetryPolicy().
+            dead_letters (pymongo.collection.Collection, optional): Collection of given up statuses.
+        """
+        self.collection = collection
+        self.owner = owner or default_owner()
+        self.batch_size = batch_size
+        self.lease = timedelta(seconds=lease_seconds)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.dead_letters = dead_letters
+        self.prefetched = deque()
+
+    @staticmethod
+    def claimable_query(now, excluded_instances):
+        return {
+            "$or": [
+                {"status": "pending", **due_query(now)},
+                {"status": "read", "lease_expires": {"$lt": now}}
+            ],
+            "instance_name": {"$nin": excluded_instances}
+        }
+
+    def claim_batch(self, excluded_instances):
+        """
+        Atomically claims up to batch_size statuses with a single lease ID.
+
+        Args:
+            excluded_instances (list): Instances whose statuses must not be claimed.
+
+        Returns:
+            list: The claimed statuses.
+        """
+        now = datetime.now()
+        query = self.claimable_query(now, excluded_instances)
+        candidate_ids = [doc['_id'] for doc in self.collection.find(query, {"_id": 1}).limit(self.batch_size)]
+        if not candidate_ids:
+            return []
+        lease_id = uuid.uuid4().hex
+        query["_id"] = {"$in": candidate_ids}
+        self.collection.update_many(query, {"$set": {
+            "status": "read",
+            "lease_owner": self.owner,
+            "lease_id": lease_id,
+            "lease_expires": now + self.lease
+        }})
+        claimed = list(self.collection.find({"lease_id": lease_id}))
+        logger.debug(f"Claimed {len(claimed)} statuses.")
+        return claimed
+
+    def get(self, excluded_instances):
+        """
+        Returns the next claimed status, claiming a new batch when the prefetch queue is empty.
+        Prefetched statuses of instances that became excluded are released.
+
+        Args:
+            excluded_instances (list): Instances whose statuses must not be returned.
+
+        Returns:
+            dict or None: The status information or None if nothing is claimable.
+        """
+        excluded = set(excluded_instances)
+        while True:
+            if not self.prefetched:
+                self.prefetched.extend(self.claim_batch(list(excluded)))
+                if not self.prefetched:
+                    return None
+            status = self.prefetched.popleft()
+            if status['instance_name'] in excluded:
+                self.release(status)
+                continue
+            self.renew(status)
+            return status
+
+    def renew(self, status):
+        """
+        Extends the lease of a status that is handed out if it waited in the prefetch queue for more
+        than a third of the lease.
+
+        Args:
+            status (dict): The claimed status.
+        """
+        now = datetime.now()
+        if status['lease_expires'] - now > self.lease * 2 / 3:
+            return
+        status['lease_expires'] = now + self.lease
+        self.collection.update_one(
+            {"_id": status["_id"], "lease_id": status["lease_id"]},
+            {"$set": {"lease_expires": status['lease_expires']}}
+        )
+
+    def heartbeat(self):
+        """
+        Extends every lease held by this worker, both of prefetched statuses and of the one being processed.
+        """
+        self.collection.update_many(
+            {"status": "read", "lease_owner": self.owner, "lease_id": {"$exists": True}},
+            {"$set": {"lease_expires": datetime.now() + self.lease}}
+        )
+
+    def complete(self, status):
+        """
+        Marks a claimed status as processed.
+
+        Args:
+            status (dict): The claimed status.
+        """
+        result = self.collection.update_one(
+            {"_id": status["_id"], "lease_id": status["lease_id"]},
+            {"$unset": {field: "" for field in ["lease_owner", "lease_id", "lease_expires"] + RETRY_FIELDS}}
+        )
+        if not result.matched_count:
+            metrics.inc('lost_leases_total', kind='engagement')
+            logger.warning(f"Lease of {status['instance_name']}#{status['id']} expired and was taken over before it was completed.")
+
+    def release(self, status):
+        """
+        Gives a claimed status back so that it can be claimed again.
+
+        Args:
+            status (dict): The claimed status.
+        """
+        self.collection.update_one(
+            {"_id": status["_id"], "lease_id": status["lease_id"]},
+            {"$set": {"status": "pending"}, "$unset": {"lease_owner": "", "lease_id": "", "lease_expires": ""}}
+        )
+
+    def defer(self, status, seconds):
+        """
+        Gives a claimed status back without counting an attempt, e.g. while its instance is rate limited.
+
+        Args:
+            status (dict): The claimed status.
+            seconds (float): Seconds before the status can be claimed again.
+        """
+        self.collection.update_one(
+            {"_id": status["_id"], "lease_id": status["lease_id"]},
+            {"$set": {"status": "pending", "next_attempt_at": datetime.now() + timedelta(seconds=seconds)},
+             "$unset": {"lease_owner": "", "lease_id": "", "lease_expires": ""}}
+        )
+
+    def retry(self, status, error):
+        """
+        Gives a failed status back with a delayed next attempt, or dead-letters it after the last attempt
+        or a failure that is not worth retrying.
+
+        Args:
+            status (dict): The claimed status.
+            error (dict): Error from retry.crawl_error.
+
+        Returns:
+            bool: True if a retry was scheduled, False if the status was given up.
+        """
+        attempts = status.get('attempts', 0) + 1
+        next_attempt_at = self.retry_policy.next_attempt(attempts, error)
+        update = {"attempts": attempts, "last_error": error}
+        if next_attempt_at:
+            update.update({"status": "pending", "next_attempt_at": next_attempt_at})
+            metrics.inc('retries_scheduled_total', kind='engagement')
+        else:
+            update["status"] = "dead"
+        self.collection.update_one(
+            {"_id": status["_id"], "lease_id": status["lease_id"]},
+            {"$set": update, "$unset": {"lease_owner": "", "lease_id": "", "lease_expires": ""}}
+        )
+        if not next_attempt_at:
+            dead_letter(self.dead_letters, 'engagement', status['sid'], attempts, error)
+        return next_attempt_at is not None
+
+    def release_all(self):
+        """
+        Gives back every prefetched status that was not handed out yet.
+        """
+        while self.prefetched:
+            self.release(self.prefetched.popleft())
@@ -0,0 +1,151 @@
+# fetcher/token_pool.py
+import math
+import hashlib
+import logging
+from ratelimit import RateLimitRegistry, ANONYMOUS, create_registry, create_controller
+
+logger = logging.getLogger(__name__)
+
+def token_fingerprint(token):
+    """
+    Returns a short, stable identifier of a token that is safe to store and log.
+
+    Args:
+        token (str): API token.
+
+    Returns:
+        str: The first 12 hex digits of the token's SHA-1 hash.
+    """
+    return hashlib.sha1(token.encode('utf-8')).hexdigest()[:12]
+
+class TokenPool:
+    """
+    Leases API tokens to requests by the rate limit budget each token has left on an instance.
+    Every (instance, token) pair has its own bucket in the RateLimitRegistry, so a request goes to
+    the token that can be used soonest and the pool rotates to a fresh token when one nears its limit.
+    The registry returns the buckets of all tokens of an instance at once, so a lease costs the same
+    number of round trips however many tokens the pool has.
+    Tokens answered with 401 by an instance are retired for that instance; requests fall back to
+    no token when an instance has retired all of them. With an AdaptiveController, requests to an
+    instance are also spaced by the load the instance has shown it can take.
+    """
+    def __init__(self, tokens, registry=None, email='', controller=None):
+        """
+        Args:
+            tokens (list): List of API tokens.
+            registry (RateLimitRegistry, optional): Shared rate limit registry. Defaults to a process-local one.
+            email (str, optional): Contact address sent with every request. Defaults to ''.
+            controller (AdaptiveController, optional): Per-instance load controller. Defaults to None.
+        """
+        self.tokens = {token_fingerprint(token): token for token in tokens if token.strip()}
+        self.registry = registry if registry is not None else RateLimitRegistry()
+        self.email = email
+        self.controller = controller
+
+    def lease(self, instance):
+        """
+        Picks the token that can be used soonest on an instance and takes one request from its bucket.
+        Ties are broken by the remaining budget, so load spreads over all tokens.
+
+        Args:
+            instance (str): Instance name.
+
+        Returns:
+            tuple: The token (None for anonymous requests) and the seconds to wait before sending.
+        """
+        token_id, wait_time = self.registry.reserve(instance, list(self.tokens))
+        if self.controller is not None:
+            wait_time = max(wait_time, self.controller.reserve(instance))
+        return self.tokens.get(token_id), wait_time
+
+    def headers(self, token):
+        """
+        Builds the HTTP headers for a request made with a leased token.
+
+        Args:
+            token (str or None): The leased token.
+
+        Returns:
+            dict: HTTP headers.
+        """
+        headers = {'Email': self.email}
+        if token:
+            headers['Authorization'] = f'Bearer {token}'
+        return headers
+
+    def report(self, instance, token, status_code, res_headers, latency=None):
+        """
+        Records the outcome of a request made with a leased token.
+
+        Args:
+            instance (str): Instance name.
+            token (str or None): The leased token.
+            status_code (int): HTTP status code of the response.
+            res_headers (dict): Lower-cased response headers.
+            latency (float, optional): Seconds the request took.
+        """
+        token_id = token_fingerprint(token) if token else ANONYMOUS
+        self.registry.update(instance, token_id, res_headers)
+        if self.controller is not None:
+            self.controller.observe(instance, status_code, latency)
+        if status_code == 401 and token:
+            self.registry.retire(instance, token_id)
+            logger.warning(f"Token {token_id} was rejected by {instance}, retiring it for this instance.")
+
+    def report_timeout(self, instance):
+        """
+        Records a request to an instance that timed out.
+
+        Args:
+            instance (str): Instance name.
+        """
+        if self.controller is not None:
+            self.controller.observe(instance, 'timeout')
+
+    def penalize(self, instance, token, seconds):
+        """
+        Blocks a token on an instance for a fixed time, e.g. after repeated 429 or 503 responses.
+
+        Args:
+            instance (str): Instance name.
+            token (str or None): The leased token.
+            seconds (float): Seconds to block the token for.
+        """
+        token_id = token_fingerprint(token) if token else ANONYMOUS
+        self.registry.penalize(instance, token_id, seconds)
+
+    def limited_instances(self):
+        """
+        Returns the instances on which every active token is currently blocked, from a single read of
+        the blocked tokens of all instances.
+
+        Returns:
+            list: Names of the blocked instances.
+        """
+        limited = []
+        for instance, blocked in self.registry.blocked_tokens().items():
+            active = [token_id for token_id in self.tokens if blocked.get(token_id) != math.inf] or [ANONYMOUS]
+            if all(token_id in blocked for token_id in active):
+                limited.append(instance)
+        return limited
+
+def create_token_pool(tokens, mode, email='', manager=None, central_db=None, adaptive=None):
+    """
+    Creates the token pool of a worker together with its rate limit registry.
+
+    Args:
+        tokens (list): List of API tokens.
+        mode (str): 'host' to share the budgets between the processes of this host, 'cluster' to share them
+            between all hosts through the central MongoDB.
+        email (str, optional): Contact address sent with every request. Defaults to ''.
+        manager (multiprocessing.managers.SyncManager, optional): Manager used in 'host' mode.
+            Without a manager the pool is local to the calling process, e.g. for the async engine.
+        central_db (pymongo.database.Database, optional): Central database used in 'cluster' mode.
+        adaptive (dict, optional): Settings of the AdaptiveController from the 'adaptive' configuration.
+
+    Returns:
+        TokenPool: The token pool.
+    """
+    registry = create_registry(mode, manager=manager, central_db=central_db)
+    controller = create_controller(mode, manager=manager, central_db=central_db, **(adaptive or {}))
+    return TokenPool(tokens, registry, email=email, controller=controller)
@@ -1,9 +1,11 @@
 # fetcher/utils.py
 import logging
 from pymongo.errors import DuplicateKeyError
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 import time
 import math
+import re
+from writer import Writer
 
 logger = logging.getLogger(__name__)
 
@@ -38,23 +40,66 @@ def judge_sleep(res_headers, instance_name):
     Returns:
         bool: False if slept, True otherwise.
     """
+    sleep_time = get_ratelimit_sleep_time(res_headers)
+    if sleep_time > 0:
+        logger.info(f"[{instance_name}] Rate limit reached. Sleeping for {sleep_time:.1f} seconds")
+        time.sleep(sleep_time)
+        return False
+    return True
+
+def get_ratelimit_sleep_time(res_headers):
+    """
+    Computes how long to wait before the next request according to the rate limit headers.
+    
+    Args:
+        res_headers (dict): Response headers from the API.
+    
+    Returns:
+        float: Seconds until the rate limit resets, or 0 if the limit is not exhausted.
+    """
     res_headers = {k.lower(): v for k, v in res_headers.items()}
     if int(res_headers.get('x-ratelimit-remaining', 2)) <= 0:
-        target_time_str = res_headers.get('x-ratelimit-reset')
-        if target_time_str:
-            if target_time_str.endswith('Z'):
-                target_time_str = target_time_str[:-1] + '+00:00'
-            try:
-                target_time = datetime.fromisoformat(target_time_str.replace('T', ' ')).replace(tzinfo=timezone.utc)
-                current_time = datetime.now(timezone.utc)
-                sleep_time = (target_time - current_time).total_seconds()
-                if sleep_time > 0:
-                    logger.info(f"[{instance_name}] Rate limit reached. Sleeping until {target_time.isoformat()}")
-                    time.sleep(sleep_time)
-                    return False
-            except ValueError as e:
-                logger.error(f"Error parsing datetime string: {target_time_str}. Error: {e}")
-    return True
+        target_time = parse_ratelimit_reset(res_headers)
+        if target_time:
+            current_time = datetime.now(timezone.utc)
+            return max((target_time - current_time).total_seconds(), 0)
+    return 0
+
+def parse_ratelimit_reset(res_headers):
+    """
+    Parses the 'x-ratelimit-reset' header.
+    
+    Args:
+        res_headers (dict): Lower-cased response headers from the API.
+    
+    Returns:
+        datetime or None: Time in UTC at which the rate limit resets, or None if unknown.
+    """
+    target_time_str = res_headers.get('x-ratelimit-reset')
+    if not target_time_str:
+        return None
+    if target_time_str.endswith('Z'):
+        target_time_str = target_time_str[:-1] + '+00:00'
+    try:
+        return datetime.fromisoformat(target_time_str.replace('T', ' ')).replace(tzinfo=timezone.utc)
+    except ValueError as e:
+        logger.error(f"Error parsing datetime string: {target_time_str}. Error: {e}")
+        return None
+
+def parse_next_max_id(res_headers):
+    """
+    Extracts the 'max_id' of the next page from the Link header.
+    
+    Args:
+        res_headers (dict): Lower-cased response headers from the API.
+    
+    Returns:
+        str or None: The 'max_id' of the next page, or None if there is none.
+    """
+    match = re.search(r'max_id=(\d+)', res_headers.get('link', ''))
+    if match:
+        return match.group(1)
+    return None
 
 def rename_key(d, old_key, new_key):
     """
@@ -77,7 +122,7 @@ def save_error_log(collection, data_name, object_name, content, res_code='None',
     Saves an error log entry to the specified MongoDB collection.
     
     Args:
-        collection (pymongo.collection.Collection): The MongoDB collection for error logs.
+        collection (pymongo.collection.Collection or Writer): The MongoDB collection for error logs.
         data_name (str): Name of the data source.
         object_name (str): Name of the object involved.
         content (str): Content related to the error.
@@ -94,11 +139,28 @@ def save_error_log(collection, data_name, object_name, content, res_code='None',
         "error_message": error_message
     }
     try:
-        collection.insert_one(log_entry)
+        if isinstance(collection, Writer):
+            collection.write(log_entry)
+        else:
+            collection.insert_one(log_entry)
         logger.info(f"Saved error log: {log_entry}")
     except Exception as e:
         logger.error(f"Failed to save error log: {e}")
 
+def instance_url(instance_name, path, scheme='https'):
+    """
+    Builds the URL of an API endpoint on a Mastodon instance.
+    
+    Args:
+        instance_name (str): Name of the instance.
+        path (str): Path of the endpoint, starting with '/'.
+        scheme (str, optional): URL scheme, 'http' only for local stand-in servers. Defaults to 'https'.
+    
+    Returns:
+        str: The endpoint URL.
+    """
+    return f"{scheme}://{instance_name}{path}"
+
 def transform_ISO2datetime(time_str):
     """
     Converts an ISO 8601 formatted string to a datetime object.
@@ -138,48 +200,62 @@ def compute_round_time(global_duration):
     return math.ceil(hours_diff)
 
 
-def judge_sleep_limit_table(res_headers,instance_name,limit_dict,limit_set):
-    res_headers = {k.lower(): v for k, v in res_headers.items()}
-    if int(res_headers.get('x-ratelimit-remaining', 2)) <= 0:
-        target_time_str = res_headers.get('x-ratelimit-reset')
-        if target_time_str is not None:
-            if target_time_str.endswith('Z'):
-                target_time_str = target_time_str[:-1] + '+00:00'
-            try:
-                target_time = datetime.fromisoformat(target_time_str.replace('T', ' ')).replace(tzinfo=timezone.utc)
-                current_time = datetime.now(timezone.utc)  # 使用UTC时区
-                sleep_time = (target_time - current_time).total_seconds()
-                if sleep_time > 0:
-                    logger.info(current_time,'sleep to',target_time)
-                    time.sleep(sleep_time)
-                    return False
-            except ValueError as e:
-                logger.error(f"Error parsing datetime string: {target_time_str}. Error: {e}")
-
-    if int(res_headers.get('x-ratelimit-remaining', 2)) <= 50:
-        target_time_str = res_headers.get('x-ratelimit-reset')
-        if target_time_str is not None:
-            if target_time_str.endswith('Z'):
-                target_time_str = target_time_str[:-1] + '+00:00'
-            try:
-                target_time = datetime.fromisoformat(target_time_str.replace('T', ' ')).replace(tzinfo=timezone.utc)
-                current_time = datetime.now(timezone.utc)  
-                if target_time>current_time:
-                    limit_dict[instance_name] = target_time.isoformat()
-                    limit_set.add(instance_name)
-                    logger.info(f"take {instance_name} into limit dict")
-                    return True
-            except ValueError as e:
-                logger.error(f"Error parsing datetime string: {target_time_str}. Error: {e}")
-
-
-def judge_api_islimit(limit_dict,limit_set):
-    current_time = datetime.now(timezone.utc)
-    keys_deleted = []
-    for key,value in limit_dict.items():
-        target_time = datetime.fromisoformat(value.replace('T', ' ')).replace(tzinfo=timezone.utc)
-        if target_time <= current_time:
-            limit_set.discard(key)
-            keys_deleted.append(key)
-    for item in keys_deleted:
-        del limit_dict[item]
\ No newline at end of file
+def datetime2snowflake(dt):
+    """
+    Converts a UTC datetime to the smallest Mastodon snowflake ID created at that millisecond.
+    Mastodon status IDs store the creation time in milliseconds in the bits above the lower 16.
+    
+    Args:
+        dt (datetime): Naive datetime in UTC.
+    
+    Returns:
+        int: Snowflake ID.
+    """
+    milliseconds = int(dt.replace(tzinfo=timezone.utc).timestamp() * 1000)
+    return milliseconds << 16
+
+def snowflake2datetime(status_id):
+    """
+    Extracts the creation time from a Mastodon snowflake ID.
+    
+    Args:
+        status_id (str or int): Snowflake ID.
+    
+    Returns:
+        datetime: Naive datetime in UTC.
+    """
+    milliseconds = int(status_id) >> 16
+    return datetime.fromtimestamp(milliseconds / 1000, tz=timezone.utc).replace(tzinfo=None)
+
+def is_snowflake_status(status, tolerance=timedelta(minutes=1)):
+    """
+    Checks whether the ID of a status encodes its creation time.
+    
+    Args:
+        status (dict): Status returned by the Mastodon API.
+        tolerance (timedelta, optional): Allowed difference to 'created_at'. Defaults to one minute.
+    
+    Returns:
+        bool: True if the ID is a snowflake matching 'created_at', False otherwise.
+    """
+    try:
+        id_time = snowflake2datetime(status['id'])
+        return abs(id_time - transform_ISO2datetime(status['created_at'])) <= tolerance
+    except (KeyError, ValueError, OverflowError, OSError):
+        return False
+
+def compute_seek_bounds(duration):
+    """
+    Computes the snowflake ID bounds of a time window for the timeline endpoints.
+    'max_id' and 'since_id' are exclusive, so the bounds are shifted to keep both ends of the window.
+    
+    Args:
+        duration (dict): Dictionary containing 'start_time' and 'end_time'.
+    
+    Returns:
+        dict: 'max_id' and 'since_id' covering the window.
+    """
+    return {
+        'max_id': str(datetime2snowflake(duration['end_time'] + timedelta(milliseconds=1))),
+        'since_id': str(datetime2snowflake(duration['start_time']) - 1)
+    }
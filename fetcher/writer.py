@@ -0,0 +1,217 @@
+# fetcher/writer.py
+import time
+import threading
+import logging
+from abc import ABC, abstractmethod
+from pymongo.errors import BulkWriteError
+from metrics import record_write
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY_ERROR = 11000
+
+class Writer(ABC):
+    """
+    Interface of everything the workers write documents to.
+    """
+    @abstractmethod
+    def write(self, document):
+        pass
+
+    @abstractmethod
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+class FlushTimer(threading.Thread):
+    """
+    Background thread that flushes a writer whose buffer waited flush_interval seconds, so documents
+    are written in time even when no further document arrives.
+    """
+    def __init__(self, writer, interval):
+        """
+        Args:
+            writer (Writer): Writer with a maybe_flush method.
+            interval (float): Seconds between checks.
+        """
+        super().__init__(daemon=True, name=f"flush-{writer.name}")
+        self.writer = writer
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.writer.maybe_flush()
+            except Exception as e:
+                logger.error(f"Error flushing {self.writer.name}: {e}")
+
+    def stop(self):
+        self.stopped.set()
+        if self is not threading.current_thread():
+            self.join()
+
+def start_flush_timer(writer):
+    """
+    Starts the FlushTimer of a writer in the current process unless it is running. Writers are used
+    by the process that created them or by a forked one, so the timer is started with the first write.
+    Must be called with writer.lock held.
+
+    Args:
+        writer (Writer): Writer with 'flush_interval' and 'timer' attributes.
+    """
+    if writer.flush_interval and (writer.timer is None or not writer.timer.is_alive()):
+        writer.timer = FlushTimer(writer, writer.flush_interval / 2)
+        writer.timer.start()
+
+def stop_flush_timer(writer):
+    """
+    Stops the FlushTimer of a writer, if it has one.
+
+    Args:
+        writer (Writer): Writer with a 'timer' attribute.
+    """
+    if writer.timer is not None:
+        writer.timer.stop()
+        writer.timer = None
+
+class BufferedWriter(Writer):
+    """
+    Collects documents for a MongoDB collection and writes them with unordered insert_many batches.
+    A batch is flushed when it reaches batch_size documents or when flush_interval seconds have
+    passed since the last flush, checked on every write and by a FlushTimer. Duplicate keys are
+    counted from the bulk result instead of raising.
+    """
+    def __init__(self, collection, batch_size=500, flush_interval=5):
+        """
+        Args:
+            collection (pymongo.collection.Collection): The MongoDB collection to write to.
+            batch_size (int, optional): Number of documents per batch. Defaults to 500.
+            flush_interval (float, optional): Maximum seconds a document waits in the buffer. Defaults to 5.
+        """
+        self.collection = collection
+        self.name = collection.name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.timer = None
+        self.stats = {'inserted': 0, 'duplicates': 0, 'errors': 0}
+
+    def write(self, document):
+        """
+        Adds a document to the buffer and flushes it if the batch is full or due.
+
+        Args:
+            document (dict): The document to insert.
+        """
+        with self.lock:
+            self.buffer.append(document)
+            due = len(self.buffer) >= self.batch_size
+            start_flush_timer(self)
+        if due:
+            self.flush()
+        else:
+            self.maybe_flush()
+
+    def maybe_flush(self):
+        """
+        Flushes the buffer if flush_interval seconds have passed since the last flush.
+        """
+        with self.lock:
+            due = self.buffer and time.monotonic() - self.last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes all buffered documents with a single unordered insert_many. Flushes run one at a time,
+        so when flush returns, every document written before it was called has been sent.
+
+        Returns:
+            dict: Number of documents inserted, skipped as duplicates and failed in this batch.
+        """
+        with self.write_lock:
+            with self.lock:
+                batch, self.buffer = self.buffer, []
+                self.last_flush = time.monotonic()
+            result = {'inserted': 0, 'duplicates': 0, 'errors': 0}
+            if not batch:
+                return result
+            write_start = time.monotonic()
+            try:
+                inserted = self.collection.insert_many(batch, ordered=False)
+                result['inserted'] = len(inserted.inserted_ids)
+            except BulkWriteError as e:
+                details = e.details
+                result['inserted'] = details.get('nInserted', 0)
+                for error in details.get('writeErrors', []):
+                    if error.get('code') == DUPLICATE_KEY_ERROR:
+                        result['duplicates'] += 1
+                    else:
+                        result['errors'] += 1
+                        logger.error(f"Error writing to {self.name}: {error.get('errmsg')}")
+            except Exception as e:
+                result['errors'] = len(batch)
+                logger.error(f"Error writing batch of {len(batch)} documents to {self.name}: {e}")
+            for key, value in result.items():
+                self.stats[key] += value
+            record_write(self.name, result, time.monotonic() - write_start)
+            logger.debug(f"Flushed {len(batch)} documents to {self.name}: {result['inserted']} inserted, "
+                        f"{result['duplicates']} duplicates, {result['errors']} errors.")
+            return result
+
+    def close(self):
+        """
+        Stops the FlushTimer and flushes the remaining documents.
+        """
+        stop_flush_timer(self)
+        self.flush()
+
+def create_writers(collections, names, writer_config=None):
+    """
+    Wraps the named collections in BufferedWriters and leaves the others untouched.
+
+    Args:
+        collections (dict): MongoDB collections.
+        names (list): Keys of the collections that are only written to.
+        writer_config (dict, optional): 'batch_size' and 'flush_interval' settings.
+
+    Returns:
+        dict: A copy of collections with the named entries replaced by BufferedWriters.
+    """
+    writer_config = writer_config or {}
+    writers = dict(collections)
+    for name in names:
+        writers[name] = BufferedWriter(
+            collections[name],
+            batch_size=writer_config.get('batch_size', 500),
+            flush_interval=writer_config.get('flush_interval', 5)
+        )
+    return writers
+
+def flush_writers(collections):
+    """
+    Flushes every Writer in a collections dictionary.
+
+    Args:
+        collections (dict): MongoDB collections and Writers.
+    """
+    for collection in collections.values():
+        if isinstance(collection, Writer):
+            collection.flush()
+
+def close_writers(collections):
+    """
+    Flushes and closes every Writer in a collections dictionary.
+
+    Args:
+        collections (dict): MongoDB collections and Writers.
+    """
+    for collection in collections.values():
+        if isinstance(collection, Writer):
+            collection.close()
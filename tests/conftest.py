@@ -0,0 +1,12 @@
+# tests/conftest.py
+import os
+import sys
+import pytest
+
+# The fetcher scripts import each other by module name, as when they are run from ./fetcher.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fetcher'))
+
+@pytest.fixture
+def db():
+    mongomock = pytest.importorskip('mongomock')
+    return mongomock.MongoClient()['mastodon']
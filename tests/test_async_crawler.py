@@ -0,0 +1,74 @@
+# tests/test_async_crawler.py
+import asyncio
+from types import SimpleNamespace
+import pytest
+
+aiohttp = pytest.importorskip('aiohttp')
+from mock_server import MockMastodon
+from async_crawler import AsyncCrawler
+from token_pool import create_token_pool
+from scheduler import ensure_instance_indexes
+from utils import create_unique_index, compute_round_time
+
+CONFIG = SimpleNamespace(api={'scheme': 'http'}, writer={'batch_size': 100, 'flush_interval': 1}, storage={},
+                         retry={'base_delay': 0.05, 'jitter': 0})
+
+def create_crawler(db, server, adaptive=None, **kwargs):
+    create_unique_index(db['livefeeds'], 'sid')
+    ensure_instance_indexes(db['instances'])
+    db['instances'].insert_many([
+        {"name": name, "processable": True, "round": -1, "statuses": len(instance.ids)}
+        for name, instance in zip(server.instance_names, server.instances.values())
+    ])
+    collections = {name: db[name] for name in ['livefeeds', 'error_log', 'instances', 'dead_letters']}
+    global_duration = {'start_time': server.window_start, 'end_time': server.window_end}
+    return AsyncCrawler(CONFIG, collections, create_token_pool(['token'], 'host', adaptive=adaptive), 0, global_duration,
+                        compute_round_time(global_duration), schedule='single', **kwargs)
+
+def serve(server, coroutine):
+    async def main():
+        await server.start()
+        try:
+            return await coroutine()
+        finally:
+            await server.stop()
+    return asyncio.run(main())
+
+def test_single_pass_crawls_every_instance(db):
+    server = MockMastodon(instances=5, toots=100, latency=0.005, jitter=0, base_port=18710)
+    crawler = create_crawler(db, server, max_concurrency=2)
+    serve(server, crawler.run)
+    assert db['livefeeds'].count_documents({}) == 500
+    assert db['instances'].count_documents({"crawl_state": "done"}) == 5
+
+def test_single_pass_retries_overloaded_instances(db):
+    server = MockMastodon(instances=3, toots=100, latency=0.005, jitter=0, error_rate=0.5, burst_length=2,
+                          base_port=18720)
+    # Keep the window large, so the backoff after an overload before the first latency sample stays short.
+    crawler = create_crawler(db, server, adaptive={'initial_window': 32, 'min_window': 8})
+    crawler.scheduler.poll_interval = 0.05
+    serve(server, crawler.run)
+    assert server.stats[('timeline', 429)] + server.stats[('timeline', 503)] > 0
+    assert db['livefeeds'].count_documents({}) == 300
+
+def run_requests(crawler, server, names):
+    async def requests():
+        crawler.global_semaphore = asyncio.Semaphore(crawler.max_concurrency)
+        async with aiohttp.ClientSession() as session:
+            await asyncio.gather(*[
+                crawler.request(session, name, f"http://{name}/api/v1/timelines/public", {"limit": 1})
+                for name in names
+            ])
+    serve(server, requests)
+
+def test_requests_per_instance_are_limited(db):
+    server = MockMastodon(instances=1, toots=10, latency=0.05, jitter=0, ratelimit=1000, base_port=18730)
+    crawler = create_crawler(db, server, per_host=2)
+    run_requests(crawler, server, server.instance_names * 8)
+    assert server.max_in_flight[18730] == 2
+
+def test_requests_in_total_are_limited(db):
+    server = MockMastodon(instances=6, toots=10, latency=0.05, jitter=0, ratelimit=1000, base_port=18740)
+    crawler = create_crawler(db, server, max_concurrency=3, per_host=2)
+    run_requests(crawler, server, server.instance_names * 2)
+    assert server.max_in_flight['total'] == 3
@@ -0,0 +1,65 @@
+# tests/test_engagements.py
+import pytest
+from storage import group_engagements
+from reblog_favourite import EngagementBuckets, ensure_engagement_indexes, migrate_engagement_buckets
+
+def test_group_engagements_joins_buckets_in_order():
+    buckets = [
+        {"sid": "a#1", "seq": 1, "reblogs": [{"id": "3"}], "favourites": []},
+        {"sid": "a#1", "seq": 0, "reblogs": [{"id": "1"}, {"id": "2"}], "favourites": [{"id": "1"}]},
+    ]
+    assert group_engagements(buckets) == [
+        {"sid": "a#1", "reblogs": [{"id": "1"}, {"id": "2"}, {"id": "3"}], "favourites": [{"id": "1"}]}
+    ]
+
+def test_group_engagements_keeps_repeated_accounts_once():
+    buckets = [
+        {"sid": "a#1", "seq": 0, "reblogs": [{"id": "1"}], "favourites": []},
+        {"sid": "a#1", "seq": 1, "reblogs": [{"id": "1"}, {"id": "2"}], "favourites": []},
+    ]
+    assert group_engagements(buckets)[0]['reblogs'] == [{"id": "1"}, {"id": "2"}]
+
+def test_group_engagements_of_compact_buckets():
+    buckets = [
+        {"sid": "a#1", "seq": 0, "reblogs": ["a#1", "b#7"], "favourites": ["a#1"]},
+        {"sid": "a#1", "seq": 1, "reblogs": ["b#7", "a#2"], "favourites": []},
+    ]
+    assert group_engagements(buckets) == [{"sid": "a#1", "reblogs": ["a#1", "b#7", "a#2"], "favourites": ["a#1"]}]
+
+class ListWriter:
+    def __init__(self):
+        self.documents = []
+
+    def write(self, document):
+        self.documents.append(document)
+
+def test_buckets_are_written_when_full():
+    writer = ListWriter()
+    buckets = EngagementBuckets('a#1', writer, bucket_size=2)
+    buckets.add('reblogs', [{"id": "1"}])
+    assert not buckets.full()
+    buckets.add('favourites', [{"id": "2"}, {"id": "3"}])
+    assert buckets.full() and buckets.write()
+    buckets.add('reblogs', [{"id": "4"}])
+    assert buckets.write() and not buckets.write()
+    assert [(doc['seq'], doc['bid']) for doc in writer.documents] == [(0, 'a#1#0'), (1, 'a#1#1')]
+    assert writer.documents[0]['favourites'] == [{"id": "2"}, {"id": "3"}]
+
+def test_minimal_buckets_keep_id_and_acct():
+    writer = ListWriter()
+    buckets = EngagementBuckets('a#1', writer, seq=3, minimal=True)
+    buckets.add('reblogs', [{"id": "1", "acct": "user1", "note": "long"}])
+    buckets.write()
+    assert writer.documents == [{"sid": "a#1", "seq": 3, "bid": "a#1#3", "reblogs": [{"id": "1", "acct": "user1"}],
+                                 "favourites": []}]
+
+def test_unconverted_collection_is_refused_and_migrated(db):
+    collection = db['boostersfavourites']
+    collection.create_index([("sid", 1)], unique=True)
+    collection.insert_one({"sid": "a#1", "reblogs": [], "favourites": []})
+    with pytest.raises(RuntimeError, match=r"reblog_favourite\.py --migrate"):
+        ensure_engagement_indexes(collection)
+    assert migrate_engagement_buckets(collection) == 1
+    assert collection.find_one({"sid": "a#1"})['bid'] == 'a#1#0'
+    assert 'sid_1' not in collection.index_information()
+    assert migrate_engagement_buckets(collection) == 0
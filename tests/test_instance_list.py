@@ -0,0 +1,35 @@
+# tests/test_instance_list.py
+from datetime import datetime
+from masto_list_fetcher import build_instance_upsert, load_listed_fields
+
+NOW = datetime(2024, 1, 1)
+
+def refresh(db, items):
+    existing = load_listed_fields(db['instances'])
+    updates = [build_instance_upsert(dict(item), existing.get(item['name']), NOW) for item in items]
+    updates = [update for update in updates if update is not None]
+    if updates:
+        db['instances'].bulk_write(updates)
+    return len(updates)
+
+def test_new_instance_starts_unprocessed(db):
+    assert refresh(db, [{"name": "a", "statuses": "12", "users": 3}]) == 1
+    instance = db['instances'].find_one({"name": "a"})
+    assert instance['statuses'] == 12 and instance['round'] == -1 and instance['processable'] is True
+    assert instance['loadtime'] == NOW
+
+def test_unchanged_instance_is_not_written(db):
+    refresh(db, [{"name": "a", "statuses": 12, "users": 3}])
+    assert refresh(db, [{"name": "a", "statuses": 12, "users": 3}]) == 0
+
+def test_refresh_keeps_the_crawl_state(db):
+    refresh(db, [{"name": "a", "statuses": 12, "users": 3}])
+    db['instances'].update_one({"name": "a"}, {"$set": {"round": 2, "processable": False}})
+    assert refresh(db, [{"name": "a", "statuses": 20, "users": 3, "round": -1, "processable": True}]) == 1
+    instance = db['instances'].find_one({"name": "a"})
+    assert instance['statuses'] == 20 and instance['refreshed_at'] == NOW
+    assert instance['round'] == 2 and instance['processable'] is False
+
+def test_missing_statuses_count_as_zero(db):
+    refresh(db, [{"name": "a", "statuses": None}])
+    assert db['instances'].find_one({"name": "a"})['statuses'] == 0
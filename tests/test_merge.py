@@ -0,0 +1,60 @@
+# tests/test_merge.py
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+from merge import HostMerger, ensure_merge_indexes
+
+def old_id(seconds_ago):
+    return ObjectId.from_datetime(datetime.now(timezone.utc) - timedelta(seconds=seconds_ago))
+
+def create_dbs():
+    client = mongomock.MongoClient()
+    central = client['central']
+    ensure_merge_indexes(central)
+    return client['host'], central
+
+def test_merge_copies_documents_without_bookkeeping():
+    local, central = create_dbs()
+    local['livefeeds'].insert_one({"_id": old_id(600), "sid": "a#1", "content": "hi", "status": "read",
+                                   "lease_owner": "w", "attempts": 2, "last_error": {"code": 503}})
+    counts = HostMerger('host1', local, central, lag=60).merge()
+    assert counts['livefeeds'] == 1
+    merged = central['livefeeds'].find_one({"sid": "a#1"})
+    assert merged['content'] == 'hi' and merged['merged_from'] == 'host1'
+    assert not {'status', 'lease_owner', 'attempts', 'last_error'} & set(merged)
+
+def test_merge_continues_from_high_water_mark():
+    local, central = create_dbs()
+    local['livefeeds'].insert_one({"_id": old_id(600), "sid": "a#1"})
+    merger = HostMerger('host1', local, central, lag=60)
+    merger.merge()
+    local['livefeeds'].insert_one({"_id": old_id(300), "sid": "a#2"})
+    assert merger.merge()['livefeeds'] == 1
+    assert central['livefeeds'].count_documents({}) == 2
+    assert merger.merge()['livefeeds'] == 0
+
+def test_merge_leaves_recent_documents_for_later():
+    local, central = create_dbs()
+    local['livefeeds'].insert_one({"_id": old_id(5), "sid": "a#1"})
+    assert HostMerger('host1', local, central, lag=60).merge()['livefeeds'] == 0
+
+def test_merge_deduplicates_hosts_on_key():
+    local, central = create_dbs()
+    other = mongomock.MongoClient()['other']
+    for db in (local, other):
+        db['livefeeds'].insert_one({"_id": old_id(600), "sid": "a#1"})
+    HostMerger('host1', local, central, lag=60).merge()
+    HostMerger('host2', other, central, lag=60).merge()
+    assert central['livefeeds'].count_documents({"sid": "a#1"}) == 1
+
+def test_merge_picks_up_updated_accounts():
+    local, central = create_dbs()
+    loadtime = datetime.now() - timedelta(minutes=10)
+    local['accounts'].insert_one({"aid": "a#1", "username": "old", "loadtime": loadtime})
+    merger = HostMerger('host1', local, central, lag=60)
+    merger.merge()
+    local['accounts'].update_one({"aid": "a#1"}, {"$set": {"username": "new", "loadtime": loadtime + timedelta(minutes=5)}})
+    assert merger.merge()['accounts'] == 1
+    assert central['accounts'].find_one({"aid": "a#1"})['username'] == 'new'
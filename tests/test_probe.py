@@ -0,0 +1,44 @@
+# tests/test_probe.py
+import errno
+import socket
+import pytest
+
+aiohttp = pytest.importorskip('aiohttp')
+from probe import build_probe_update, is_inconclusive, is_unreachable_error
+
+def probe(db, instance_info, **result):
+    db['instances'].insert_one(instance_info)
+    db['instances'].bulk_write([build_probe_update(instance_info, result)])
+    return db['instances'].find_one({"_id": instance_info['_id']})
+
+def test_inconclusive_results():
+    assert is_inconclusive({'reachable': None, 'public_timeline': None})
+    assert is_inconclusive({'reachable': True, 'public_timeline': None})
+    assert not is_inconclusive({'reachable': False, 'public_timeline': None})
+    assert not is_inconclusive({'reachable': True, 'public_timeline': False})
+
+def test_unhealthy_instance_is_disabled(db):
+    instance = probe(db, {"_id": 1, "name": "a", "processable": True}, reachable=True, public_timeline=False)
+    assert instance['processable'] is False and instance['probe']['disabled'] is True
+
+def test_inconclusive_result_keeps_processable(db):
+    instance = probe(db, {"_id": 1, "name": "a", "processable": True}, reachable=None, public_timeline=None)
+    assert instance['processable'] is True and instance['probe']['disabled'] is False
+
+def test_instance_disabled_by_a_probe_is_enabled_again(db):
+    instance = probe(db, {"_id": 1, "name": "a", "processable": False, "probe": {"disabled": True}},
+                     reachable=True, public_timeline=True)
+    assert instance['processable'] is True and instance['probe']['disabled'] is False
+
+def test_instance_disabled_otherwise_stays_disabled(db):
+    instance = probe(db, {"_id": 1, "name": "a", "processable": False}, reachable=True, public_timeline=True)
+    assert instance['processable'] is False
+
+def connector_error(os_error):
+    return aiohttp.ClientConnectorError(None, os_error)
+
+def test_unreachable_errors():
+    assert is_unreachable_error(connector_error(socket.gaierror(socket.EAI_NONAME, 'Name or service not known')))
+    assert is_unreachable_error(connector_error(ConnectionRefusedError(errno.ECONNREFUSED, 'Connection refused')))
+    assert not is_unreachable_error(connector_error(OSError(errno.ENETUNREACH, 'Network is unreachable')))
+    assert not is_unreachable_error(TimeoutError())
@@ -0,0 +1,81 @@
+# tests/test_ratelimit.py
+import math
+from datetime import datetime, timedelta, timezone
+from ratelimit import RateLimitRegistry, AdaptiveController, ANONYMOUS
+
+def ratelimit_headers(remaining, limit=300, seconds=300):
+    reset = datetime.now(timezone.utc) + timedelta(seconds=seconds)
+    return {'x-ratelimit-limit': str(limit), 'x-ratelimit-remaining': str(remaining),
+            'x-ratelimit-reset': reset.strftime('%Y-%m-%dT%H:%M:%S.000Z')}
+
+def test_requests_go_out_at_once_while_the_budget_lasts():
+    registry = RateLimitRegistry()
+    assert registry.reserve('a', ['t1']) == ('t1', 0)
+    registry.update('a', 't1', ratelimit_headers(200))
+    token_id, wait_time = registry.reserve('a', ['t1'])
+    assert token_id == 't1' and wait_time <= 0
+
+def test_requests_are_spaced_out_when_the_budget_runs_low():
+    registry = RateLimitRegistry(pace_below=0.5)
+    registry.update('a', 't1', ratelimit_headers(100, seconds=100))
+    registry.reserve('a', ['t1'])
+    _, wait_time = registry.reserve('a', ['t1'])
+    # About 100 seconds left for 95 usable requests.
+    assert 0.5 < wait_time < 1.5
+
+def test_exhausted_token_is_blocked_and_another_one_used():
+    registry = RateLimitRegistry(safety_margin=5)
+    registry.update('a', 't1', ratelimit_headers(3))
+    assert registry.reserve('a', ['t1', 't2'])[0] == 't2'
+    assert set(registry.blocked_tokens()) == {'a'}
+    assert 't1' in registry.blocked_tokens()['a']
+
+def test_penalized_token_waits():
+    registry = RateLimitRegistry()
+    registry.penalize('a', 't1', 30)
+    token_id, wait_time = registry.reserve('a', ['t1'])
+    assert token_id == 't1' and 29 < wait_time <= 30
+
+def test_retired_tokens_fall_back_to_anonymous():
+    registry = RateLimitRegistry()
+    registry.retire('a', 't1')
+    assert registry.reserve('a', ['t1', 't2'])[0] == 't2'
+    registry.retire('a', 't2')
+    assert registry.reserve('a', ['t1', 't2'])[0] == ANONYMOUS
+    assert registry.blocked_tokens()['a'] == {'t1': math.inf, 't2': math.inf}
+
+def test_registry_shared_through_mongo(db):
+    registry = RateLimitRegistry.from_mongo(db['ratelimits'])
+    registry.update('a', 't1', ratelimit_headers(3))
+    other = RateLimitRegistry.from_mongo(db['ratelimits'])
+    assert other.reserve('a', ['t1', 't2'])[0] == 't2'
+    assert 't1' in other.blocked_tokens()['a']
+
+def test_window_grows_while_the_instance_is_healthy():
+    controller = AdaptiveController(initial_window=2, max_window=4)
+    for _ in range(20):
+        controller.observe('a', 200, 0.1)
+    assert controller.window('a') == 4
+
+def test_window_is_cut_once_per_round_trip_on_overload():
+    controller = AdaptiveController(initial_window=8, decrease=0.5)
+    controller.observe('a', 200, 10)
+    assert controller.window('a') == 8 + 1 / 8
+    controller.observe('a', 503)
+    # The second overload arrives within the same 10 second round trip.
+    controller.observe('a', 429)
+    assert controller.window('a') == (8 + 1 / 8) * 0.5
+
+def test_rising_latency_counts_as_overload():
+    controller = AdaptiveController(initial_window=8, latency_factor=3, smoothing=1)
+    controller.observe('a', 200, 0.1)
+    window = controller.window('a')
+    controller.observe('a', 200, 1)
+    assert controller.window('a') < window
+
+def test_requests_are_spaced_by_latency_over_window():
+    controller = AdaptiveController(initial_window=4, max_window=4)
+    assert controller.reserve('a') == 0
+    controller.observe('a', 200, 0.4)
+    controller.reserve('a')
+    assert 0.05 < controller.reserve('a') <= 0.1
@@ -0,0 +1,40 @@
+# tests/test_retry.py
+from datetime import datetime, timedelta
+from retry import RetryPolicy, crawl_error, is_retryable, due_query
+
+def test_delay_grows_and_is_capped():
+    policy = RetryPolicy(base_delay=10, max_delay=100, factor=2, jitter=0)
+    assert [policy.delay(attempts) for attempts in range(1, 6)] == [10, 20, 40, 80, 100]
+
+def test_jitter_only_shortens_the_delay():
+    policy = RetryPolicy(base_delay=10, factor=1, jitter=0.5)
+    delays = [policy.delay(1) for _ in range(100)]
+    assert all(5 <= delay <= 10 for delay in delays)
+
+def test_retryable_errors():
+    assert is_retryable(crawl_error(429))
+    assert is_retryable(crawl_error(503))
+    assert is_retryable(crawl_error('timeout'))
+    assert not is_retryable(crawl_error(404))
+    assert not is_retryable(crawl_error(410))
+
+def test_next_attempt():
+    policy = RetryPolicy(base_delay=60, jitter=0, max_attempts=3)
+    next_attempt_at = policy.next_attempt(1, crawl_error(503))
+    assert timedelta(seconds=59) < next_attempt_at - datetime.now() <= timedelta(seconds=60)
+    assert policy.next_attempt(3, crawl_error(503)) is None
+    assert policy.next_attempt(1, crawl_error(404)) is None
+
+def test_crawl_error_truncates_message():
+    assert len(crawl_error(500, 'x' * 1000)['message']) == 500
+    assert crawl_error('timeout')['message'] is None
+
+def test_due_query_matches_items_without_a_future_retry(db):
+    now = datetime.now()
+    db['items'].insert_many([
+        {"name": "new"},
+        {"name": "cleared", "next_attempt_at": None},
+        {"name": "due", "next_attempt_at": now - timedelta(seconds=1)},
+        {"name": "waiting", "next_attempt_at": now + timedelta(seconds=60)},
+    ])
+    assert sorted(doc['name'] for doc in db['items'].find(due_query(now))) == ['cleared', 'due', 'new']
@@ -0,0 +1,87 @@
+# tests/test_scheduler.py
+from datetime import datetime, timedelta
+from scheduler import InstanceScheduler
+from retry import RetryPolicy, crawl_error
+
+def add_instances(collection, sizes):
+    collection.insert_many([
+        {"name": f"instance{i}", "processable": True, "round": -1, "statuses": statuses}
+        for i, statuses in enumerate(sizes)
+    ])
+
+def test_claims_largest_first(db):
+    add_instances(db['instances'], [10, 30, 20])
+    scheduler = InstanceScheduler(db['instances'], owner='a', batch_size=2)
+    first = scheduler.get(None, wait=False)
+    second = scheduler.get(None, wait=False)
+    assert [first['name'], second['name']] == ['instance1', 'instance2']
+    assert first['lease_owner'] == 'a' and first['lease_id'] == second['lease_id']
+    assert db['instances'].find_one({"name": "instance1"})['round'] == 0
+
+def test_workers_do_not_share_instances(db):
+    add_instances(db['instances'], [10, 20, 30])
+    schedulers = [InstanceScheduler(db['instances'], owner=owner) for owner in 'ab']
+    names = []
+    for _ in range(3):
+        for scheduler in schedulers:
+            instance = scheduler.get(None, wait=False)
+            if instance:
+                names.append(instance['name'])
+    assert sorted(names) == ['instance0', 'instance1', 'instance2']
+    assert schedulers[0].get(None, wait=False) is None
+
+def test_claim_batch_without_candidates(db):
+    scheduler = InstanceScheduler(db['instances'], owner='a')
+    assert scheduler.claim_batch(None) is None
+
+def test_complete_removes_lease(db):
+    add_instances(db['instances'], [10])
+    scheduler = InstanceScheduler(db['instances'], owner='a')
+    instance = scheduler.get(None, wait=False)
+    scheduler.complete(instance)
+    stored = db['instances'].find_one({"name": "instance0"})
+    assert 'lease_id' not in stored and 'lease_owner' not in stored
+
+def test_expired_lease_is_requeued(db):
+    add_instances(db['instances'], [10])
+    crashed = InstanceScheduler(db['instances'], owner='crashed')
+    instance = crashed.get(None, wait=False)
+    db['instances'].update_one({"_id": instance["_id"]}, {"$set": {"lease_expires": datetime.now() - timedelta(seconds=1)}})
+    other = InstanceScheduler(db['instances'], owner='other')
+    taken_over = other.get(None, wait=False)
+    assert taken_over['name'] == 'instance0'
+    assert taken_over['lease_owner'] == 'other'
+
+def test_release_all_gives_back_prefetched(db):
+    add_instances(db['instances'], [10, 20])
+    scheduler = InstanceScheduler(db['instances'], owner='a', batch_size=2)
+    scheduler.get(None, wait=False)
+    scheduler.release_all()
+    stored = db['instances'].find_one({"name": "instance0"})
+    assert stored['round'] == -1 and 'lease_id' not in stored
+
+def test_retry_schedules_next_attempt(db):
+    add_instances(db['instances'], [10])
+    scheduler = InstanceScheduler(db['instances'], owner='a', retry_policy=RetryPolicy(base_delay=60, jitter=0))
+    instance = scheduler.get(None, wait=False)
+    assert scheduler.retry(instance, crawl_error(503))
+    stored = db['instances'].find_one({"name": "instance0"})
+    assert stored['round'] == -1 and stored['attempts'] == 1 and stored['next_attempt_at'] > datetime.now()
+    assert scheduler.get(None, wait=False) is None
+    assert scheduler.retries_pending(None)
+
+def test_final_error_is_dead_lettered(db):
+    add_instances(db['instances'], [10])
+    scheduler = InstanceScheduler(db['instances'], owner='a', dead_letters=db['dead_letters'])
+    instance = scheduler.get(None, wait=False)
+    assert not scheduler.retry(instance, crawl_error(404))
+    assert db['instances'].find_one({"name": "instance0"})['processable'] is False
+    assert db['dead_letters'].find_one({"key": "instance0"})['attempts'] == 1
+
+def test_heartbeat_extends_own_leases(db):
+    add_instances(db['instances'], [10])
+    scheduler = InstanceScheduler(db['instances'], owner='a', lease_seconds=300)
+    instance = scheduler.get(None, wait=False)
+    db['instances'].update_one({"_id": instance["_id"]}, {"$set": {"lease_expires": datetime.now() + timedelta(seconds=5)}})
+    scheduler.heartbeat()
+    assert db['instances'].find_one({"_id": instance["_id"]})['lease_expires'] > datetime.now() + timedelta(seconds=200)
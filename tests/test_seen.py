@@ -0,0 +1,54 @@
+# tests/test_seen.py
+from datetime import datetime, timedelta
+import sqlite3
+from seen import IdSet, SeenFilter, mongo_loader, key_index_loader
+from utils import datetime2snowflake
+from livefeeds_worker import save_livefeeds_page
+from scheduler import record_crawl_stats
+
+START = datetime(2024, 1, 1)
+DURATION = {'start_time': START, 'end_time': START + timedelta(hours=1)}
+
+def status(created_at):
+    return {'id': str(datetime2snowflake(created_at)), 'created_at': created_at.strftime('%Y-%m-%dT%H:%M:%S.000Z')}
+
+def test_known_page_stops_paging_and_marks_stats_partial(db):
+    page = [status(START + timedelta(minutes=minutes)) for minutes in (50, 40)]
+    # A status from before the window shows that the stored statuses reach back to its start.
+    known = [status(START - timedelta(minutes=1))] + page
+    seen = SeenFilter(lambda name: [f"{name}#{item['id']}" for item in known])
+    db['instances'].insert_one({"name": "a", "round": 0})
+    collections = {'instances': db['instances'], 'livefeeds': None, 'seen': seen}
+    stats = {'pages': 1, 'statuses': 2}
+    assert save_livefeeds_page(page, {'name': 'a', 'round': 0}, collections, DURATION, 4, {}, stats)
+    assert stats['partial'] and db['instances'].find_one({"name": "a"})['round'] == 4
+    record_crawl_stats(db['instances'], 'a', stats, 10, 1)
+    assert 'crawl_stats' not in db['instances'].find_one({"name": "a"})
+
+def test_id_set_holds_loaded_and_added_ids():
+    ids = IdSet(['30', '10', 'abc'])
+    ids.add('5')
+    ids.add('xyz')
+    assert all(status_id in ids for status_id in ['10', '30', '5', 'abc', 'xyz'])
+    assert '20' not in ids and len(ids) == 5 and ids.min_id == 5
+
+def test_seen_filter_loads_each_instance_once(db):
+    db['livefeeds'].insert_many([{"sid": "a#1"}, {"sid": "a.b#2"}, {"sid": "ab#3"}])
+    calls = []
+    loader = mongo_loader(db['livefeeds'])
+    seen = SeenFilter(lambda name: calls.append(name) or loader(name))
+    assert seen.seen('a', '1') and not seen.seen('a', '2') and not seen.seen('a', '3')
+    seen.add('a', '4')
+    assert seen.seen('a', '4') and calls == ['a']
+    seen.forget('a')
+    assert not seen.seen('a', '4') and calls == ['a', 'a']
+
+def test_key_index_loader(tmp_path):
+    path = str(tmp_path / 'livefeeds.sid.sqlite')
+    assert key_index_loader(path)('a') == []
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE seen (key TEXT PRIMARY KEY)")
+    connection.executemany("INSERT INTO seen VALUES (?)", [("a#1",), ("a#2",), ("ab#3",), ("b#4",)])
+    connection.commit()
+    connection.close()
+    assert sorted(key_index_loader(path)('a')) == ['a#1', 'a#2']
@@ -0,0 +1,52 @@
+# tests/test_shards.py
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+import livefeeds_worker
+from retry import crawl_error
+from shards import split_window
+from utils import compute_seek_bounds
+
+WINDOW = {'start_time': datetime(2024, 1, 1), 'end_time': datetime(2024, 1, 2)}
+
+def test_split_window_covers_window():
+    windows = split_window(WINDOW, 4)
+    assert len(windows) == 4
+    assert windows[0]['start_time'] == WINDOW['start_time']
+    assert windows[-1]['end_time'] == WINDOW['end_time']
+
+def test_split_window_is_disjoint_and_gapless():
+    windows = split_window(WINDOW, 7)
+    for previous, current in zip(windows, windows[1:]):
+        assert current['start_time'] - previous['end_time'] == timedelta(milliseconds=1)
+        assert previous['start_time'] < previous['end_time']
+
+def test_split_window_seek_bounds_meet():
+    # max_id and since_id are exclusive: IDs below max_id belong to the older shard, the others to the newer one.
+    bounds = [compute_seek_bounds(window) for window in split_window(WINDOW, 3)]
+    for previous, current in zip(bounds, bounds[1:]):
+        assert int(current['since_id']) == int(previous['max_id']) - 1
+
+def test_split_window_single_shard():
+    assert split_window(WINDOW, 1) == [WINDOW]
+
+def test_instance_unsharded_in_the_final_phase_is_crawled(db, monkeypatch):
+    db['instances'].insert_many([
+        {"name": "small", "processable": True, "round": -1, "statuses": 1},
+        {"name": "big", "processable": True, "round": 4, "crawl_state": "sharded", "statuses": 2},
+    ])
+    # The shard only becomes claimable once the single pass is running, so it is crawled in the final phase.
+    db['instance_shards'].insert_one({"name": "big", "shard": 0, "shards": 1, "window_start": WINDOW['start_time'],
+                                      "round": -1, "processable": False, "cost": 1})
+    crawled = []
+
+    def fetch_livefeeds(instance_info, *args, **kwargs):
+        crawled.append(instance_info['name'])
+        db['instance_shards'].update_many({}, {"$set": {"processable": True}})
+
+    monkeypatch.setattr(livefeeds_worker, 'fetch_livefeeds', fetch_livefeeds)
+    monkeypatch.setattr(livefeeds_worker, 'fetch_shard', lambda *args: crawl_error('not_snowflake'))
+    config = SimpleNamespace(writer={}, storage={'seen_filter': False}, retry={})
+    collections = {name: db[name] for name in ['instances', 'instance_shards', 'livefeeds', 'error_log', 'dead_letters']}
+    livefeeds_worker.process_task_single(1, config, collections, None, WINDOW, 4)
+    assert crawled == ['small', 'big']
+    assert db['instances'].count_documents({"crawl_state": "done"}) == 2
@@ -0,0 +1,62 @@
+# tests/test_sinks.py
+import os
+import gzip
+import json
+import socket
+import sinks
+from sinks import FileSink
+
+def read_segments(directory, name):
+    documents = []
+    for filename in sorted(os.listdir(directory)):
+        if filename.startswith(name) and filename.endswith('.jsonl.gz'):
+            with gzip.open(os.path.join(directory, filename), 'rt', encoding='utf-8') as segment:
+                documents.extend(json.loads(line) for line in segment)
+    return documents
+
+def test_flush_writes_documents(tmp_path):
+    sink = FileSink(str(tmp_path), 'livefeeds', batch_size=100, flush_interval=60)
+    sink.write({'sid': 'a#1'})
+    sink.write({'sid': 'a#2'})
+    result = sink.flush()
+    sink.close()
+    assert result == {'inserted': 2, 'duplicates': 0, 'errors': 0}
+    assert [doc['sid'] for doc in read_segments(str(tmp_path), 'livefeeds')] == ['a#1', 'a#2']
+
+def test_flush_drops_duplicates(tmp_path):
+    sink = FileSink(str(tmp_path), 'livefeeds', batch_size=100, flush_interval=60)
+    for sid in ['a#1', 'a#1', 'a#2']:
+        sink.write({'sid': sid})
+    assert sink.flush()['duplicates'] == 1
+    sink.write({'sid': 'a#2'})
+    assert sink.flush() == {'inserted': 0, 'duplicates': 1, 'errors': 0}
+    sink.close()
+    assert len(read_segments(str(tmp_path), 'livefeeds')) == 2
+
+def test_failed_flush_does_not_mark_keys_as_written(tmp_path, monkeypatch):
+    class BrokenSegment:
+        def write(self, text):
+            raise OSError("disk full")
+
+        def close(self):
+            pass
+
+    sink = FileSink(str(tmp_path), 'livefeeds', batch_size=100, flush_interval=60)
+    monkeypatch.setattr(sinks, 'open_segment', lambda path, compression: BrokenSegment())
+    sink.write({'sid': 'a#1'})
+    assert sink.flush()['errors'] == 1
+    monkeypatch.undo()
+    sink.write({'sid': 'a#1'})
+    assert sink.flush() == {'inserted': 1, 'duplicates': 0, 'errors': 0}
+    sink.close()
+    assert [doc['sid'] for doc in read_segments(str(tmp_path), 'livefeeds')] == ['a#1']
+
+def test_unfinished_segment_is_recovered(tmp_path):
+    # No process has this PID, so the segment was left behind by a dead one.
+    filename = f"livefeeds-{socket.gethostname()}-999999999-20240101T000000-0001.jsonl.gz"
+    path = os.path.join(str(tmp_path), filename)
+    with gzip.open(path + '.partial', 'wt', encoding='utf-8') as segment:
+        segment.write(json.dumps({'sid': 'a#1'}) + '\n' + '{"sid": "a#')
+    FileSink(str(tmp_path), 'livefeeds').close()
+    assert os.path.exists(path)
+    assert read_segments(str(tmp_path), 'livefeeds') == [{'sid': 'a#1'}]
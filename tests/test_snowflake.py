@@ -0,0 +1,37 @@
+# tests/test_snowflake.py
+from datetime import datetime, timedelta
+from utils import datetime2snowflake, snowflake2datetime, is_snowflake_status, compute_seek_bounds
+from livefeeds_worker import get_seek_bounds, check_seek_page
+
+WINDOW = {'start_time': datetime(2024, 1, 1), 'end_time': datetime(2024, 1, 2)}
+
+def test_snowflake_round_trip():
+    created_at = datetime(2024, 1, 1, 12, 30, 15, 123000)
+    status_id = datetime2snowflake(created_at) + 4242
+    assert snowflake2datetime(status_id) == created_at
+
+def test_is_snowflake_status():
+    created_at = datetime(2024, 1, 1, 12)
+    assert is_snowflake_status({'id': str(datetime2snowflake(created_at)), 'created_at': '2024-01-01T12:00:00.000Z'})
+    assert not is_snowflake_status({'id': '1234', 'created_at': '2024-01-01T12:00:00.000Z'})
+    assert not is_snowflake_status({'id': 'abc', 'created_at': '2024-01-01T12:00:00.000Z'})
+
+def test_seek_bounds_keep_both_ends_of_the_window():
+    bounds = compute_seek_bounds(WINDOW)
+    first = datetime2snowflake(WINDOW['start_time'])
+    last = datetime2snowflake(WINDOW['end_time']) + 0xffff
+    # max_id and since_id are exclusive.
+    assert int(bounds['since_id']) < first and last < int(bounds['max_id'])
+
+def test_seek_bounds_only_for_the_first_round_of_snowflake_instances():
+    assert get_seek_bounds({'round': 0}, WINDOW) == compute_seek_bounds(WINDOW)
+    assert get_seek_bounds({'round': 1}, WINDOW) is None
+    assert get_seek_bounds({'round': 0, 'snowflake': False}, WINDOW) is None
+
+def test_check_seek_page(db):
+    db['instances'].insert_one({"name": "a"})
+    snowflake = {'id': str(datetime2snowflake(datetime(2024, 1, 1, 12))), 'created_at': '2024-01-01T12:00:00.000Z'}
+    assert check_seek_page([snowflake], db['instances'], 'a') == 'seek'
+    assert check_seek_page([], db['instances'], 'a') == 'verify'
+    assert check_seek_page([{'id': '1', 'created_at': '2024-01-01T12:00:00.000Z'}], db['instances'], 'a') == 'scan'
+    assert db['instances'].find_one({"name": "a"})['snowflake'] is False
@@ -0,0 +1,56 @@
+# tests/test_storage.py
+from types import SimpleNamespace
+from storage import (AccountWriter, UpsertWriter, compact_status, compact_engagement, expand_documents,
+                     create_storage, REQUIRED_STATUS_FIELDS)
+from writer import close_writers
+
+def account(account_id):
+    return {"id": str(account_id), "acct": f"user{account_id}", "display_name": f"User {account_id}"}
+
+def status(status_id, account_id):
+    return {"id": str(status_id), "sid": f"a#{status_id}", "instance_name": "a", "content": "hi", "uri": "u",
+            "status": "pending", "account": account(account_id)}
+
+def create_accounts(db):
+    return AccountWriter(UpsertWriter(db['accounts'], 'aid', batch_size=100, flush_interval=60))
+
+def test_compact_status_keeps_configured_fields_and_references_the_account(db):
+    accounts = create_accounts(db)
+    compact = compact_status(status(1, 7), accounts, ['content'])
+    assert compact['account_id'] == 'a#7'
+    assert set(compact) <= set(REQUIRED_STATUS_FIELDS) | {'content', 'account_id'}
+    assert 'uri' not in compact and compact['content'] == 'hi'
+
+def test_accounts_are_written_once(db):
+    accounts = create_accounts(db)
+    for status_id in range(3):
+        compact_status(status(status_id, 7), accounts, [])
+    accounts.close()
+    assert db['accounts'].count_documents({}) == 1
+    assert db['accounts'].find_one({"aid": "a#7"})['acct'] == 'user7'
+
+def test_compact_engagement_keeps_minimal_accounts(db):
+    accounts = create_accounts(db)
+    document = {"sid": "a#1", "reblogs": [account(1)], "favourites": [{"id": "2", "acct": "user2"}]}
+    compact = compact_engagement(document, accounts)
+    assert compact['reblogs'] == ['a#1'] and compact['favourites'] == [{"id": "2", "acct": "user2"}]
+
+def test_expand_documents_restores_accounts(db):
+    accounts = create_accounts(db)
+    compact = [compact_status(status(1, 7), accounts, ['content']),
+               compact_engagement({"sid": "a#1", "reblogs": [account(8)], "favourites": []}, accounts)]
+    accounts.close()
+    status_view, engagement_view = expand_documents(compact, db['accounts'])
+    assert status_view['account']['display_name'] == 'User 7' and 'account_id' not in status_view
+    assert engagement_view['reblogs'][0]['acct'] == 'user8'
+
+def test_compact_storage_writes_compact_statuses(db):
+    config = SimpleNamespace(writer={'batch_size': 100, 'flush_interval': 60},
+                             storage={'compact': True, 'status_fields': ['content'], 'seen_filter': False})
+    collections = {name: db[name] for name in ['livefeeds', 'error_log', 'accounts']}
+    writers = create_storage(collections, ['livefeeds', 'error_log'], config)
+    writers['livefeeds'].write(status(1, 7))
+    close_writers(writers)
+    stored = db['livefeeds'].find_one({"sid": "a#1"})
+    assert stored['account_id'] == 'a#7' and 'account' not in stored and 'uri' not in stored
+    assert db['accounts'].count_documents({"aid": "a#7"}) == 1
@@ -0,0 +1,100 @@
+# tests/test_streaming.py
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+import pytest
+
+aiohttp = pytest.importorskip('aiohttp')
+from mock_server import MockMastodon
+from streaming import (StreamingCollector, claim_stream_instances, renew_stream_instances,
+                       release_stream_instances)
+from token_pool import create_token_pool
+
+CONFIG = SimpleNamespace(api={'scheme': 'http'}, writer={'batch_size': 100, 'flush_interval': 1}, storage={})
+
+def insert_instances(collection, names):
+    collection.insert_many([{"name": name, "processable": True, "statuses": 10} for name in names])
+
+def test_claims_are_exclusive_until_they_expire(db):
+    insert_instances(db['instances'], ['a', 'b', 'c'])
+    assert len(claim_stream_instances(db['instances'], 'host1', 2)) == 2
+    assert len(claim_stream_instances(db['instances'], 'host2', 2)) == 1
+    db['instances'].update_many({"stream_owner": "host1"}, {"$set": {"stream_expires": datetime.now() - timedelta(seconds=1)}})
+    assert len(claim_stream_instances(db['instances'], 'host2', 2)) == 2
+    assert db['instances'].count_documents({"stream_owner": "host2"}) == 3
+
+def test_renew_saves_last_ids_and_release_frees_claims(db):
+    insert_instances(db['instances'], ['a', 'b'])
+    claim_stream_instances(db['instances'], 'host1', 1, lease_seconds=10)
+    name = db['instances'].find_one({"stream_owner": "host1"})['name']
+    assert renew_stream_instances(db['instances'], 'host1', 600, {name: '42'}) == {name}
+    claimed = db['instances'].find_one({"name": name})
+    assert claimed['stream_last_id'] == '42' and claimed['stream_expires'] > datetime.now() + timedelta(seconds=500)
+    release_stream_instances(db['instances'], 'host1')
+    assert claim_stream_instances(db['instances'], 'host2', 2)[0].get('stream_last_id') is None
+
+def create_collector(db, server, **kwargs):
+    insert_instances(db['instances'], server.instance_names)
+    collections = {name: db[name] for name in ['livefeeds', 'error_log', 'instances']}
+    return StreamingCollector(CONFIG, collections, create_token_pool(['token'], 'host'), owner='host1', **kwargs)
+
+def serve(server, coroutine):
+    async def main():
+        await server.start()
+        try:
+            return await coroutine()
+        finally:
+            await server.stop()
+    return asyncio.run(main())
+
+def collect(server, collector, publish_after, seconds):
+    async def main():
+        collector.end_time = datetime.now() + timedelta(seconds=seconds)
+        run = asyncio.create_task(collector.run())
+        await asyncio.sleep(publish_after)
+        published = [server.publish(port) for port in server.instances]
+        await run
+        return published
+    return serve(server, main)
+
+def test_streamed_statuses_are_saved(db):
+    server = MockMastodon(instances=2, toots=10, latency=0.001, jitter=0, base_port=18810)
+    collector = create_collector(db, server)
+    published = collect(server, collector, publish_after=0.5, seconds=1)
+    assert server.stats[('stream', 200)] == 2
+    assert sorted(doc['id'] for doc in db['livefeeds'].find()) == sorted(published)
+
+def test_instances_without_streaming_are_polled(db):
+    server = MockMastodon(instances=1, toots=10, latency=0.001, jitter=0, streaming=False, base_port=18820)
+    collector = create_collector(db, server, poll_interval=0.1)
+    published = collect(server, collector, publish_after=0.3, seconds=1)
+    assert server.stats[('stream', 200)] == 0
+    assert [doc['id'] for doc in db['livefeeds'].find()] == published
+
+def test_backfill_fetches_statuses_newer_than_the_last_id(db):
+    server = MockMastodon(instances=1, toots=100, latency=0.001, jitter=0, base_port=18830)
+    collector = create_collector(db, server)
+    name, instance = server.instance_names[0], server.instances[18830]
+    collector.last_ids[name] = str(instance.ids[9])
+
+    async def backfill():
+        async with aiohttp.ClientSession() as session:
+            await collector.backfill(session, name)
+        collector.collections['livefeeds'].close()
+    serve(server, backfill)
+    assert db['livefeeds'].count_documents({}) == 90
+    assert collector.last_ids[name] == str(instance.ids[-1])
+
+def test_finished_instances_free_their_slot(db):
+    server = MockMastodon(instances=2, toots=10, base_port=18840)
+    collector = create_collector(db, server, max_streams=2)
+
+    async def follow_instance(session, name):
+        pass
+
+    async def claim():
+        collector.follow_instance = follow_instance
+        await collector.claim(None)
+        await asyncio.gather(*collector.tasks.values())
+        return collector.tasks
+    assert asyncio.run(claim()) == {}
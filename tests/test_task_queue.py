@@ -0,0 +1,97 @@
+# tests/test_task_queue.py
+from datetime import datetime, timedelta
+from task_queue import StatusQueue, ensure_status_indexes
+from retry import RetryPolicy, crawl_error
+
+def add_statuses(collection, instances):
+    collection.insert_many([
+        {"sid": f"{instance}#{i}", "id": str(i), "instance_name": instance, "status": "pending"}
+        for i, instance in enumerate(instances)
+    ])
+
+def test_get_claims_pending_statuses(db):
+    add_statuses(db['livefeeds'], ['a', 'a', 'b'])
+    queue = StatusQueue(db['livefeeds'], owner='w', batch_size=2)
+    status = queue.get([])
+    assert status['status'] == 'read' and status['lease_owner'] == 'w'
+    assert db['livefeeds'].count_documents({"status": "read"}) == 2
+
+def test_get_skips_excluded_instances(db):
+    add_statuses(db['livefeeds'], ['a', 'b'])
+    queue = StatusQueue(db['livefeeds'], owner='w')
+    assert queue.get(['a'])['instance_name'] == 'b'
+    assert queue.get(['a']) is None
+
+def test_prefetched_statuses_of_excluded_instances_are_released(db):
+    add_statuses(db['livefeeds'], ['a', 'b'])
+    queue = StatusQueue(db['livefeeds'], owner='w', batch_size=2)
+    first = queue.get([])
+    second = queue.get([first['instance_name']])
+    assert second is None or second['instance_name'] != first['instance_name']
+    assert db['livefeeds'].count_documents({"status": "read"}) == (2 if second else 1)
+
+def test_complete_removes_lease(db):
+    add_statuses(db['livefeeds'], ['a'])
+    queue = StatusQueue(db['livefeeds'], owner='w')
+    status = queue.get([])
+    queue.complete(status)
+    stored = db['livefeeds'].find_one({"_id": status["_id"]})
+    assert stored['status'] == 'read' and 'lease_id' not in stored
+    assert queue.get([]) is None
+
+def test_expired_lease_is_taken_over(db):
+    add_statuses(db['livefeeds'], ['a'])
+    crashed = StatusQueue(db['livefeeds'], owner='crashed')
+    status = crashed.get([])
+    db['livefeeds'].update_one({"_id": status["_id"]}, {"$set": {"lease_expires": datetime.now() - timedelta(seconds=1)}})
+    taken_over = StatusQueue(db['livefeeds'], owner='other').get([])
+    assert taken_over['_id'] == status['_id'] and taken_over['lease_owner'] == 'other'
+    crashed.complete(status)
+    assert db['livefeeds'].find_one({"_id": status["_id"]})['lease_owner'] == 'other'
+
+def test_heartbeat_extends_own_leases(db):
+    add_statuses(db['livefeeds'], ['a'])
+    queue = StatusQueue(db['livefeeds'], owner='w', lease_seconds=600)
+    status = queue.get([])
+    db['livefeeds'].update_one({"_id": status["_id"]}, {"$set": {"lease_expires": datetime.now() + timedelta(seconds=5)}})
+    queue.heartbeat()
+    assert db['livefeeds'].find_one({"_id": status["_id"]})['lease_expires'] > datetime.now() + timedelta(seconds=500)
+
+def test_renew_extends_stale_prefetched_lease(db):
+    add_statuses(db['livefeeds'], ['a', 'a'])
+    queue = StatusQueue(db['livefeeds'], owner='w', batch_size=2, lease_seconds=600)
+    queue.get([])
+    waiting = queue.prefetched[0]
+    waiting['lease_expires'] = datetime.now() + timedelta(seconds=60)
+    status = queue.get([])
+    assert status['_id'] == waiting['_id']
+    assert status['lease_expires'] > datetime.now() + timedelta(seconds=500)
+
+def test_retry_and_dead_letter(db):
+    add_statuses(db['livefeeds'], ['a'])
+    queue = StatusQueue(db['livefeeds'], owner='w', retry_policy=RetryPolicy(max_attempts=2),
+                        dead_letters=db['dead_letters'])
+    status = queue.get([])
+    assert queue.retry(status, crawl_error(503))
+    stored = db['livefeeds'].find_one({"_id": status["_id"]})
+    assert stored['status'] == 'pending' and stored['attempts'] == 1
+    assert queue.get([]) is None
+    db['livefeeds'].update_one({"_id": status["_id"]}, {"$set": {"next_attempt_at": datetime.now() - timedelta(seconds=1)}})
+    status = queue.get([])
+    assert not queue.retry(status, crawl_error(503))
+    assert db['livefeeds'].find_one({"_id": status["_id"]})['status'] == 'dead'
+    assert db['dead_letters'].find_one({"key": status['sid']})['attempts'] == 2
+
+def test_defer_does_not_count_an_attempt(db):
+    add_statuses(db['livefeeds'], ['a'])
+    queue = StatusQueue(db['livefeeds'], owner='w')
+    status = queue.get([])
+    queue.defer(status, 60)
+    stored = db['livefeeds'].find_one({"_id": status["_id"]})
+    assert stored['status'] == 'pending' and 'attempts' not in stored
+    assert queue.get([]) is None
+
+def test_sparse_retry_index_is_replaced(db):
+    db['livefeeds'].create_index([("status", 1), ("next_attempt_at", 1)], name="status_next_attempt_at", sparse=True)
+    ensure_status_indexes(db['livefeeds'])
+    assert not db['livefeeds'].index_information()['status_next_attempt_at'].get('sparse')
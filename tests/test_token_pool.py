@@ -0,0 +1,42 @@
+# tests/test_token_pool.py
+from datetime import datetime, timedelta, timezone
+from token_pool import TokenPool, token_fingerprint, create_token_pool
+
+def exhausted_headers():
+    reset = datetime.now(timezone.utc) + timedelta(minutes=5)
+    return {'x-ratelimit-limit': '300', 'x-ratelimit-remaining': '2', 'x-ratelimit-reset': reset.strftime('%Y-%m-%dT%H:%M:%S.000Z')}
+
+def test_fingerprint_is_stable_and_short():
+    assert token_fingerprint('secret') == token_fingerprint('secret')
+    assert len(token_fingerprint('secret')) == 12 and 'secret' not in token_fingerprint('secret')
+
+def test_blank_tokens_are_ignored():
+    assert list(TokenPool(['t1', '', '  ']).tokens.values()) == ['t1']
+
+def test_lease_rotates_away_from_exhausted_token():
+    pool = TokenPool(['t1', 't2'])
+    token, _ = pool.lease('a')
+    pool.report('a', token, 200, exhausted_headers())
+    other, wait_time = pool.lease('a')
+    assert other != token and wait_time <= 0
+
+def test_rejected_token_is_retired_for_the_instance():
+    pool = TokenPool(['t1'])
+    pool.report('a', 't1', 401, {})
+    assert pool.lease('a')[0] is None
+    assert pool.lease('b')[0] == 't1'
+    assert pool.headers(None) == {'Email': ''}
+    assert pool.headers('t1')['Authorization'] == 'Bearer t1'
+
+def test_limited_instances():
+    pool = TokenPool(['t1', 't2'])
+    pool.penalize('a', 't1', 60)
+    assert pool.limited_instances() == []
+    pool.penalize('a', 't2', 60)
+    assert pool.limited_instances() == ['a']
+
+def test_cluster_pool_shares_budgets_through_the_central_database(db):
+    pool = create_token_pool(['t1', 't2'], 'cluster', central_db=db)
+    pool.penalize('a', 't1', 60)
+    other = create_token_pool(['t1', 't2'], 'cluster', central_db=db)
+    assert other.lease('a')[0] == 't2'
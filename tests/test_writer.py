@@ -0,0 +1,36 @@
+# tests/test_writer.py
+import time
+from writer import BufferedWriter, close_writers, create_writers
+from utils import create_unique_index
+
+def test_batch_is_flushed_when_full(db):
+    writer = BufferedWriter(db['livefeeds'], batch_size=3, flush_interval=60)
+    for i in range(4):
+        writer.write({"sid": f"a#{i}"})
+    assert db['livefeeds'].count_documents({}) == 3
+    writer.close()
+    assert db['livefeeds'].count_documents({}) == 4
+
+def test_duplicates_are_counted(db):
+    create_unique_index(db['livefeeds'], 'sid')
+    writer = BufferedWriter(db['livefeeds'], batch_size=100, flush_interval=60)
+    for sid in ['a#1', 'a#1', 'a#2']:
+        writer.write({"sid": sid})
+    assert writer.flush() == {'inserted': 2, 'duplicates': 1, 'errors': 0}
+    writer.close()
+
+def test_flush_timer_writes_waiting_documents(db):
+    writer = BufferedWriter(db['livefeeds'], batch_size=100, flush_interval=0.1)
+    writer.write({"sid": "a#1"})
+    deadline = time.monotonic() + 2
+    while not db['livefeeds'].count_documents({}) and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert db['livefeeds'].count_documents({}) == 1
+    writer.close()
+    assert writer.timer is None
+
+def test_create_writers_wraps_only_named_collections(db):
+    writers = create_writers({'livefeeds': db['livefeeds'], 'instances': db['instances']}, ['livefeeds'], {'batch_size': 7})
+    assert isinstance(writers['livefeeds'], BufferedWriter) and writers['livefeeds'].batch_size == 7
+    assert writers['instances'] is db['instances']
+    close_writers(writers)